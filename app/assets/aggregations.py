@@ -1,5 +1,8 @@
 import pandas as pd
+from app.assets import rollups
+from app.assets.cache import memoize
 
+@memoize
 def calculate_ARPU(sales_by_region: pd.DataFrame) -> pd.DataFrame:
     """
     Calculate the ARPU for each product category and region
@@ -13,14 +16,57 @@ def calculate_ARPU(sales_by_region: pd.DataFrame) -> pd.DataFrame:
             .sort_values(by="ARPU", ascending=False))
     return sales_by_region
 
-def get_total_revenue(data: dict[str, pd.DataFrame]) -> str:
-    df_order_item = data['order_item']
-    return f"${df_order_item['price'].sum().astype(int):,.0f}"
+@memoize
+def get_total_revenue(data: dict[str, pd.DataFrame],
+                      year: int | list[int] | None = None,
+                      start: str | pd.Timestamp | None = None,
+                      end: str | pd.Timestamp | None = None) -> str:
+    """
+    Total revenue, optionally for a purchase year or month range
+    Args:
+        data: dict[str, pd.DataFrame]
+            Data:
+                - monthly_rollup: pd.DataFrame
+        year: int | list[int] | None - Purchase year(s)
+        start: str | pd.Timestamp | None - First purchase month, inclusive
+        end: str | pd.Timestamp | None - Last purchase month, inclusive
+    Returns:
+        str - Formatted revenue
+    """
+    df_rollup = data['monthly_rollup']
+    revenue = df_rollup.loc[rollups.month_mask(df_rollup['purchase_month'], year, start, end), 'revenue'].sum()
+    return f"${revenue.astype(int):,.0f}"
 
-def get_total_orders(data: dict[str, pd.DataFrame]) -> str:
-    df_order = data['order']
-    return f"{df_order['order_id'].nunique():,.0f}"
+@memoize
+def get_total_orders(data: dict[str, pd.DataFrame],
+                     year: int | list[int] | None = None,
+                     start: str | pd.Timestamp | None = None,
+                     end: str | pd.Timestamp | None = None) -> str:
+    """
+    Total orders, optionally for a purchase year or month range (see get_total_revenue)
+    """
+    df_rollup = data['monthly_rollup']
+    orders = df_rollup.loc[rollups.month_mask(df_rollup['purchase_month'], year, start, end), 'order_count'].sum()
+    return f"{orders:,.0f}"
 
-def get_total_customers(data: dict[str, pd.DataFrame]) -> str:
-    df_customer = data['customer']
-    return f"{df_customer['customer_id'].nunique():,.0f}"
\ No newline at end of file
+@memoize
+def get_total_customers(data: dict[str, pd.DataFrame],
+                        year: int | list[int] | None = None,
+                        start: str | pd.Timestamp | None = None,
+                        end: str | pd.Timestamp | None = None) -> str:
+    """
+    Total unique customers, optionally for a purchase year or month range (see get_total_revenue)
+    Args:
+        data: dict[str, pd.DataFrame]
+            Data:
+                - customer_month: pd.DataFrame - Distinct customer keys of the selected months
+                  are counted, the same exact count with or without a range
+    Returns:
+        str - Formatted customer count
+    Notes:
+        - Without a range, customers with no delivered or unavailable order (NaT month) count
+          too, as the revenue of dropped orders does in get_total_revenue
+    """
+    df_customer_month = data['customer_month']
+    mask = rollups.month_mask(df_customer_month['purchase_month'], year, start, end)
+    return f"{df_customer_month.loc[mask, 'customer_key'].nunique():,.0f}"
@@ -0,0 +1,186 @@
+import functools
+import hashlib
+import inspect
+import os
+import threading
+import weakref
+from pathlib import Path
+from typing import BinaryIO
+
+import numpy as np
+import pandas as pd
+from cachetools import LRUCache
+
+# Upper bound on the memory held by cached results
+CACHE_MAX_BYTES = 256 * 1024 ** 2
+# Rows of a stamped table hashed to notice in-place changes, see table_version
+STAMP_SAMPLE_ROWS = 64
+
+# Shared by every page and session of the Streamlit server process
+_results = LRUCache(maxsize=CACHE_MAX_BYTES, getsizeof=lambda value: _sizeof(value))
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+_file_versions: dict[tuple, str] = {}
+# Versions of the tables loaded from disk, by id(). Not kept in DataFrame.attrs, which pandas
+# copies onto every frame derived from a table
+_stamps: dict[int, tuple[weakref.ref, str, tuple]] = {}
+
+def file_version(path: Path, source: BinaryIO | None = None) -> str:
+    """
+    Content hash of a file, recomputed only when its size or modification time changes
+
+    Args:
+        path: Path
+        source: BinaryIO | None - The file opened earlier, hashed instead of path (which may
+            have been replaced since). Its position is left unchanged
+    Returns:
+        str - SHA-1 hex digest of the file contents
+    """
+    stat = os.fstat(source.fileno()) if source is not None else path.stat()
+    key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_versions:
+        digest = hashlib.sha1()
+        if source is not None:
+            offset = 0
+            while chunk := os.pread(source.fileno(), 1 << 20, offset):
+                digest.update(chunk)
+                offset += len(chunk)
+        else:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+        _file_versions[key] = digest.hexdigest()
+    return _file_versions[key]
+
+def stamp_version(df: pd.DataFrame, version: str) -> pd.DataFrame:
+    """
+    Record the data version of a table loaded from disk
+
+    Only this object carries the version, frames derived from it (copies, selections, merges)
+    are hashed by table_version.
+
+    Args:
+        df: pd.DataFrame
+        version: str - e.g. file_version() of the file the table was read from
+    Returns:
+        pd.DataFrame - The same table
+    """
+    key = id(df)
+
+    def forget(ref: weakref.ref) -> None:
+        # The id of a collected table can be reused by a new one
+        if _stamps.get(key, (None,))[0] is ref:
+            del _stamps[key]
+
+    _stamps[key] = (weakref.ref(df, forget), version, _fingerprint(df))
+    return df
+
+def table_version(df: pd.DataFrame) -> str:
+    """
+    Data version of a processed table
+
+    Args:
+        df: pd.DataFrame
+    Returns:
+        str - The stamped version when df is the stamped object and still has its shape,
+            columns, dtypes and sampled rows, otherwise a content hash of the table (stamped for
+            the next call)
+    Notes:
+        - In-place changes are noticed through STAMP_SAMPLE_ROWS evenly spaced rows. A change
+          to rows outside the sample keeps the stamped version, so tables shared through the
+          cache should still be replaced rather than modified
+    """
+    stamp = _stamps.get(id(df))
+    if stamp is not None and stamp[0]() is df and stamp[2] == _fingerprint(df):
+        return stamp[1]
+    version = frame_hash(df)
+    stamp_version(df, version)
+    return version
+
+def frame_hash(df: pd.DataFrame) -> str:
+    """
+    Content hash of a DataFrame, including its columns
+    """
+    digest = hashlib.sha1(repr((df.shape, tuple(df.columns), tuple(map(str, df.dtypes)))).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def _fingerprint(df: pd.DataFrame) -> tuple:
+    # Shape, columns, dtypes and a hash of evenly spaced rows, cheap whatever the table size
+    positions = np.unique(np.linspace(0, len(df) - 1, min(len(df), STAMP_SAMPLE_ROWS)).astype('int64'))
+    sample = pd.util.hash_pandas_object(df.iloc[positions], index=True).to_numpy().tobytes()
+    return df.shape, tuple(df.columns), tuple(map(str, df.dtypes)), hashlib.sha1(sample).hexdigest()
+
+def memoize(func):
+    """
+    Cache the results of a merges/aggregations function
+
+    Results are keyed on the function, the data version of every table in a data dict
+    argument (see table_version) or the file versions of a LazyDataset, a content hash of other DataFrame arguments and the remaining
+    arguments (sales, ARPU, top_n, year, ...). The cache is bounded by CACHE_MAX_BYTES with
+    least recently used eviction and shared across pages and sessions, so cached results
+    must not be modified in place.
+
+    Args:
+        func: Callable
+    Returns:
+        Callable - func with caching, func itself is available as .uncached
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = (func.__module__, func.__qualname__,
+               tuple((name, _key_part(value)) for name, value in bound.arguments.items()))
+        with _lock:
+            if key in _results:
+                _stats['hits'] += 1
+                return _results[key]
+            _stats['misses'] += 1
+        result = func(*args, **kwargs)
+        with _lock:
+            try:
+                _results[key] = result
+            except ValueError:
+                # Larger than the whole cache
+                pass
+        return result
+
+    wrapper.uncached = func
+    return wrapper
+
+def cache_info() -> dict:
+    """
+    Hits, misses, number of entries and bytes held by the results cache
+    """
+    with _lock:
+        return {**_stats, 'entries': len(_results), 'bytes': _results.currsize}
+
+def clear_cache() -> None:
+    with _lock:
+        _results.clear()
+        _stats.update(hits=0, misses=0)
+
+def _key_part(value):
+    if hasattr(value, 'data_versions'):
+        # Lazy datasets key on file versions without loading their tables
+        return value.data_versions()
+    if isinstance(value, dict):
+        return tuple((key, table_version(table)) for key, table in sorted(value.items()))
+    if isinstance(value, pd.DataFrame):
+        # Arguments are often built by the caller and may change in place, always hash them
+        return frame_hash(value)
+    if isinstance(value, list):
+        return tuple(_key_part(item) for item in value)
+    return value
+
+def _sizeof(value) -> int:
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    return 1
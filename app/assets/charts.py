@@ -3,6 +3,52 @@ import altair as alt
 import logging
 logging.basicConfig(level=logging.INFO)
 
+# Most rows a chart may embed in its Vega-Lite spec
+MAX_CHART_ROWS = 5000
+
+def limit_rows(df: pd.DataFrame, max_rows: int = MAX_CHART_ROWS) -> pd.DataFrame:
+    """
+    Enforce the row budget of a chart
+
+    Args:
+        df: pd.DataFrame - Rows the chart would embed
+        max_rows: int - Row budget
+    Returns:
+        pd.DataFrame - df
+    Raises:
+        ValueError: If df has more than max_rows rows
+    """
+    if len(df) > max_rows:
+        raise ValueError(f"Chart would embed {len(df):,} rows, over the budget of {max_rows:,}. Aggregate first.")
+    return df
+
+def boxplot_summary(df: pd.DataFrame, value: str, by: str) -> pd.DataFrame:
+    """
+    Box plot statistics per group, computed as Vega-Lite's boxplot mark does (1.5 IQR whiskers)
+
+    Args:
+        df: pd.DataFrame - Requires value and by columns
+        value: str - Column to summarise
+        by: str - Grouping column
+    Returns:
+        pd.DataFrame - One row per group. Columns: by, lower, q1, median, q3, upper, count
+            where lower and upper are the most extreme values within 1.5 IQR of the quartiles
+    """
+    df = df[[by, value]].dropna()
+    grouped = df.groupby(by, observed=True)[value]
+    summary = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    summary.columns = ['q1', 'median', 'q3']
+
+    iqr = summary['q3'] - summary['q1']
+    low_fence = df[by].map(summary['q1'] - 1.5 * iqr)
+    high_fence = df[by].map(summary['q3'] + 1.5 * iqr)
+    inside = df[value].between(low_fence, high_fence)
+    whiskers = df[inside].groupby(by, observed=True)[value].agg(['min', 'max'])
+
+    summary['lower'] = whiskers['min']
+    summary['upper'] = whiskers['max']
+    summary['count'] = grouped.size()
+    return summary[['lower', 'q1', 'median', 'q3', 'upper', 'count']].reset_index()
 
 def get_sales_by_region_category_bubble_chart(df: pd.DataFrame) -> alt.LayerChart:
     """
@@ -12,6 +58,9 @@ def get_sales_by_region_category_bubble_chart(df: pd.DataFrame) -> alt.LayerChar
     Returns:
         alt.Chart - Sales vs ARPU by Product Category and Region
     """
+    df = limit_rows(df[['category_name', 'region', 'sales', 'ARPU', 'order_count']])
+    # Mean lines as a single row instead of aggregating df again in the browser
+    means = pd.DataFrame({'ARPU': [df['ARPU'].mean()], 'sales': [df['sales'].mean()]})
 
     bubble_chart = alt.Chart(df).mark_circle(opacity=0.7).encode(
         x=alt.X('sales:Q', title='Total Sales (BRL)'),
@@ -24,11 +73,11 @@ def get_sales_by_region_category_bubble_chart(df: pd.DataFrame) -> alt.LayerChar
         width=800,
         height=500,
     ).interactive()
-    rule = alt.Chart(df).mark_rule(color='red', strokeWidth=2).encode(
-        y=alt.Y('mean(ARPU):Q', title='Average Revenue per Order (ARPU)')
+    rule = alt.Chart(means).mark_rule(color='red', strokeWidth=2).encode(
+        y=alt.Y('ARPU:Q', title='Average Revenue per Order (ARPU)')
     )
-    rule2 = alt.Chart(df).mark_rule(color='blue', strokeWidth=2).encode(
-        x=alt.X('mean(sales):Q', title='Total Sales (BRL)')
+    rule2 = alt.Chart(means).mark_rule(color='blue', strokeWidth=2).encode(
+        x=alt.X('sales:Q', title='Total Sales (BRL)')
     )
 
     return bubble_chart + rule + rule2
@@ -37,11 +86,10 @@ def sales_ARPU_time_chart(df: pd.DataFrame, year: int | list[int] = 2017, title:
     """
     Above Average Sales and Below Average ARPU
     Args: 
-        sales_by_region: pd.DataFrame
-            Columns: Product Category, Region, Sales, Orders, ARPU
-        df_order: pd.DataFrame
-        df_order_item: pd.DataFrame
-        df_product: pd.DataFrame
+        df: pd.DataFrame - Output of merges.get_average_sales_ARPU
+            Columns: purchase_month, category_name, order_count
+        year: int | list[int] - Purchase year(s)
+        title: str
     Returns: 
         alt.Chart - Above Average Sales and Below Average ARPU
     """
@@ -54,12 +102,13 @@ def sales_ARPU_time_chart(df: pd.DataFrame, year: int | list[int] = 2017, title:
         if not all(y in VALID_YEARS for y in year):
             raise ValueError(f"All years must be in {VALID_YEARS}")
 
-    df_year = df[df['purchase_month'].dt.year.isin([year])]
+    df_year = df[df['purchase_month'].dt.year.isin(year if isinstance(year, list) else [year])]
 
-    # Group by month and category
+    # Sum over the selected regions of each category and month
     df_year_agg = df_year.groupby(
-        ['purchase_month', 'category_name']
-            ).size().reset_index(name='order_count')
+        ['purchase_month', 'category_name'], observed=True
+            )['order_count'].sum().reset_index()
+    df_year_agg = limit_rows(df_year_agg)
 
     chart = alt.Chart(df_year_agg).mark_line(point=True).encode(
         x=alt.X('purchase_month:T', title='Month'),
@@ -83,27 +132,43 @@ def payment_type_pie_chart(df: pd.DataFrame) -> alt.Chart:
     Returns:
         alt.Chart - Payment type and payment value
     """
-    chart = alt.Chart(df).mark_arc().encode(
-        theta="sum(payment_value):Q",
+    source = limit_rows(df.groupby('payment_type', observed=True)['payment_value'].sum().reset_index())
+    chart = alt.Chart(source).mark_arc().encode(
+        theta="payment_value:Q",
         color="payment_type:N"
     )
     return chart
 
-def delivery_time_boxplot_chart(df_order: pd.DataFrame, df_order_review: pd.DataFrame) -> alt.Chart:
+def delivery_time_boxplot_chart(df_fact: pd.DataFrame) -> alt.LayerChart:
     """
     Get the chart for delivery time
     Args:
-        df: pd.DataFrame - Requires delivery_time and review_score columns
+        df_fact: pd.DataFrame - Order fact table, requires delivery_time and review_score columns
     Returns:
-        alt.Chart - Delivery time and review score
+        alt.LayerChart - Delivery time and review score
+    Notes:
+        - The box plot is drawn from precomputed quartiles and whiskers, outliers are not drawn
     """
-    order_cols = ['order_id', 'delivery_time']
-    review_cols = ['order_id', 'review_score']
-    source = df_order[order_cols].merge(df_order_review[review_cols], on='order_id', how='left')
-    chart = alt.Chart(source).mark_boxplot().encode(
-        y=alt.Y('delivery_time:Q', title='Delivery Time', scale=alt.Scale(domain=[1, 50])),
+    source = df_fact.loc[df_fact['order_status'].notna(), ['delivery_time', 'review_score']]
+    summary = limit_rows(boxplot_summary(source, 'delivery_time', 'review_score'))
+
+    base = alt.Chart(summary).encode(
         x=alt.X('review_score:O', title='Review Score', sort=[1,2,3,4,5])
-    ).properties(
+    )
+    y_scale = alt.Scale(domain=[1, 50])
+    whiskers = base.mark_rule().encode(
+        y=alt.Y('lower:Q', title='Delivery Time', scale=y_scale),
+        y2='upper:Q'
+    )
+    boxes = base.mark_bar(size=14).encode(
+        y=alt.Y('q1:Q', scale=y_scale),
+        y2='q3:Q',
+        tooltip=['review_score:O', 'lower:Q', 'q1:Q', 'median:Q', 'q3:Q', 'upper:Q', 'count:Q']
+    )
+    medians = base.mark_tick(color='white', size=14).encode(
+        y=alt.Y('median:Q', scale=y_scale)
+    )
+    chart = (whiskers + boxes + medians).properties(
     title='Delivery Time by Review Score'
     )
-    return chart
\ No newline at end of file
+    return chart
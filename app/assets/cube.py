@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+
+# order_fact columns indexing the cube, in axis order
+CUBE_AXES = ('category_name', 'region', 'purchase_month')
+
+class SalesCube:
+    """
+    Order line counts and sales of order_fact in dense arrays indexed by (category, region, purchase month)
+
+    Each axis holds the sorted known values then one slot for missing values, so every order line
+    is counted and totals over an axis are those of order_fact. The arrays hold
+    (categories + 1) x (regions + 1) x (months + 1) cells whatever the number of orders.
+    """
+
+    def __init__(self,
+                 categories: pd.Index,
+                 regions: pd.Index,
+                 months: pd.DatetimeIndex,
+                 order_count: np.ndarray,
+                 sales: np.ndarray):
+        self.categories = categories
+        self.regions = regions
+        self.months = months
+        self.order_count = order_count
+        self.sales = sales
+
+    @property
+    def ARPU(self) -> np.ndarray:
+        """
+        Sales per order line of each cell, rounded as calculate_ARPU, NaN for empty cells
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.round(self.sales / self.order_count, 2)
+
+    @property
+    def nbytes(self) -> int:
+        return self.order_count.nbytes + self.sales.nbytes
+
+    def to_frame(self, categories: list[str] | None = None, by_region: bool = True) -> pd.DataFrame:
+        """
+        Non-empty cells of known categories and months in long format
+
+        Args:
+            categories: list[str] | None - Only these categories, in this order (all if None).
+                Categories not in the cube are skipped
+            by_region: bool - One row per region (missing region as NaN), or summed over regions
+        Returns:
+            pd.DataFrame - Columns: category_name, region (if by_region), purchase_month,
+                order_count, sales, ARPU. Rows by category, then region, then month
+        """
+        positions = np.arange(len(self.categories)) if categories is None else self.categories.get_indexer(categories)
+        positions = positions[positions >= 0]
+        # Known months only, lines without a purchase month are not on any timeline
+        counts = self.order_count[positions, :, :-1]
+        sales = self.sales[positions, :, :-1]
+        if not by_region:
+            counts, sales = counts.sum(axis=1, keepdims=True), sales.sum(axis=1, keepdims=True)
+
+        category, region, month = np.nonzero(counts)
+        frame = pd.DataFrame({'category_name': self.categories[positions[category]]})
+        if by_region:
+            frame['region'] = self.regions.append(pd.Index([np.nan]))[region]
+        frame['purchase_month'] = self.months[month]
+        frame['order_count'] = counts[category, region, month]
+        frame['sales'] = sales[category, region, month]
+        frame['ARPU'] = np.round(frame['sales'] / frame['order_count'], 2)
+        return frame
+
+def build_sales_cube(df_fact: pd.DataFrame) -> SalesCube:
+    """
+    Count and sum the order lines of order_fact into a SalesCube
+
+    Args:
+        df_fact: pd.DataFrame - Requires category_name, region, purchase_month and price columns
+    Returns:
+        SalesCube
+    """
+    axes, codes = [], []
+    for col in CUBE_AXES:
+        col_codes, uniques = pd.factorize(df_fact[col], sort=True)
+        col_codes[col_codes < 0] = len(uniques)
+        axes.append(pd.Index(np.asarray(uniques)) if col != 'purchase_month' else pd.DatetimeIndex(uniques))
+        codes.append(col_codes)
+
+    shape = tuple(len(axis) + 1 for axis in axes)
+    cells = np.ravel_multi_index(codes, shape)
+    order_count = np.bincount(cells, minlength=np.prod(shape)).reshape(shape)
+    sales = np.bincount(cells, weights=df_fact['price'].to_numpy('float64'), minlength=np.prod(shape)).reshape(shape)
+    return SalesCube(*axes, order_count, sales)
@@ -0,0 +1,281 @@
+import hashlib
+import os
+import threading
+import time
+from collections.abc import Mapping
+from pathlib import Path
+from typing import BinaryIO
+
+import pandas as pd
+from streamlit import cache_resource
+
+from app.assets import cache, dimensions, manifest
+from app.assets.preprocessing import (DATA_PROCESSED_DIR, DEFAULT_FORMAT, DICTIONARY_TABLE, PROCESSED_TABLES,
+                                      check_format, read_table)
+
+# Tables no page has accessed for this long are released
+IDLE_SECONDS = 15 * 60
+# Environment variable selecting the format of the tables the dashboard reads
+FORMAT_ENV = 'OLIST_FORMAT'
+
+def served_format(processed_dir: Path = DATA_PROCESSED_DIR) -> str:
+    """
+    Format of the processed tables the dashboard reads
+
+    Returns:
+        str - The OLIST_FORMAT environment variable, then the format recorded in the manifest
+            of the last run, then DEFAULT_FORMAT
+    Raises:
+        ValueError: If OLIST_FORMAT is not one of PROCESSED_FORMATS
+    """
+    fmt = os.environ.get(FORMAT_ENV) or manifest.read_manifest(processed_dir)['format'] or DEFAULT_FORMAT
+    check_format(fmt)
+    return fmt
+
+def data_version(processed_dir: Path = DATA_PROCESSED_DIR, fmt: str = DEFAULT_FORMAT) -> str:
+    """
+    Version of the processed tables as a whole
+
+    Returns:
+        str - Content hash of the manifest, which every run writes after its tables, or without
+            a manifest a hash of the size and modification time of the table files
+    """
+    path = processed_dir / manifest.MANIFEST_FILE
+    if path.exists():
+        return cache.file_version(path)
+    stats = [(key, stat.st_size, stat.st_mtime_ns) for key in PROCESSED_TABLES
+             if (stat := _stat(processed_dir / f'{key}.{fmt}')) is not None]
+    return hashlib.sha1(repr(stats).encode()).hexdigest()
+
+def _stat(path: Path) -> os.stat_result | None:
+    try:
+        return path.stat()
+    except FileNotFoundError:
+        return None
+
+class Snapshot(Mapping):
+    """
+    Processed tables of one data version, loaded on first access
+
+    Every table file is opened when the snapshot is created, and runs replace the files rather
+    than rewrite them (see preprocessing.write_table), so tables loaded later still come from
+    this version. Feather files are memory mapped: numeric and date columns are views of the
+    page cache, shared by every session and process reading them. Tables are released once no
+    page has accessed them for idle_seconds. Dimension columns load as categoricals with the
+    codes of the dimension_dictionary table of the snapshot. Safe to share between sessions.
+    """
+
+    def __init__(self,
+                 version: str,
+                 fmt: str = DEFAULT_FORMAT,
+                 processed_dir: Path = DATA_PROCESSED_DIR,
+                 idle_seconds: float = IDLE_SECONDS):
+        self.version = version
+        self.fmt = fmt
+        self.processed_dir = processed_dir
+        self.idle_seconds = idle_seconds
+        self._files: dict[str, BinaryIO] = {}
+        for key in PROCESSED_TABLES:
+            try:
+                self._files[key] = open(self.path(key), 'rb')
+            except FileNotFoundError:
+                pass
+        self._tables: dict[str, pd.DataFrame] = {}
+        # Loaded columns per table, None when every column is loaded
+        self._columns: dict[str, set[str] | None] = {}
+        self._last_access: dict[str, float] = {}
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key: str) -> pd.DataFrame:
+        return self.table(key)
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def __del__(self):
+        for f in getattr(self, '_files', {}).values():
+            f.close()
+
+    def path(self, key: str) -> Path:
+        return self.processed_dir / f'{key}.{self.fmt}'
+
+    def table(self, key: str, columns: list[str] | None = None) -> pd.DataFrame:
+        """
+        Get a table, loading it if needed
+
+        Args:
+            key: str - Table name
+            columns: list[str] | None - Columns needed (every column if None). The returned
+                table may hold more columns, when other pages requested them
+        Returns:
+            pd.DataFrame - Shared, must not be modified in place
+        Raises:
+            KeyError: If the table does not exist in this snapshot
+        """
+        self._check_table(key)
+        with self._lock:
+            self.release_idle()
+            loaded = self._columns.get(key, set())
+            if key not in self._tables or (loaded is not None and (columns is None or not set(columns) <= loaded)):
+                wanted = None if columns is None or loaded is None else sorted(loaded | set(columns))
+                self._tables[key] = read_table(self.path(key), self.fmt, wanted, self.dimension_dtypes(key),
+                                               self._files[key])
+                self._columns[key] = None if wanted is None else set(wanted)
+            self._last_access[key] = time.monotonic()
+            return self._tables[key]
+
+    def dimension_dtypes(self, key: str) -> dict[str, pd.CategoricalDtype] | None:
+        """
+        Dictionary dtypes to read a table with, None without a dimension_dictionary table
+        """
+        if key == DICTIONARY_TABLE or DICTIONARY_TABLE not in self._files:
+            return None
+        return dimensions.dictionary_dtypes(self.table(DICTIONARY_TABLE))
+
+    def view(self, columns: dict[str, list[str]]) -> 'DatasetView':
+        """
+        Page-scoped access to some tables and columns
+
+        Args:
+            columns: dict[str, list[str]] - Columns needed per table
+        Returns:
+            DatasetView - Mapping with the same data['order'] interface
+        """
+        return DatasetView(self, columns)
+
+    def data_versions(self, keys: list[str] | None = None) -> tuple:
+        """
+        File versions of the tables, without loading them (used as cache key)
+        """
+        keys = list(self) if keys is None else keys
+        for key in keys:
+            self._check_table(key)
+        with self._lock:
+            return tuple((key, cache.file_version(self.path(key), self._files[key])) for key in sorted(keys))
+
+    def _check_table(self, key: str) -> None:
+        if key not in self._files:
+            if key in PROCESSED_TABLES:
+                raise KeyError(f"No {self.path(key).name} in {self.processed_dir}, run preprocessing.py "
+                               f"--format {self.fmt} or set {FORMAT_ENV} to the format of the processed tables")
+            raise KeyError(key)
+
+    def release_idle(self) -> list[str]:
+        """
+        Release the tables not accessed for idle_seconds
+
+        Returns:
+            list[str] - Released tables
+        """
+        now = time.monotonic()
+        with self._lock:
+            idle = [key for key, last in self._last_access.items() if now - last > self.idle_seconds]
+            for key in idle:
+                self.release(key)
+        return idle
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            for state in (self._tables, self._columns, self._last_access):
+                state.pop(key, None)
+
+    def loaded(self) -> dict[str, int]:
+        """
+        Memory held per loaded table, in bytes (mapped columns included)
+        """
+        with self._lock:
+            return {key: int(df.memory_usage(deep=True).sum()) for key, df in self._tables.items()}
+
+class LazyDataset(Mapping):
+    """
+    The current Snapshot of the processed tables
+
+    dataset['order'] loads the whole table, view() restricts a page to the columns it needs and
+    pins the snapshot for the rerun. When data_version() changes, e.g. after a new run wrote
+    data/processed, the next access swaps in a new snapshot at once. Reruns holding a view of
+    the previous one finish on it, its tables are freed with the last view.
+    """
+
+    def __init__(self,
+                 fmt: str = DEFAULT_FORMAT,
+                 processed_dir: Path = DATA_PROCESSED_DIR,
+                 idle_seconds: float = IDLE_SECONDS):
+        check_format(fmt)
+        self.fmt = fmt
+        self.processed_dir = processed_dir
+        self.idle_seconds = idle_seconds
+        self._snapshot: Snapshot | None = None
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> Snapshot:
+        """
+        The snapshot of the current data version, opened on first access after a change
+        """
+        version = data_version(self.processed_dir, self.fmt)
+        with self._lock:
+            if self._snapshot is None or self._snapshot.version != version:
+                self._snapshot = Snapshot(version, self.fmt, self.processed_dir, self.idle_seconds)
+            return self._snapshot
+
+    def __getitem__(self, key: str) -> pd.DataFrame:
+        return self.snapshot().table(key)
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __len__(self) -> int:
+        return len(self.snapshot())
+
+    def path(self, key: str) -> Path:
+        return self.processed_dir / f'{key}.{self.fmt}'
+
+    def table(self, key: str, columns: list[str] | None = None) -> pd.DataFrame:
+        return self.snapshot().table(key, columns)
+
+    def view(self, columns: dict[str, list[str]]) -> 'DatasetView':
+        return self.snapshot().view(columns)
+
+    def data_versions(self, keys: list[str] | None = None) -> tuple:
+        return self.snapshot().data_versions(keys)
+
+    def release_idle(self) -> list[str]:
+        return self.snapshot().release_idle()
+
+    def loaded(self) -> dict[str, int]:
+        return self.snapshot().loaded()
+
+class DatasetView(Mapping):
+    """
+    The tables and columns of a Snapshot one page needs
+    """
+
+    def __init__(self, dataset: Snapshot, columns: dict[str, list[str]]):
+        self.dataset = dataset
+        self.columns = columns
+
+    def __getitem__(self, key: str) -> pd.DataFrame:
+        if key not in self.columns:
+            raise KeyError(key)
+        return self.dataset.table(key, self.columns[key])
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __len__(self) -> int:
+        return len(self.columns)
+
+    def data_versions(self) -> tuple:
+        return self.dataset.data_versions(list(self.columns))
+
+@cache_resource
+def get_dataset(fmt: str | None = None) -> LazyDataset:
+    """
+    The LazyDataset of a format shared by every page and session of the Streamlit server
+
+    Args:
+        fmt: str | None - One of PROCESSED_FORMATS, served_format() if None
+    """
+    return LazyDataset(fmt or served_format())
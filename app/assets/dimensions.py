@@ -0,0 +1,265 @@
+from collections.abc import Iterable
+
+import numpy as np
+import pandas as pd
+
+# Brazilian zip code prefixes (first five CEP digits) are below this bound
+ZIP_PREFIX_MAX = 100_000
+# Label columns with integer codes shared by every processed table, see build_dimension_dictionary
+DIMENSION_COLUMNS = ('state', 'region', 'city', 'category_name', 'payment_type', 'order_status')
+
+def build_zip_dimension(df_geo: pd.DataFrame) -> pd.DataFrame:
+    """
+    Collapse the geolocation table to one row per zip code prefix
+
+    Args:
+        df_geo: pd.DataFrame - Requires zip_code_prefix, latitude, longitude, city, state and region columns
+    Returns:
+        pd.DataFrame - One row per zip code prefix, sorted
+            Columns: zip_code_prefix, latitude, longitude, city, state, region
+            Data:
+                - latitude, longitude: centroid of the geolocation points of the zip
+                - city, state, region: first non-null value of the zip
+    """
+    zip_dim = (df_geo
+               .groupby('zip_code_prefix', sort=True)
+               .agg(latitude=('latitude', 'mean'),
+                    longitude=('longitude', 'mean'),
+                    city=('city', 'first'),
+                    state=('state', 'first'),
+                    region=('region', 'first'))
+               .reset_index())
+    return zip_dim
+
+def zip_dimension_partials(df_geo: pd.DataFrame) -> pd.DataFrame:
+    """
+    Mergeable aggregates of build_zip_dimension over a chunk of the geolocation table
+
+    Args:
+        df_geo: pd.DataFrame - See build_zip_dimension
+    Returns:
+        pd.DataFrame - One row per zip code prefix, sorted
+            Columns: zip_code_prefix, latitude_sum, latitude_count, longitude_sum, longitude_count,
+            city, state, region
+    """
+    return (df_geo
+            .groupby('zip_code_prefix', sort=True)
+            .agg(latitude_sum=('latitude', 'sum'),
+                 latitude_count=('latitude', 'count'),
+                 longitude_sum=('longitude', 'sum'),
+                 longitude_count=('longitude', 'count'),
+                 city=('city', 'first'),
+                 state=('state', 'first'),
+                 region=('region', 'first'))
+            .reset_index())
+
+def merge_zip_dimension_partials(partials: list[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Merge outputs of zip_dimension_partials
+
+    Args:
+        partials: list[pd.DataFrame] - In geolocation row order, so first values stay first
+    Returns:
+        pd.DataFrame - Same columns as zip_dimension_partials
+    """
+    return (pd.concat(partials, ignore_index=True)
+            .groupby('zip_code_prefix', sort=True)
+            .agg(latitude_sum=('latitude_sum', 'sum'),
+                 latitude_count=('latitude_count', 'sum'),
+                 longitude_sum=('longitude_sum', 'sum'),
+                 longitude_count=('longitude_count', 'sum'),
+                 city=('city', 'first'),
+                 state=('state', 'first'),
+                 region=('region', 'first'))
+            .reset_index())
+
+def finish_zip_dimension(partial: pd.DataFrame) -> pd.DataFrame:
+    """
+    Turn merged zip_dimension_partials into the output of build_zip_dimension
+    """
+    return pd.DataFrame({
+        'zip_code_prefix': partial['zip_code_prefix'],
+        'latitude': partial['latitude_sum'] / partial['latitude_count'],
+        'longitude': partial['longitude_sum'] / partial['longitude_count'],
+        'city': partial['city'],
+        'state': partial['state'],
+        'region': partial['region'],
+    })
+
+def build_zip_lookup(zip_dim: pd.DataFrame, column: str) -> pd.Categorical | np.ndarray:
+    """
+    Build a dense lookup array where position i holds the value of zip code prefix i
+
+    Args:
+        zip_dim: pd.DataFrame - Output of build_zip_dimension
+        column: str - Column to look up
+    Returns:
+        pd.Categorical | np.ndarray - Length ZIP_PREFIX_MAX. Categorical for string columns
+            (unknown zips are NaN), float array for numeric columns (unknown zips are NaN)
+    """
+    zips = zip_dim['zip_code_prefix'].to_numpy('int64')
+    values = zip_dim[column]
+
+    if pd.api.types.is_numeric_dtype(values):
+        lookup = np.full(ZIP_PREFIX_MAX, np.nan)
+        lookup[zips] = values.to_numpy('float64')
+        return lookup
+
+    values = pd.Categorical(values)
+    codes = np.full(ZIP_PREFIX_MAX, -1, dtype=values.codes.dtype)
+    codes[zips] = values.codes
+    return pd.Categorical.from_codes(codes, values.categories)
+
+def lookup_zips(zips: pd.Series | np.ndarray, lookup: pd.Categorical | np.ndarray) -> pd.Categorical | np.ndarray:
+    """
+    Map zip code prefixes to values with an array index instead of a merge
+
+    Args:
+        zips: pd.Series | np.ndarray - Zip code prefixes, may contain NaN
+        lookup: pd.Categorical | np.ndarray - Output of build_zip_lookup
+    Returns:
+        pd.Categorical | np.ndarray - One value per zip, NaN for missing or unknown zips
+    """
+    zips = pd.Series(zips).to_numpy('float64', na_value=np.nan)
+    valid = ~np.isnan(zips) & (zips >= 0) & (zips < ZIP_PREFIX_MAX)
+    positions = np.where(valid, zips, 0).astype('int64')
+
+    if isinstance(lookup, pd.Categorical):
+        codes = np.where(valid, lookup.codes[positions], -1)
+        return pd.Categorical.from_codes(codes, lookup.categories)
+    return np.where(valid, lookup[positions], np.nan)
+
+def zip_to_region(zips: pd.Series | np.ndarray, zip_dim: pd.DataFrame) -> pd.Categorical:
+    """
+    Map zip code prefixes to their region
+
+    Args:
+        zips: pd.Series | np.ndarray - Zip code prefixes
+        zip_dim: pd.DataFrame - Output of build_zip_dimension
+    Returns:
+        pd.Categorical - Region of each zip, NaN for unknown zips
+    """
+    return lookup_zips(zips, build_zip_lookup(zip_dim, 'region'))
+
+def map_labels(values: pd.Series, mapping: dict) -> pd.Series:
+    """
+    Map labels through a dict once per distinct label instead of once per row
+
+    Args:
+        values: pd.Series - Labels, may be categorical
+        mapping: dict - Label to mapped label
+    Returns:
+        pd.Series - Categorical with the sorted mapped labels as categories, NaN for missing or
+            unmapped labels
+    """
+    codes, uniques = pd.factorize(values)
+    targets = pd.Index(np.asarray(uniques, dtype=object)).map(mapping)
+    categories = pd.Index(sorted(targets.dropna().unique()))
+    # -1 codes (missing labels) pick the appended -1
+    target_codes = np.append(categories.get_indexer(targets), -1)
+    return pd.Series(pd.Categorical.from_codes(target_codes[codes], categories), index=values.index, name=values.name)
+
+def dimension_labels(tables: Iterable[pd.DataFrame]) -> dict[str, set]:
+    """
+    Distinct labels of the DIMENSION_COLUMNS found in the tables
+
+    Args:
+        tables: Iterable[pd.DataFrame]
+    Returns:
+        dict[str, set] - Non-null labels per dimension column
+    """
+    labels = {col: set() for col in DIMENSION_COLUMNS}
+    for df in tables:
+        for col in DIMENSION_COLUMNS:
+            if col in df.columns:
+                labels[col].update(df[col].dropna().unique())
+    return labels
+
+def build_dimension_dictionary(labels: dict[str, Iterable[str]], previous: pd.DataFrame | None = None) -> pd.DataFrame:
+    """
+    Assign an integer code to each label of the dimension columns
+
+    Args:
+        labels: dict[str, Iterable[str]] - Labels per dimension column, see dimension_labels
+        previous: pd.DataFrame | None - Dictionary to extend. Its labels keep their codes
+    Returns:
+        pd.DataFrame - Columns: column, code, label. Codes count from 0 per column: labels of
+            previous first, then the new labels sorted
+    """
+    frames = []
+    for col in DIMENSION_COLUMNS:
+        known = [] if previous is None else list(previous.loc[previous['column'] == col].sort_values('code')['label'])
+        new = sorted(set(labels.get(col, ())) - set(known))
+        frames.append(pd.DataFrame({'column': col, 'code': np.arange(len(known) + len(new), dtype='int32'),
+                                    'label': known + new}))
+    return pd.concat(frames, ignore_index=True)
+
+def dictionary_dtypes(dictionary: pd.DataFrame) -> dict[str, pd.CategoricalDtype]:
+    """
+    Categorical dtype of each dimension column, whose codes are the dictionary codes
+
+    Args:
+        dictionary: pd.DataFrame - Output of build_dimension_dictionary
+    Returns:
+        dict[str, pd.CategoricalDtype]
+    """
+    return {col: pd.CategoricalDtype(dictionary.loc[dictionary['column'] == col]
+                                     .sort_values('code')['label'].to_numpy(dtype=object))
+            for col in DIMENSION_COLUMNS}
+
+def encode_dimensions(df: pd.DataFrame, dtypes: dict[str, pd.CategoricalDtype]) -> pd.DataFrame:
+    """
+    Convert the dimension columns of a table to their dictionary dtypes, in place
+
+    Args:
+        df: pd.DataFrame
+        dtypes: dict[str, pd.CategoricalDtype] - Output of dictionary_dtypes
+    Returns:
+        pd.DataFrame - The same table. Labels missing from the dictionary become NaN
+    """
+    for col, dtype in dtypes.items():
+        # Column by column, astype on the table would copy the other columns too
+        if col in df.columns and df[col].dtype != dtype:
+            df[col] = df[col].astype(dtype)
+    return df
+
+def encode(values: pd.Series | np.ndarray, dictionary: pd.DataFrame, column: str) -> np.ndarray:
+    """
+    Labels to dictionary codes
+
+    Args:
+        values: pd.Series | np.ndarray - Labels of a dimension column
+        dictionary: pd.DataFrame - Output of build_dimension_dictionary
+        column: str - One of DIMENSION_COLUMNS
+    Returns:
+        np.ndarray - Integer codes, -1 for missing labels
+    Raises:
+        ValueError: If the column is not a dimension column or a label is not in the dictionary
+    """
+    dtype = _dictionary_dtype(dictionary, column)
+    codes = pd.Categorical(values, dtype=dtype).codes
+    unknown = (codes < 0) & pd.notna(np.asarray(values, dtype=object))
+    if unknown.any():
+        raise ValueError(f"Labels {sorted(set(np.asarray(values, dtype=object)[unknown]))[:5]} not in the {column} dictionary")
+    return codes
+
+def decode(codes: np.ndarray, dictionary: pd.DataFrame, column: str) -> pd.Categorical:
+    """
+    Dictionary codes to labels
+
+    Args:
+        codes: np.ndarray - Integer codes, -1 for missing labels
+        dictionary: pd.DataFrame - Output of build_dimension_dictionary
+        column: str - One of DIMENSION_COLUMNS
+    Returns:
+        pd.Categorical
+    Raises:
+        ValueError: If the column is not a dimension column
+    """
+    dtype = _dictionary_dtype(dictionary, column)
+    return pd.Categorical.from_codes(codes, dtype=dtype)
+
+def _dictionary_dtype(dictionary: pd.DataFrame, column: str) -> pd.CategoricalDtype:
+    if column not in DIMENSION_COLUMNS:
+        raise ValueError(f"Column {column} not in {DIMENSION_COLUMNS}")
+    return dictionary_dtypes(dictionary)[column]
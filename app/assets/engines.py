@@ -0,0 +1,248 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# Environment variable selecting the engine of the merges, aggregations and preprocessing joins
+ENGINE_ENV = 'OLIST_ENGINE'
+DEFAULT_ENGINE = 'pandas'
+AGGREGATIONS = ('sum', 'count')
+# Row numbers keeping the pandas row order of a merge
+LEFT_ROW, RIGHT_ROW = '__left_row', '__right_row'
+
+class Engine:
+    """
+    Joins and grouped aggregations on pandas DataFrames
+
+    Subclasses run them on another engine, taking and returning pandas DataFrames with the rows,
+    row order, columns and dtypes pandas gives. Float sums may differ in the last digits.
+    """
+    name = 'pandas'
+
+    def merge(self, left: pd.DataFrame, right: pd.DataFrame, on: str | list[str], how: str = 'inner') -> pd.DataFrame:
+        """
+        pd.merge(left, right, on=on, how=how)
+
+        Args:
+            left: pd.DataFrame
+            right: pd.DataFrame - Columns other than on must not be in left
+            on: str | list[str] - Key columns
+            how: str - 'inner' or 'left'
+        Returns:
+            pd.DataFrame - Rows in left order, then right order for the rows of a same left row
+        """
+        return pd.merge(left, right, on=on, how=how)
+
+    def groupby_agg(self, df: pd.DataFrame, keys: list[str], aggs: dict[str, tuple[str, str]]) -> pd.DataFrame:
+        """
+        df.groupby(keys, observed=True).agg(**aggs).reset_index()
+
+        Args:
+            df: pd.DataFrame
+            keys: list[str] - Group columns, rows with a missing key are dropped
+            aggs: dict[str, tuple[str, str]] - Output column: (input column, one of AGGREGATIONS)
+        Returns:
+            pd.DataFrame - keys then the aggs columns, one row per group sorted by keys
+        """
+        return df.groupby(keys, observed=True).agg(**aggs).reset_index()
+
+class PolarsEngine(Engine):
+    """
+    Runs on Polars lazy frames, multi-threaded (pip install polars)
+    """
+    name = 'polars'
+
+    def __init__(self):
+        try:
+            import polars
+        except ImportError as error:
+            raise ImportError("The polars engine needs polars installed (pip install polars)") from error
+        self.pl = polars
+
+    def merge(self, left: pd.DataFrame, right: pd.DataFrame, on: str | list[str], how: str = 'inner') -> pd.DataFrame:
+        on = check_merge(left, right, on, how)
+        coded_left, coded_right = coded_keys(left, right, on)
+        joined = (self._lazy(coded_left).with_row_index(LEFT_ROW)
+                  .join(self._lazy(coded_right).with_row_index(RIGHT_ROW), on=on, how=how, coalesce=True)
+                  .sort([LEFT_ROW, RIGHT_ROW], nulls_last=True)
+                  .drop([LEFT_ROW, RIGHT_ROW])
+                  .collect())
+        return restore_merge_dtypes(joined.to_pandas(), left, right, on)
+
+    def groupby_agg(self, df: pd.DataFrame, keys: list[str], aggs: dict[str, tuple[str, str]]) -> pd.DataFrame:
+        check_aggs(aggs)
+        pl = self.pl
+        exprs = [pl.col(col).sum().alias(out) if func == 'sum' else pl.col(col).count().alias(out)
+                 for out, (col, func) in aggs.items()]
+        columns = list(dict.fromkeys(keys + [col for col, _ in aggs.values()]))
+        grouped = (self._lazy(df[columns])
+                   .filter(pl.all_horizontal([pl.col(key).is_not_null() for key in keys]))
+                   .group_by(keys)
+                   .agg(exprs)
+                   .collect())
+        return restore_groupby_dtypes(grouped.to_pandas(), df, keys, aggs)
+
+    def _lazy(self, df: pd.DataFrame):
+        return self.pl.from_pandas(plain(df)).lazy()
+
+class DuckDBEngine(Engine):
+    """
+    Runs on an embedded DuckDB, multi-threaded (pip install duckdb)
+    """
+    name = 'duckdb'
+
+    def __init__(self):
+        try:
+            import duckdb
+        except ImportError as error:
+            raise ImportError("The duckdb engine needs duckdb installed (pip install duckdb)") from error
+        self.duckdb = duckdb
+
+    def merge(self, left: pd.DataFrame, right: pd.DataFrame, on: str | list[str], how: str = 'inner') -> pd.DataFrame:
+        on = check_merge(left, right, on, how)
+        columns = ([f'l."{col}"' for col in left.columns]
+                   + [f'r."{col}"' for col in right.columns if col not in on])
+        condition = ' AND '.join(f'l."{key}" = r."{key}"' for key in on)
+        coded_left, coded_right = coded_keys(left, right, on)
+        joined = self._query(f'SELECT {", ".join(columns)} FROM l {how.upper()} JOIN r ON {condition} '
+                             f'ORDER BY l."{LEFT_ROW}", r."{RIGHT_ROW}"',
+                             l=plain(coded_left).assign(**{LEFT_ROW: np.arange(len(left))}),
+                             r=plain(coded_right).assign(**{RIGHT_ROW: np.arange(len(right))}))
+        return restore_merge_dtypes(joined, left, right, on)
+
+    def groupby_agg(self, df: pd.DataFrame, keys: list[str], aggs: dict[str, tuple[str, str]]) -> pd.DataFrame:
+        check_aggs(aggs)
+        columns = [f'"{key}"' for key in keys] + [f'{func.upper()}("{col}") AS "{out}"'
+                                                  for out, (col, func) in aggs.items()]
+        where = ' AND '.join(f'"{key}" IS NOT NULL' for key in keys)
+        grouped = self._query(f'SELECT {", ".join(columns)} FROM t WHERE {where} GROUP BY ALL', t=plain(df))
+        # SUM over a group of nulls is NULL in SQL, 0 in pandas
+        grouped = grouped.fillna({out: 0 for out, (_, func) in aggs.items() if func == 'sum'})
+        return restore_groupby_dtypes(grouped, df, keys, aggs)
+
+    def _query(self, sql: str, **tables: pd.DataFrame) -> pd.DataFrame:
+        con = self.duckdb.connect()
+        try:
+            for name, df in tables.items():
+                con.register(name, df)
+            return con.execute(sql).df()
+        finally:
+            con.close()
+
+ENGINES = {'pandas': Engine, 'polars': PolarsEngine, 'duckdb': DuckDBEngine}
+
+def get_engine(name: str | None = None) -> Engine:
+    """
+    Engine by name, shared by all callers
+
+    Args:
+        name: str | None - One of ENGINES, defaults to the OLIST_ENGINE environment variable, then pandas
+    Returns:
+        Engine
+    Raises:
+        ValueError: If the engine is unknown
+        ImportError: If the engine library is not installed
+    """
+    name = name or os.environ.get(ENGINE_ENV) or DEFAULT_ENGINE
+    if name not in ENGINES:
+        raise ValueError(f"Engine {name} not in {tuple(ENGINES)}")
+    return _engine(name)
+
+@lru_cache(maxsize=None)
+def _engine(name: str) -> Engine:
+    return ENGINES[name]()
+
+def check_merge(left: pd.DataFrame, right: pd.DataFrame, on: str | list[str], how: str) -> list[str]:
+    """
+    Validate a merge run outside pandas
+
+    Returns:
+        list[str] - The key columns
+    Raises:
+        ValueError: If how is not inner or left, or a non-key column is on both sides (pandas would suffix it)
+    """
+    on = [on] if isinstance(on, str) else list(on)
+    if how not in ('inner', 'left'):
+        raise ValueError(f"Merge how={how} not in ('inner', 'left')")
+    shared = (set(left.columns) & set(right.columns)) - set(on)
+    if shared:
+        raise ValueError(f"Columns {sorted(shared)} are on both sides of the merge")
+    return on
+
+def check_aggs(aggs: dict[str, tuple[str, str]]) -> None:
+    for col, func in aggs.values():
+        if func not in AGGREGATIONS:
+            raise ValueError(f"Aggregation {func} of {col} not in {AGGREGATIONS}")
+
+def plain(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Categorical columns as their integer codes (nullable, missing labels are null), so the
+    engines group and join on small integers. Restored by restore_merge_dtypes and restore_groupby_dtypes
+    """
+    categoricals = [col for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)]
+    if not categoricals:
+        return df.reset_index(drop=True)
+    codes = {col: pd.arrays.IntegerArray(df[col].cat.codes.to_numpy(), df[col].cat.codes.to_numpy() < 0)
+             for col in categoricals}
+    return df.reset_index(drop=True).assign(**codes)
+
+def coded_keys(left: pd.DataFrame, right: pd.DataFrame, on: list[str]) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Categorical keys join on their codes only when both sides share the categories (e.g. the
+    dimension dictionary), other categorical keys join as strings
+    """
+    labels = [key for key in on
+              if (isinstance(left[key].dtype, pd.CategoricalDtype) or isinstance(right[key].dtype, pd.CategoricalDtype))
+              and left[key].dtype != right[key].dtype]
+    if not labels:
+        return left, right
+    return left.astype({key: object for key in labels}), right.astype({key: object for key in labels})
+
+def from_codes(values: pd.Series, dtype: pd.CategoricalDtype) -> pd.Categorical:
+    """
+    Categorical of a column of codes returned by an engine (nulls or NaN are missing labels)
+    """
+    codes = values.to_numpy('float64', na_value=np.nan)
+    return pd.Categorical.from_codes(np.nan_to_num(codes, nan=-1).astype('int64'), dtype=dtype)
+
+def restore_merge_dtypes(joined: pd.DataFrame, left: pd.DataFrame, right: pd.DataFrame, on: list[str]) -> pd.DataFrame:
+    """
+    Give the columns of an engine merge the dtypes pd.merge would (missing right values make ints floats)
+    """
+    dtypes = {**{col: right[col].dtype for col in right.columns if col not in on}, **left.dtypes.to_dict()}
+    for key in on:
+        # pandas joins categorical keys as strings unless both sides share the categories
+        if left[key].dtype != right[key].dtype and any(isinstance(side[key].dtype, pd.CategoricalDtype)
+                                                       for side in (left, right)):
+            dtypes[key] = np.dtype('object')
+    for col in joined.columns:
+        dtype = dtypes[col]
+        if isinstance(dtype, pd.CategoricalDtype) and pd.api.types.is_numeric_dtype(joined[col].dtype):
+            joined[col] = from_codes(joined[col], dtype)
+            continue
+        if pd.api.types.is_integer_dtype(dtype) and joined[col].isna().any():
+            dtype = np.dtype('float64')
+        elif pd.api.types.is_bool_dtype(dtype) and joined[col].isna().any():
+            dtype = np.dtype('object')
+        if joined[col].dtype != dtype:
+            joined[col] = joined[col].astype(dtype)
+    return joined
+
+def restore_groupby_dtypes(grouped: pd.DataFrame,
+                           df: pd.DataFrame,
+                           keys: list[str],
+                           aggs: dict[str, tuple[str, str]]) -> pd.DataFrame:
+    """
+    Give an engine groupby the key dtypes, value dtypes and key order of pandas
+    """
+    dtypes = {key: df[key].dtype for key in keys}
+    for out, (col, func) in aggs.items():
+        source = df[col].dtype
+        summed_as_int = pd.api.types.is_integer_dtype(source) or pd.api.types.is_bool_dtype(source)
+        dtypes[out] = np.dtype('int64' if func == 'count' or summed_as_int else 'float64')
+    grouped = grouped[keys + list(aggs)]
+    coded = {key: from_codes(grouped[key], dtype) for key, dtype in dtypes.items()
+             if isinstance(dtype, pd.CategoricalDtype) and pd.api.types.is_numeric_dtype(grouped[key].dtype)}
+    grouped = grouped.assign(**coded).astype(dtypes)
+    return grouped.sort_values(keys, kind='stable', ignore_index=True)
@@ -0,0 +1,321 @@
+import io
+
+import pandas as pd
+from pathlib import Path
+
+from app.assets import dimensions, manifest, rollups
+from app.assets.preprocessing import (DATA_PROCESSED_DIR, DATA_RAW_DIR, DICTIONARY_TABLE, RAW_FILES, RENAME_COLUMNS, STATE_TO_REGION,
+                                      add_date_features, add_delivery_time, add_product_volume,
+                                      build_order_fact, convert_to_datetime, discretize_spending, encode_dimensions,
+                                      impute_order_delivery, load_processed_data, load_raw_data, merge_product_category,
+                                      preprocess_data, rename_columns, write_table, check_format)
+
+# Raw tables that new rows can be appended to without a full rebuild
+INCREMENTAL_TABLES = ['order', 'order_item', 'order_payment', 'order_review', 'customer', 'product', 'seller']
+# Processed tables rewritten by an incremental run
+UPDATED_TABLES = ['order', 'order_item', 'order_payment', 'order_review', 'customer', 'unpaid_customer', 'order_customer',
+                  'product', 'seller', 'order_fact', *rollups.ROLLUP_TABLES, DICTIONARY_TABLE]
+DELIVERY_DATE_COLUMNS = ['delivered_customer_date', 'delivered_carrier_date']
+
+def read_new_rows(raw_dir: Path, ingested: dict) -> tuple[dict, dict, dict]:
+    """
+    Read the raw rows not yet recorded in the manifest
+
+    Args:
+        raw_dir: Path - Directory holding the raw Olist files
+        ingested: dict - Output of manifest.read_manifest
+    Returns:
+        tuple[dict, dict, dict]
+            - Raw tables holding only the new rows (tables without new rows are left out)
+            - Per table: (raw file name, first row, end row) for manifest.record_batch
+            - Per raw file name: byte offset past the new rows, for manifest.record_batch
+    Raises:
+        ValueError: If a table outside INCREMENTAL_TABLES has new rows, or a raw file is
+            shorter than its recorded offset
+    Notes:
+        - Only the bytes past the recorded offset are read. Manifests written without offsets
+          fall back to parsing the files from the start and skipping the ingested rows
+    """
+    delta, rows, offsets = {}, {}, {}
+    for key, file in RAW_FILES.items():
+        start = manifest.ingested_rows(ingested, file)
+        offset = manifest.ingested_offset(ingested, file)
+        if offset is None:
+            df = pd.read_csv(raw_dir / file, skiprows=range(1, start + 1))
+            offsets[file] = (raw_dir / file).stat().st_size
+        else:
+            df, offsets[file] = read_rows_from(raw_dir / file, offset)
+        if df.empty:
+            continue
+        if key not in INCREMENTAL_TABLES:
+            raise ValueError(f"{file} has new rows, rebuild with save_processed_data()")
+        delta[key] = df
+        rows[key] = (file, start, start + len(df))
+    return delta, rows, offsets
+
+def read_rows_from(path: Path, offset: int) -> tuple[pd.DataFrame, int]:
+    """
+    Read the rows of a raw CSV file from a byte offset, with the header of the file
+
+    Returns:
+        tuple[pd.DataFrame, int] - The rows (empty with the header columns if none) and the
+            byte offset past them
+    Raises:
+        ValueError: If the file is shorter than offset
+    """
+    with open(path, 'rb') as f:
+        header = f.readline()
+        f.seek(0, io.SEEK_END)
+        if f.tell() < offset:
+            raise ValueError(f"{path.name} is shorter than when it was ingested, rebuild with save_processed_data()")
+        f.seek(max(offset, len(header)))
+        new = f.read()
+    return pd.read_csv(io.BytesIO(header + new)), max(offset, len(header)) + len(new)
+
+def ingest_batch(data: dict, delta: dict, raw_delivery: pd.DataFrame | None = None) -> dict:
+    """
+    Apply a batch of new raw rows to the processed tables
+
+    Only the affected rows are recomputed: customer spending for customers with new orders,
+    payments or customer rows (bins are refitted on the customer totals), delivery imputation for orders sold
+    from the seller zips of the new or changed orders (medians are taken over every order of every
+    zip these orders are sold from), and order_fact rows for the new or changed orders.
+    The partials of the replaced and new order_fact rows are merged into the stored monthly rollups
+    (see rollups.update_rollups), only the customers of these rows and those joining the customer
+    table get their customer months rebuilt. check_against_full compares the result with a full rebuild.
+
+    Args:
+        data: dict - Processed tables, as returned by load_processed_data
+        delta: dict - Raw tables holding only new rows, any of INCREMENTAL_TABLES
+        raw_delivery: pd.DataFrame | None - Raw order_id and delivery date columns of the ingested
+            orders (see read_raw_delivery). Lets the affected zips be re-imputed from the raw dates,
+            otherwise medians are taken over the stored, already imputed, dates
+    Returns:
+        data: dict - The updated processed tables
+    Notes:
+        - Labels new to the dimension dictionary are appended to it with the next codes
+        - Payments are attributed to customers through order_customer, which holds every raw
+          order, and customers without payments are kept in unpaid_customer, so orders, payments
+          and customer rows can arrive in any batch
+    """
+    delta = rename_columns(dict(delta))
+
+    if 'product' in delta:
+        products = merge_product_category({'product': delta['product'], 'product_category': data['product_category']})
+        data['product'] = pd.concat([data['product'], products['product']], ignore_index=True)
+    if 'seller' in delta:
+        data['seller'] = pd.concat([data['seller'], delta['seller']], ignore_index=True)
+
+    new_orders = pd.DataFrame(columns=data['order'].columns)
+    if 'order' in delta:
+        orders = {'order': delta['order']}
+        for step in [convert_to_datetime, add_date_features, add_delivery_time]:
+            orders = step(orders)
+        new_orders = orders['order']
+    if 'order_item' in delta:
+        items = add_product_volume({'order_item': delta['order_item'], 'product': data['product']})
+        data['order_item'] = pd.concat([data['order_item'], items['order_item']], ignore_index=True)
+    for key in ['order_payment', 'order_review']:
+        if key in delta:
+            data[key] = pd.concat([data[key], delta[key]], ignore_index=True)
+
+    affected_orders = pd.Index(pd.concat([delta[key]['order_id'] for key in ['order', 'order_item', 'order_payment', 'order_review']
+                                          if key in delta])).unique()
+
+    paid = data['customer']['customer_id']
+    data = _update_customer_spending(data, delta, new_orders)
+    # Orders of customers added to the customer table get their customer columns in order_fact
+    added = data['customer'].loc[~data['customer']['customer_id'].isin(paid), 'customer_id']
+    affected_orders = affected_orders.union(
+        data['order_customer'].loc[data['order_customer']['customer_id'].isin(added), 'order_id'])
+    data = _update_order_delivery(data, new_orders, affected_orders, raw_delivery)
+
+    # Rebuild the fact rows of the new or changed orders
+    is_affected = {key: data[key]['order_id'].isin(affected_orders) for key in ['order_item', 'order', 'order_payment', 'order_review']}
+    fact = build_order_fact({
+        **{key: data[key][mask] for key, mask in is_affected.items()},
+        'customer': data['customer'],
+        'seller': data['seller'],
+        'zip': data['zip'],
+    })['order_fact']
+    is_replaced = data['order_fact']['order_id'].isin(affected_orders)
+    removed = data['order_fact'][is_replaced]
+    data['order_fact'] = pd.concat([data['order_fact'][~is_replaced], fact], ignore_index=True)
+
+    # Customer months change for the customers of the replaced lines and those joining the customer table
+    customers = pd.Series(pd.concat([removed['customer_id'], fact['customer_id'], added]).dropna().unique())
+    lines = data['order_fact'][data['order_fact']['customer_id'].isin(customers) & data['order_fact']['order_status'].notna()]
+    pairs = rollups.customer_months(lines[['customer_id', 'purchase_month']],
+                                    data['customer'].loc[data['customer']['customer_id'].isin(customers), 'customer_id'])
+    data.update(rollups.update_rollups({key: data[key] for key in rollups.ROLLUP_TABLES}, removed, fact, pairs, customers))
+    # New labels get the next codes, the codes of the stored tables stay valid
+    return encode_dimensions(data, data.get(DICTIONARY_TABLE))
+
+def read_raw_delivery(raw_dir: Path) -> pd.DataFrame:
+    """
+    Read the raw delivery dates of every order, before imputation
+
+    Args:
+        raw_dir: Path - Directory holding the raw Olist files
+    Returns:
+        pd.DataFrame - Columns: order_id, delivered_customer_date, delivered_carrier_date
+    """
+    raw_columns = {raw: col for raw, col in RENAME_COLUMNS['order'].items() if col in DELIVERY_DATE_COLUMNS}
+    df = pd.read_csv(raw_dir / RAW_FILES['order'], usecols=['order_id', *raw_columns],
+                     parse_dates=list(raw_columns))
+    return df.rename(columns=raw_columns)
+
+def update_processed_data(raw_dir: Path = DATA_RAW_DIR,
+                          fmt: str | None = None,
+                          processed_dir: Path = DATA_PROCESSED_DIR) -> dict | None:
+    """
+    Ingest the raw rows appended since the last run and rewrite the changed processed tables
+
+    Args:
+        raw_dir: Path - Directory holding the raw Olist files
+        fmt: str | None - Storage format, defaults to the one recorded in the manifest
+        processed_dir: Path - Directory holding the processed tables and manifest
+    Returns:
+        dict | None - The updated processed tables, None if there were no new rows
+    Raises:
+        ValueError: If processed_dir has no manifest (run save_processed_data() first)
+    """
+    ingested = manifest.read_manifest(processed_dir)
+    if not ingested['files']:
+        raise ValueError(f"No {manifest.MANIFEST_FILE} in {processed_dir}, run save_processed_data() first")
+    fmt = fmt or ingested['format']
+    check_format(fmt)
+
+    delta, rows, offsets = read_new_rows(raw_dir, ingested)
+    if not delta:
+        print("No new rows to ingest")
+        return None
+    for key, (file, start, end) in rows.items():
+        print(f"Ingesting rows {start}-{end} of {file}...")
+
+    data = ingest_batch(load_processed_data(fmt, processed_dir=processed_dir), delta, read_raw_delivery(raw_dir))
+
+    for key in UPDATED_TABLES:
+        print(f"Saving {key}...")
+        write_table(data[key], processed_dir / f'{key}.{fmt}', fmt)
+    manifest.write_manifest(manifest.record_batch(ingested, rows, 'incremental', fmt, offsets), processed_dir)
+    print("Done")
+    return data
+
+def check_against_full(raw_dir: Path = DATA_RAW_DIR,
+                       fmt: str | None = None,
+                       processed_dir: Path = DATA_PROCESSED_DIR) -> dict[str, str]:
+    """
+    Compare the processed tables with a full rebuild of the raw files, run in memory
+
+    Args:
+        raw_dir: Path - Directory holding the raw Olist files
+        fmt: str | None - Storage format, defaults to the one recorded in the manifest
+        processed_dir: Path - Directory holding the processed tables and manifest
+    Returns:
+        dict[str, str] - Per table of UPDATED_TABLES that differs, the first difference. Empty if
+            every table holds the same rows as the rebuild, in any order
+    Notes:
+        - The dimension dictionary is left out, incremental runs give new labels later codes
+    """
+    fmt = fmt or manifest.read_manifest(processed_dir)['format']
+    check_format(fmt)
+    stored = load_processed_data(fmt, processed_dir=processed_dir)
+    full = preprocess_data(load_raw_data(raw_dir))
+    return compare_tables(stored, full, [key for key in UPDATED_TABLES if key != DICTIONARY_TABLE])
+
+def compare_tables(got: dict, expected: dict, keys: list[str], check_dtype: bool = False) -> dict[str, str]:
+    """
+    Compare tables holding the same rows in any order
+
+    Args:
+        got: dict - Tables to check
+        expected: dict - Reference tables, with at least the columns of got
+        keys: list[str] - Tables compared
+        check_dtype: bool - Also require the same dtype per column. Leave off when comparing
+            tables read back from a file with tables built in memory
+    Returns:
+        dict[str, str] - Per table that differs, the first difference. Empty if every table matches
+    """
+    differences = {}
+    for key in keys:
+        try:
+            if check_dtype:
+                dtypes = {col: (str(dtype), str(expected[key][col].dtype)) for col, dtype in got[key].dtypes.items()}
+                mismatched = {col: pair for col, pair in dtypes.items() if pair[0] != pair[1]}
+                if mismatched:
+                    raise AssertionError(f"dtypes differ (got, expected): {mismatched}")
+            pd.testing.assert_frame_equal(_canonical(got[key]), _canonical(expected[key][got[key].columns]),
+                                          check_dtype=False)
+        except (AssertionError, KeyError) as error:
+            differences[key] = str(error)
+    return differences
+
+def _canonical(df: pd.DataFrame) -> pd.DataFrame:
+    # Labels instead of codes and one missing value, rows sorted by every column
+    df = df.astype({col: object for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)})
+    labels = df.columns[df.dtypes == object]
+    df[labels] = df[labels].where(df[labels].notna(), None)
+    return df.sort_values(list(df.columns), ignore_index=True)
+
+def _update_customer_spending(data: dict, delta: dict, new_orders: pd.DataFrame) -> dict:
+    new_customers = delta.get('customer', pd.DataFrame(columns=['customer_id', 'state']))
+    new_customers = new_customers.assign(region=dimensions.map_labels(new_customers['state'], STATE_TO_REGION))
+    data['order_customer'] = pd.concat([data['order_customer'], new_orders[['order_id', 'customer_id']]], ignore_index=True)
+    if 'order_payment' not in delta and new_orders.empty and new_customers.empty:
+        return data
+
+    # Customers whose spending can change, totals are taken over all their stored payments
+    order_customer = data['order_customer'].set_index('order_id')['customer_id']
+    payments = delta.get('order_payment', pd.DataFrame(columns=['order_id']))
+    affected = pd.concat([new_customers['customer_id'], new_orders['customer_id'],
+                          payments['order_id'].map(order_customer)]).dropna().unique()
+    paid = (data['order_customer'][data['order_customer']['customer_id'].isin(affected)]
+            .merge(data['order_payment'][['order_id', 'payment_value']], on='order_id'))
+    totals = paid.groupby('customer_id')['payment_value'].sum()
+
+    customers = pd.concat([data['customer'].drop(columns=['customer_spending']), data['unpaid_customer'], new_customers],
+                          ignore_index=True)
+    is_affected = customers['customer_id'].isin(affected)
+    customers.loc[is_affected, 'payment_value'] = customers.loc[is_affected, 'customer_id'].map(totals)
+    # Customers without any payment are left out, as in add_customer_spending
+    has_payment = customers['payment_value'].notna()
+    data['unpaid_customer'] = customers[~has_payment].drop(columns=['payment_value']).reset_index(drop=True)
+    customers = customers[has_payment]
+
+    spending = discretize_spending(customers.set_index('customer_id')[['payment_value']])
+    customers['customer_spending'] = spending['customer_spending'].to_numpy()
+    data['customer'] = customers.reset_index(drop=True)
+    return data
+
+def _update_order_delivery(data: dict, new_orders: pd.DataFrame, affected_orders: pd.Index,
+                           raw_delivery: pd.DataFrame | None) -> dict:
+    seller_zip = data['seller'].set_index('seller_id')['zip_code_prefix']
+    item_zips = data['order_item']['seller_id'].map(seller_zip)
+
+    # Every order sold from a zip touched by the new or changed orders is re-imputed
+    affected_zips = item_zips[data['order_item']['order_id'].isin(affected_orders)].unique()
+    reimputed = data['order_item'].loc[item_zips.isin(affected_zips), 'order_id'].unique()
+    # Their items in other zips take the medians of those zips, so every order of these zips
+    # is imputed along for exact medians. Only the re-imputed orders are kept
+    touched_zips = item_zips[data['order_item']['order_id'].isin(reimputed)].unique()
+    context = data['order_item'].loc[item_zips.isin(touched_zips), 'order_id'].unique()
+
+    old_orders = data['order'][data['order']['order_id'].isin(context)].drop_duplicates('order_id')
+    if raw_delivery is not None:
+        # Undo the previous imputation so medians match a full rebuild
+        raw_dates = raw_delivery.set_index('order_id')
+        for col in DELIVERY_DATE_COLUMNS:
+            old_orders[col] = old_orders['order_id'].map(raw_dates[col])
+    orders = pd.concat([old_orders, new_orders[data['order'].columns]], ignore_index=True)
+    imputed = impute_order_delivery({
+        'order': orders,
+        'order_item': data['order_item'][data['order_item']['order_id'].isin(orders['order_id'])],
+        'seller': data['seller'],
+    })['order']
+    replaced = pd.Index(reimputed).union(new_orders['order_id'])
+    imputed = imputed[imputed['order_id'].isin(replaced)]
+
+    data['order'] = pd.concat([data['order'][~data['order']['order_id'].isin(replaced)], imputed],
+                              ignore_index=True)
+    return data
@@ -0,0 +1,66 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable
+
+import pandas as pd
+
+def load_tables(readers: dict[str, Callable[[], pd.DataFrame]],
+                max_workers: int | None = None,
+                use_processes: bool = False) -> tuple[dict, dict]:
+    """
+    Read several tables concurrently
+
+    Args:
+        readers: dict[str, Callable[[], pd.DataFrame]] - One zero-argument reader per table,
+            e.g. functools.partial(pd.read_csv, path, usecols=..., dtype=...)
+        max_workers: int | None - Pool size, defaults to one worker per table up to the CPU count
+        use_processes: bool - Use a process pool instead of a thread pool. Readers must then be
+            picklable, and every table is pickled back to the caller
+    Returns:
+        tuple[dict, dict]
+            - data: dict - The tables, in the order of readers
+            - report: dict - Keys:
+                - seconds: float - Wall time of the whole load
+                - tables: dict - Per table: seconds, rows, columns and bytes (deep memory usage)
+    """
+    if max_workers is None:
+        max_workers = max(1, min(len(readers), os.cpu_count() or 1))
+    pool = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+
+    start = time.perf_counter()
+    with pool(max_workers=max_workers) as executor:
+        futures = {key: executor.submit(_timed_read, reader) for key, reader in readers.items()}
+        results = {key: future.result() for key, future in futures.items()}
+
+    data = {key: df for key, (df, _) in results.items()}
+    report = {
+        'seconds': time.perf_counter() - start,
+        'tables': {
+            key: {
+                'seconds': seconds,
+                'rows': len(df),
+                'columns': df.shape[1],
+                'bytes': int(df.memory_usage(deep=True).sum()),
+            }
+            for key, (df, seconds) in results.items()
+        },
+    }
+    return data, report
+
+def format_report(report: dict) -> str:
+    """
+    Summary table of a load_tables report
+    """
+    lines = [f"{'table':<18}{'rows':>10}{'cols':>6}{'MB':>10}{'seconds':>10}"]
+    for key, stats in report['tables'].items():
+        lines.append(f"{key:<18}{stats['rows']:>10,}{stats['columns']:>6}"
+                     f"{stats['bytes'] / 1024 ** 2:>10.1f}{stats['seconds']:>10.3f}")
+    total_bytes = sum(stats['bytes'] for stats in report['tables'].values())
+    lines.append(f"{'total':<18}{'':>16}{total_bytes / 1024 ** 2:>10.1f}{report['seconds']:>10.3f}")
+    return '\n'.join(lines)
+
+def _timed_read(reader: Callable[[], pd.DataFrame]) -> tuple[pd.DataFrame, float]:
+    start = time.perf_counter()
+    df = reader()
+    return df, time.perf_counter() - start
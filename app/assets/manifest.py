@@ -0,0 +1,94 @@
+import datetime as dt
+import json
+import os
+from pathlib import Path
+
+# Written next to the processed tables
+MANIFEST_FILE = 'manifest.json'
+
+def read_manifest(processed_dir: Path) -> dict:
+    """
+    Read the manifest of raw rows already ingested into processed_dir
+
+    Args:
+        processed_dir: Path
+    Returns:
+        dict - Keys:
+            - format: str | None - Storage format of the processed tables
+            - files: dict - Per raw file name: table, ingested row ranges [[start, end], ...] and
+              offset, the byte offset past the last ingested row (see ingested_offset)
+            - batches: list[dict] - One entry per full or incremental run
+    """
+    path = processed_dir / MANIFEST_FILE
+    if not path.exists():
+        return {'format': None, 'files': {}, 'batches': []}
+    with open(path) as f:
+        return json.load(f)
+
+def write_manifest(manifest: dict, processed_dir: Path) -> None:
+    """
+    Write the manifest, replacing the previous one at once
+
+    Runs write it after every table, so a new manifest marks a complete new version of the
+    processed tables (see dataset.data_version)
+    """
+    path = processed_dir / MANIFEST_FILE
+    tmp = path.with_name(path.name + '.partial')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+def ingested_rows(manifest: dict, file: str) -> int:
+    """
+    Number of leading data rows of a raw file already ingested
+    """
+    ranges = manifest['files'].get(file, {}).get('ranges', [])
+    return max((end for _, end in ranges), default=0)
+
+def ingested_offset(manifest: dict, file: str) -> int | None:
+    """
+    Byte offset of a raw file past its ingested rows, None for manifests written without offsets
+    """
+    return manifest['files'].get(file, {}).get('offset')
+
+def file_offsets(raw_dir: Path, files: list[str]) -> dict[str, int]:
+    """
+    Size of each raw file, taken by full runs before reading them
+
+    Raw files are only appended to between runs, so the size is the offset past the rows read.
+    """
+    return {file: (raw_dir / file).stat().st_size for file in files}
+
+def record_batch(manifest: dict,
+                 rows: dict[str, tuple[str, int, int]],
+                 mode: str,
+                 fmt: str,
+                 offsets: dict[str, int] | None = None) -> dict:
+    """
+    Record a batch of ingested raw rows
+
+    Args:
+        manifest: dict - Output of read_manifest
+        rows: dict[str, tuple[str, int, int]] - Per table: (raw file name, first row, end row)
+        mode: str - 'full' or 'incremental'. A full run replaces the previous ranges
+        fmt: str - Storage format the processed tables were written in
+        offsets: dict[str, int] | None - Per raw file name, the byte offset past the end row
+    Returns:
+        dict - The updated manifest
+    """
+    if mode == 'full':
+        manifest['files'] = {}
+    offsets = offsets or {}
+    for table, (file, start, end) in rows.items():
+        entry = manifest['files'].setdefault(file, {'table': table, 'ranges': []})
+        if end > start:
+            entry['ranges'].append([start, end])
+        if file in offsets:
+            entry['offset'] = offsets[file]
+    manifest['format'] = fmt
+    manifest['batches'].append({
+        'mode': mode,
+        'ingested_at': dt.datetime.now().isoformat(timespec='seconds'),
+        'rows': {table: [start, end] for table, (_, start, end) in rows.items()},
+    })
+    return manifest
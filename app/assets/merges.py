@@ -1,53 +1,41 @@
 import pandas as pd
+from app.assets import cube, engines, rollups
+from app.assets.cache import memoize
 
+@memoize
 def get_sales_by_region_category(data: dict[str, pd.DataFrame]) -> pd.DataFrame:
     """
-    Merge the customer, orders, geo, order item, to get sales by region
+    Get sales by region and product category from the order fact table
     Args:
         data: dict[str, pd.DataFrame]
             Data:
-                - customer: pd.DataFrame
-                - order: pd.DataFrame
-                - geo: pd.DataFrame
-                - order_item: pd.DataFrame
+                - order_fact: pd.DataFrame
     Returns:
         pd.DataFrame - Columns: category_name, region, sales, order_count
-    
-    Notes:
-        - The merging could be done during preprocessing to avoid redundant merging
     """
-    
-    df_customer = data['customer']
-    df_orders = data['order']
-    df_geo = data['geo']
-    df_order_item = data['order_item']
-
-
-    # Get unique zips with city, state, lat, lng, and region
-    geo_cols = ['zip_code_prefix','region', 'city', 'state', 'latitude', 'longitude']
-    unique_zips = (df_geo[geo_cols]
-                    .groupby('zip_code_prefix')
-                    .first())
-
-    # Merge order and customer data to get zips
-    customer_order = df_orders.merge(df_customer[['customer_id','zip_code_prefix']], on='customer_id', how='inner')
-
-    # Merge zips and geo location with customer order data
-    customer_order_geo = unique_zips.merge(customer_order, on='zip_code_prefix', how='inner')
-    
-    customer_order_geo_product = customer_order_geo.merge(df_order_item, on='order_id', how='inner')
+    df_fact = data['order_fact']
 
     # Calculate sales by region and product category
-    sales_by_region = (customer_order_geo_product
-            .groupby(["category_name", "region"])
-            .agg({"price": "sum", "order_id": "count"})
-            .reset_index()
-            .rename(columns={"price": "sales", "order_id": "order_count"})
-            )
-    
+    sales_by_region = engines.get_engine().groupby_agg(df_fact, ["category_name", "region"],
+                                                       {"sales": ("price", "sum"), "order_count": ("order_id", "count")})
+
     return sales_by_region
 
-def get_average_sales_ARPU(sales_by_region: pd.DataFrame, 
+@memoize
+def get_sales_cube(data: dict[str, pd.DataFrame]) -> cube.SalesCube:
+    """
+    Order line counts and sales by category, region and purchase month, built once per order_fact version
+    Args:
+        data: dict[str, pd.DataFrame]
+            Data:
+                - order_fact: pd.DataFrame
+    Returns:
+        cube.SalesCube
+    """
+    return cube.build_sales_cube(data['order_fact'])
+
+@memoize
+def get_average_sales_ARPU(sales_by_region: pd.DataFrame,
                                                     data: dict[str, pd.DataFrame],
                                                     sales: bool = True,
                                                     ARPU: bool = False,
@@ -58,21 +46,15 @@ def get_average_sales_ARPU(sales_by_region: pd.DataFrame,
         sales_by_region: pd.DataFrame
         data: dict[str, pd.DataFrame]
             Data:
-                - order: pd.DataFrame
-                - order_item: pd.DataFrame
-                - product: pd.DataFrame
+                - order_fact: pd.DataFrame
         sales: bool -> True if above average sales, False if below average sales
         ARPU: bool -> True if below average ARPU, False if above average ARPU
     Returns:
-        pd.DataFrame - Columns: arpu, region, sales, product_category, order_purchase_month
-    
-    Notes:
-        - The merging may be redundant and could be done in calculating sales_by_region
+        pd.DataFrame - Columns: ARPU, region, sales, category_name, purchase_month, order_count
+            One row per selected (category, region) and purchase month, order_count being the
+            order lines of the category in that month (all regions)
     """
-    
-    df_order = data['order']
-    df_order_item = data['order_item']
-    df_product = data['product']
+
     # Means
     avg_ARPU = sales_by_region["ARPU"].mean()
     avg_sales = sales_by_region['sales'].mean()
@@ -91,56 +73,94 @@ def get_average_sales_ARPU(sales_by_region: pd.DataFrame,
     # Top 10
     above_avg = sales_by_region.loc[mask].sort_values(by=['sales']).head(top_n)
 
-    # Merge order, order_item, product, and above average to grab top sales
-    merge = (df_order
-            .merge(df_order_item)
-            .merge(df_product)
-            .merge(above_avg, left_on="category_name", right_on="category_name")
-            [['ARPU','region','sales', "category_name", "purchase_month"]])
-
-    merge['purchase_month'] = pd.to_datetime(merge['purchase_month'])
+    # Monthly order lines of the top categories, a slice of the sales cube
+    monthly_lines = (get_sales_cube(data)
+                     .to_frame(list(above_avg['category_name'].unique()), by_region=False)
+                     [['category_name', 'purchase_month', 'order_count']])
+    merge = (engines.get_engine()
+            .merge(above_avg[['ARPU', 'region', 'sales', 'category_name']], monthly_lines, on="category_name")
+            .reset_index(drop=True))
     return merge
 
-def get_highest_selling_cities(data: dict[str, pd.DataFrame]) -> pd.DataFrame:
+@memoize
+def get_highest_selling_cities(data: dict[str, pd.DataFrame],
+                               year: int | list[int] | None = None,
+                               start: str | pd.Timestamp | None = None,
+                               end: str | pd.Timestamp | None = None) -> pd.DataFrame:
     """
-    Get the highest selling cities
+    Get the highest selling cities, optionally for a purchase year or month range
     Args:
         data: dict[str, pd.DataFrame]
             Data:
-                - order: pd.DataFrame
-                - customer: pd.DataFrame
+                - monthly_city: pd.DataFrame
+        year: int | list[int] | None - Purchase year(s)
+        start: str | pd.Timestamp | None - First purchase month, inclusive
+        end: str | pd.Timestamp | None - Last purchase month, inclusive
     Returns:
-        str - The highest selling cities
+        pd.DataFrame - Order line count (order_id column) per city, descending
     """
-    df_order = data['order']
-    df_customer = data['customer']
+    df_city = data['monthly_city']
+    df_city = df_city[rollups.month_mask(df_city['purchase_month'], year, start, end)]
 
-    order_cols = ['order_id', 'customer_id']
-    customer_cols = ['customer_id', 'city']
-
-    highest_selling_cities = (df_customer[customer_cols]
-                    .merge(df_order[order_cols], on='customer_id', how='inner')
-                    .groupby('city').agg({'order_id': 'count'})
+    highest_selling_cities = (engines.get_engine()
+                    .groupby_agg(df_city, ['city'], {'order_id': ('order_count', 'sum')})
+                    .set_index('city')
                     .sort_values(by='order_id', ascending=False))
-    
+
     return highest_selling_cities
 
-def get_highest_selling_categories(data: dict[str, pd.DataFrame]) -> pd.DataFrame:
+@memoize
+def get_highest_selling_categories(data: dict[str, pd.DataFrame],
+                                   year: int | list[int] | None = None,
+                                   start: str | pd.Timestamp | None = None,
+                                   end: str | pd.Timestamp | None = None) -> pd.DataFrame:
     """
-    Get the highest selling categories
+    Get the highest selling categories, optionally for a purchase year or month range
     Args:
         data: dict[str, pd.DataFrame]
             Data:
-                - order_item: pd.DataFrame - product: pd.DataFrame
+                - monthly_category: pd.DataFrame
+        year, start, end: see get_highest_selling_cities
     Returns:
-        str - The highest selling categories
+        pd.DataFrame - Sales (price column) per category, descending
     """
-    df_order_item = data['order_item']
-    df_product = data['product']
+    df_category = data['monthly_category']
+    df_category = df_category[rollups.month_mask(df_category['purchase_month'], year, start, end)]
 
-    highest_selling_categories = (df_order_item
-        .merge(df_product['product_id'], on='product_id', how='inner')
-        .groupby('category_name')
-        .agg({'price': 'sum'})
+    highest_selling_categories = (engines.get_engine()
+        .groupby_agg(df_category, ['category_name'], {'price': ('sales', 'sum')})
+        .set_index('category_name')
         .sort_values(by='price', ascending=False))
-    return highest_selling_categories
\ No newline at end of file
+    return highest_selling_categories
+
+@memoize
+def get_top_sellers(data: dict[str, pd.DataFrame],
+                    dimension: str,
+                    year: int | None = None,
+                    region: str | None = None,
+                    k: int = 1) -> pd.DataFrame:
+    """
+    Highest selling cities (order lines) or categories (sales) from the precomputed leaderboard
+    Args:
+        data: dict[str, pd.DataFrame]
+            Data:
+                - leaderboard: pd.DataFrame
+        dimension: str - 'city' or 'category_name'
+        year: int | None - Purchase year, all years if None
+        region: str | None - Customer region, all regions if None
+        k: int - Entries, at most rollups.LEADERBOARD_K
+    Returns:
+        pd.DataFrame - Value (value column) per city or category, descending
+    Raises:
+        ValueError: If the dimension is unknown or k is over rollups.LEADERBOARD_K
+    """
+    if dimension not in rollups.LEADERBOARD_DIMENSIONS:
+        raise ValueError(f"Dimension {dimension} not in {tuple(rollups.LEADERBOARD_DIMENSIONS)}")
+    if k > rollups.LEADERBOARD_K:
+        raise ValueError(f"k={k} is over the {rollups.LEADERBOARD_K} entries kept by the leaderboard")
+    board = data['leaderboard']
+    mask = ((board['dimension'] == dimension)
+            & (board['year'].isna() if year is None else board['year'] == year)
+            & (board['region'].isna() if region is None else board['region'] == region)
+            & (board['rank'] <= k))
+    return board.loc[mask, ['label', 'value']].set_index('label').rename_axis(dimension)
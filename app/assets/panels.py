@@ -0,0 +1,76 @@
+import functools
+import time
+from typing import Callable
+
+import pandas as pd
+import streamlit as st
+
+# Session state keys of the panel results and render timings
+RESULTS_STATE = 'panel_results'
+TIMINGS_STATE = 'panel_timings'
+# Refresh interval of the timings sidebar, which panel reruns do not redraw
+TIMINGS_REFRESH_SECONDS = 2
+
+def panel(name: str, inputs: tuple[str, ...] = ()) -> Callable:
+    """
+    Decorator making a section of a page an independently rerunnable panel
+
+    The panel runs as a Streamlit fragment: a widget created inside it reruns the panel alone,
+    with the arguments of its last call. Widgets outside any panel (e.g. in the sidebar) rerun
+    the page, where panels whose inputs did not change reuse their results (see cached).
+    Each run is timed into the session state (see timings).
+
+    Args:
+        name: str - Name of the panel in the timings
+        inputs: tuple[str, ...] - Keyword arguments the panel takes, the page inputs it depends on
+    Returns:
+        Callable - Decorator of a function taking the inputs as keyword arguments
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def timed(**kwargs) -> None:
+            if set(kwargs) != set(inputs):
+                raise ValueError(f"Panel {name} takes inputs {sorted(inputs)}, got {sorted(kwargs)}")
+            start = time.perf_counter()
+            func(**kwargs)
+            timing = st.session_state.setdefault(TIMINGS_STATE, {}).setdefault(name, {'runs': 0})
+            timing.update(runs=timing['runs'] + 1, seconds=time.perf_counter() - start,
+                          inputs=dict(kwargs))
+        return st.fragment(timed)
+    return decorator
+
+def cached(name: str, key: tuple, func: Callable):
+    """
+    Result of func, reused by the reruns of the session while key is unchanged
+
+    Args:
+        name: str - Result name, one entry is kept per name
+        key: tuple - The inputs and data_versions() the result depends on
+        func: Callable - Computes the result, e.g. a chart spec
+    Returns:
+        The result of func()
+    """
+    results = st.session_state.setdefault(RESULTS_STATE, {})
+    if name not in results or results[name][0] != key:
+        results[name] = (key, func())
+    return results[name][1]
+
+def timings() -> pd.DataFrame:
+    """
+    Render timings of the panels of the session
+
+    Returns:
+        pd.DataFrame - Per panel: runs, seconds (last run), inputs (of the last run)
+    """
+    rows = [{'panel': name, 'runs': timing['runs'], 'seconds': round(timing['seconds'], 3),
+             'inputs': ', '.join(f'{key}={value}' for key, value in timing['inputs'].items())}
+            for name, timing in st.session_state.get(TIMINGS_STATE, {}).items()]
+    return pd.DataFrame(rows, columns=['panel', 'runs', 'seconds', 'inputs']).set_index('panel')
+
+@st.fragment(run_every=TIMINGS_REFRESH_SECONDS)
+def timings_panel() -> None:
+    """
+    Debug table of the panel timings, call it inside `with st.sidebar`
+    """
+    st.markdown("### Panels")
+    st.dataframe(timings())
@@ -1,16 +1,144 @@
 import pandas as pd
-from scipy.stats import lognorm
+import pyarrow as pa
 import numpy as np
-import datetime as dt
+import argparse
+import mmap
+import os
+import sys
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from typing import BinaryIO
 from pathlib import Path
-from sklearn.preprocessing import KBinsDiscretizer
-from streamlit import cache_data
 
 # Get the project root directory
 # preprocessing.py -> assets/ -> app/ -> project_root/
 PROJECT_ROOT = Path(__file__).parent.parent.parent
 DATA_RAW_DIR = PROJECT_ROOT / 'data' / 'raw'
 DATA_PROCESSED_DIR = PROJECT_ROOT / 'data' / 'processed'
+# Allow running this file as a script
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from app.assets import cache, dimensions, engines, loader, manifest, profiling, rollups, routes, scheduler, sketches
+
+# Storage backends for data/processed
+PROCESSED_FORMATS = ('csv', 'parquet', 'feather')
+DEFAULT_FORMAT = 'csv'
+PROCESSED_TABLES = ['geo', 'order', 'order_item', 'order_payment', 'order_review',
+                    'product', 'seller', 'customer', 'unpaid_customer', 'order_customer', 'product_category', 'zip',
+                    'order_fact', *rollups.ROLLUP_TABLES, 'dimension_dictionary']
+# Integer codes of the dimension columns, see dimensions.build_dimension_dictionary
+DICTIONARY_TABLE = 'dimension_dictionary'
+# Columns parsed as dates when reading CSV (Parquet and Feather keep their types)
+DATE_COLUMNS = {
+    'order': ['purchase_timestamp', 'approved_timestamp', 'delivered_carrier_date',
+              'delivered_customer_date', 'purchase_month'],
+    **{key: ['purchase_month'] for key in ['order_fact', *rollups.ROLLUP_TABLES]},
+}
+# Feather files are left uncompressed so readers can map them instead of decompressing a copy
+FEATHER_COMPRESSION = 'uncompressed'
+# Low-cardinality columns stored dictionary encoded in the columnar formats
+CATEGORICAL_COLUMNS = ['state', 'region', 'city', 'category_name', 'order_status', 'payment_type', 'seller_state']
+
+STATE_TO_REGION = {
+    'SP': 'Southeast',
+    'MG': 'Southeast',
+    'RJ': 'Southeast',
+    'ES': 'Southeast',
+    'PR': 'South',
+    'SC': 'South',
+    'RS': 'South',
+    'DF': 'Central-West',
+    'GO': 'Central-West',
+    'MS': 'Central-West',
+    'MT': 'Central-West',
+    'BA': 'Northeast',
+    'SE': 'Northeast',
+    'AL': 'Northeast',
+    'PE': 'Northeast',
+    'PB': 'Northeast',
+    'RN': 'Northeast',
+    'CE': 'Northeast',
+    'PI': 'Northeast',
+    'MA': 'Northeast',
+    'PA': 'North',
+    'AM': 'North',
+    'AP': 'North',
+    'RO': 'North',
+    'AC': 'North',
+    'RR': 'North',
+    'TO': 'North'
+}
+
+RAW_FILES = {
+    'geo': 'olist_geolocation_dataset.csv',
+    'order': 'olist_orders_dataset.csv',
+    'order_item': 'olist_order_items_dataset.csv',
+    'order_payment': 'olist_order_payments_dataset.csv',
+    'order_review': 'olist_order_reviews_dataset.csv',
+    'product': 'olist_products_dataset.csv',
+    'seller': 'olist_sellers_dataset.csv',
+    'customer': 'olist_customers_dataset.csv',
+    'product_category': 'product_category_name_translation.csv',
+}
+
+RENAME_COLUMNS = {
+    'geo': {"geolocation_zip_code_prefix": "zip_code_prefix",
+            "geolocation_city": "city",
+            "geolocation_state": "state",
+            'geolocation_lat': 'latitude',
+            'geolocation_lng': 'longitude'},
+    'customer': {'customer_id': "customer_id",
+                 "customer_unique_id": "unique_id",
+                 "customer_zip_code_prefix": "zip_code_prefix",
+                 "customer_city": "city",
+                 "customer_state": "state"},
+    'product': {" product_category_name": "category_name",
+                "product_photos_qty": "photos_qty",
+                "product_name_lenght": "name_length",
+                "product_description_lenght": "description_length",
+                "product_weight_g": "weight",
+                "product_length_cm": "length",
+                "product_height_cm": "height",
+                "product_width_cm": "width"},
+    'order': {"order_id": "order_id",
+              "order_purchase_timestamp": "purchase_timestamp",
+              "order_approved_at": "approved_timestamp",
+              "order_delivered_customer_date": "delivered_customer_date",
+              "order_delivered_carrier_date": "delivered_carrier_date",
+              "order_estimated_delivery_date": "estimated_delivery_date"},
+    'seller': {"seller_zip_code_prefix": "zip_code_prefix",
+               "seller_city": "city",
+               "seller_state": "state"},
+}
+
+# Raw dtypes of the low-memory mode (save_processed_data(low_memory=True)): low-cardinality strings
+# are read as categoricals and small integers downcast. Prices, coordinates and product sizes stay
+# float64 so the processed values are those of the default mode
+LOW_MEMORY_DTYPES = {
+    'geo': {'geolocation_zip_code_prefix': 'int32', 'geolocation_city': 'category', 'geolocation_state': 'category'},
+    'order': {'order_status': 'category'},
+    'order_item': {'order_item_id': 'int16'},
+    'order_payment': {'payment_sequential': 'int16', 'payment_type': 'category', 'payment_installments': 'int16'},
+    'order_review': {'review_score': 'int8'},
+    'product': {'product_category_name': 'category'},
+    'seller': {'seller_zip_code_prefix': 'int32', 'seller_city': 'category', 'seller_state': 'category'},
+    'customer': {'customer_zip_code_prefix': 'int32', 'customer_city': 'category', 'customer_state': 'category'},
+    'product_category': {'product_category_name': 'category', 'product_category_name_english': 'category'},
+}
+
+# Customer spending bins and the np.percentile method of their edges
+SPENDING_BINS = 3
+SPENDING_QUANTILE_METHOD = 'averaged_inverted_cdf'
+
+# Columns of each table joined into order_fact
+FACT_ITEM_COLUMNS = ['order_id', 'order_item_id', 'product_id', 'seller_id', 'price', 'freight_value', 'category_name']
+FACT_ORDER_COLUMNS = ['order_id', 'customer_id', 'order_status', 'purchase_month', 'delivery_time']
+FACT_CUSTOMER_COLUMNS = ['customer_id', 'zip_code_prefix', 'city', 'state']
+FACT_SELLER_COLUMNS = {'seller_id': 'seller_id', 'zip_code_prefix': 'seller_zip_code_prefix', 'state': 'seller_state'}
+
+# Seller location levels used by impute_order_delivery, from most to least specific
+IMPUTE_LEVELS = ('zip_code_prefix', 'city', 'state', 'region')
 
 def map_states_to_regions(data: dict) -> dict:
     """
@@ -21,7 +149,7 @@ def map_states_to_regions(data: dict) -> dict:
             Columns: geolocation_state (data['geo']) or customer_state (data['customer'])
     Returns:
         data: dict (data['customer'] or data['geo'])
-            Columns: region (data['customer'] or data['geo'])
+            Columns: region (data['customer'] or data['geo']), categorical
             Data:
                 - Southeast: SP, MG, RJ, ES
                 - South: PR, SC, RS
@@ -30,85 +158,35 @@ def map_states_to_regions(data: dict) -> dict:
                 - North: PA, AM, AP, RO, RR, TO
     Raises:
         ValueError: If the state column is not found in the data['geo'] or data['customer'] dataframe
-    """    
-    STATE_TO_REGION = {
-                'SP': 'Southeast',
-                'MG': 'Southeast',
-                'RJ': 'Southeast',
-                'ES': 'Southeast',
-                'PR': 'South',
-                'SC': 'South',
-                'RS': 'South',
-                'DF': 'Central-West',
-                'GO': 'Central-West',
-                'MS': 'Central-West',
-                'MT': 'Central-West',
-                'BA': 'Northeast',
-                'SE': 'Northeast',
-                'AL': 'Northeast',
-                'PE': 'Northeast',
-                'PB': 'Northeast',
-                'RN': 'Northeast',
-                'CE': 'Northeast',
-                'PI': 'Northeast',
-                'MA': 'Northeast',
-                'PA': 'North',
-                'AM': 'North',
-                'AP': 'North',
-                'RO': 'North',
-                'AC': 'North',
-                'RR': 'North',
-                'TO': 'North'
-    }
-
-    data['geo']['region'] = data['geo']['state'].map(STATE_TO_REGION)
-    data['customer']['region'] = data['customer']['state'].map(STATE_TO_REGION)
+    """
+    data['geo']['region'] = dimensions.map_labels(data['geo']['state'], STATE_TO_REGION)
+    data['customer']['region'] = dimensions.map_labels(data['customer']['state'], STATE_TO_REGION)
 
     return data
 
-@cache_data
-def load_processed_data_streamlit() -> dict:
-    return load_processed_data()
+def load_processed_data_streamlit(fmt: str | None = None, columns: dict[str, list[str]] | None = None) -> Mapping:
+    """
+    The processed tables shared by every session of the Streamlit server, see dataset.get_dataset
+    """
+    from app.assets.dataset import get_dataset
+    dataset = get_dataset(fmt)
+    return dataset if columns is None else dataset.view(columns)
 
 def rename_columns(data: dict) -> dict:
     """
     Rename the columns
 
     Args:
-        data: dict 
+        data: dict - Tables without an entry in RENAME_COLUMNS, or missing from data, are left as is
     Returns:
         data: dict
             Data:
                 - renamed columns
     """
-    data['geo'] = data['geo'].rename(columns={
-                            "geolocation_zip_code_prefix": "zip_code_prefix", 
-                            "geolocation_city": "city", 
-                            "geolocation_state": "state",
-                            'geolocation_lat': 'latitude',
-                            'geolocation_lng': 'longitude'})
-    data['customer'] = data['customer'].rename(columns={'customer_id': "customer_id", 
-                                            "customer_unique_id": "unique_id", 
-                                            "customer_zip_code_prefix": "zip_code_prefix",
-                                            "customer_city": "city", 
-                                            "customer_state": "state"})
-    data['product'] = data['product'].rename(columns={" product_category_name": "category_name",
-                                             "product_photos_qty": "photos_qty",
-                                             "product_name_lenght": "name_length",
-                                             "product_description_lenght": "description_length",
-                                             "product_weight_g": "weight",
-                                             "product_length_cm": "length",
-                                             "product_height_cm": "height",
-                                             "product_width_cm": "width"})
-    data['order'] = data['order'].rename(columns={"order_id": "order_id", 
-                                        "order_purchase_timestamp": "purchase_timestamp",
-                                        "order_approved_at": "approved_timestamp",
-                                        "order_delivered_customer_date": "delivered_customer_date",
-                                        "order_delivered_carrier_date": "delivered_carrier_date",
-                                        "order_estimated_delivery_date": "estimated_delivery_date"})
-    data['seller'] = data['seller'].rename(columns={"seller_zip_code_prefix": "zip_code_prefix", 
-                                            "seller_city": "city", 
-                                            "seller_state": "state"})
+    for key, columns in RENAME_COLUMNS.items():
+        if key in data:
+            # In place, a renamed copy would duplicate every raw table
+            data[key].rename(columns=columns, inplace=True)
     return data
 
 def convert_to_datetime(data: dict) -> dict:
@@ -154,16 +232,30 @@ def merge_product_category(data: dict) -> dict:
     Merge the product category data
     """
 
-    data['product'] = data['product'].merge(data['product_category'], on='product_category_name', how='inner')
+    data['product'] = engines.get_engine().merge(data['product'], data['product_category'], on='product_category_name', how='inner')
     data['product'] = data['product'].drop(columns=['product_category_name'])
     data['product'] = data['product'].rename(columns={'product_category_name_english': 'category_name'})
     return data
 
-def order_merge(data: dict) -> dict:
+def encode_dimensions(data: dict, previous: pd.DataFrame | None = None) -> dict:
+    """
+    Give the dimension columns of every table integer codes shared across tables
 
-    data['order'] = data['order'].merge(data['order_item'], on='order_id', how='inner')
-    data['order'] = data['order'].merge(data['order_payment'], on='order_id', how='inner')
-    data['order'] = data['order'].merge(data['order_review'], on='order_id', how='left')
+    Args:
+        data: dict - Tables with labels in some of dimensions.DIMENSION_COLUMNS
+        previous: pd.DataFrame | None - Dictionary of an earlier run, whose labels keep their codes
+    Returns:
+        data: dict
+            Data:
+                - dimension_dictionary: pd.DataFrame - Columns: column, code, label
+                - state, region, city, category_name, payment_type, order_status of every table as
+                  categoricals whose codes are the dictionary codes, so later joins and groupbys
+                  run on small integers and tables built from them share the codes
+    """
+    data[DICTIONARY_TABLE] = dimensions.build_dimension_dictionary(dimensions.dimension_labels(data.values()), previous)
+    dtypes = dimensions.dictionary_dtypes(data[DICTIONARY_TABLE])
+    for key in data:
+        data[key] = dimensions.encode_dimensions(data[key], dtypes)
     return data
 
 def add_product_volume(data: dict) -> dict:
@@ -173,34 +265,138 @@ def add_product_volume(data: dict) -> dict:
     """
     data['order_item'] = data['order_item']
     data['product'] = data['product']
-    data['order_item'] = data['order_item'].merge(data['product'], on='product_id', how='inner')
+    data['order_item'] = engines.get_engine().merge(data['order_item'], data['product'], on='product_id', how='inner')
     data['order_item']['volume'] = data['order_item']['length'] * data['order_item']['height'] * data['order_item']['width']
     return data
 
 def add_customer_spending(data: dict) -> dict:
     """
     Add the customer spending
+
+    Notes:
+        - Customers without payments are left out of customer and kept in unpaid_customer, and
+          order_customer keeps the customer of every order, so incremental runs can attribute
+          payments arriving in a later batch (see incremental.ingest_batch)
     """
     data['customer'] = data['customer']
     data['order'] = data['order']
     data['order_payment'] = data['order_payment']
 
-    merged = pd.merge(data['customer'], data['order'], on='customer_id', how='inner')
-    merged = pd.merge(merged, data['order_payment'], on='order_id', how='inner')
+    # Join only the keys and payment_value, the row order (and so the sums) is that of the full tables
+    engine = engines.get_engine()
+    merged = engine.merge(data['customer'][['customer_id']], data['order'][['customer_id', 'order_id']],
+                          on='customer_id', how='inner')
+    merged = engine.merge(merged, data['order_payment'][['order_id', 'payment_value']], on='order_id', how='inner')
     customer_spending = merged.groupby('customer_id')['payment_value'].sum().to_frame()
-
-    # Discretize spending
-    kbd = KBinsDiscretizer(n_bins=3, encode='ordinal', strategy='quantile')
-
-    # Fit and transform
-    kbd.fit(customer_spending)
-    customer_spending['customer_spending'] = kbd.transform(customer_spending)
+    customer_spending = discretize_spending(customer_spending)
 
     # Merge with customer dataset
-    data['customer'] = pd.merge(data['customer'], customer_spending, on='customer_id', how='inner')
+    data['unpaid_customer'] = data['customer'][~data['customer']['customer_id'].isin(customer_spending.index)].reset_index(drop=True)
+    data['order_customer'] = data['order'][['order_id', 'customer_id']]
+    data['customer'] = engine.merge(data['customer'], customer_spending.reset_index(), on='customer_id', how='inner')
     return data
 
-def impute_order_delivery(data:dict) -> dict:
+def discretize_spending(customer_spending: pd.DataFrame,
+                        bin_edges: np.ndarray | dict | None = None,
+                        n_bins: int = SPENDING_BINS,
+                        by: str | None = None) -> pd.DataFrame:
+    """
+    Bin total customer spending into quantile bins
+
+    Args:
+        customer_spending: pd.DataFrame - Indexed by customer_id, requires a payment_value column
+            (and the by column)
+        bin_edges: np.ndarray | dict | None - Edges computed elsewhere, e.g. from sketches merged
+            over partitions in streaming mode, per segment when by is set. Computed from
+            payment_value with exact spending_sketches if None
+        n_bins: int - Number of quantile bins, when computing the edges
+        by: str | None - Column of the segments (e.g. region), bins are then the quantiles of
+            each segment
+    Returns:
+        pd.DataFrame - With customer_spending column (0 to n_bins - 1, NaN for a missing segment)
+    Notes:
+        - Computed edges are the exact quantiles of payment_value, as KBinsDiscretizer fits them
+          without subsampling, so a full and an incremental run bin every customer alike. Edges from sketches of
+          sketches.KLL_K items are exact up to KLL_K customers per segment and within 0.1% of the
+          customer count in rank beyond, so customers that close to an edge may land in the
+          neighbouring bin
+    """
+    if bin_edges is None:
+        bin_edges = spending_bin_edges(spending_sketches(customer_spending, by, exact=True), n_bins)
+    if not isinstance(bin_edges, dict):
+        bin_edges = {None: bin_edges}
+    values = customer_spending['payment_value'].to_numpy('float64')
+    if by is None:
+        segments = {None: np.arange(len(values))}
+    else:
+        segments = customer_spending.groupby(by, observed=True, sort=False).indices
+    codes = np.full(len(values), np.nan)
+    for segment, positions in segments.items():
+        # Same rule as KBinsDiscretizer.transform
+        codes[positions] = np.searchsorted(bin_edges[segment][1:-1], values[positions], side='right')
+    customer_spending['customer_spending'] = codes
+    return customer_spending
+
+def spending_sketches(customer_spending: pd.DataFrame,
+                      by: str | None = None,
+                      current: dict | None = None,
+                      exact: bool = False) -> dict:
+    """
+    Quantile sketches of total customer spending, per segment
+
+    Args:
+        customer_spending: pd.DataFrame - Requires a payment_value column (and the by column)
+        by: str | None - Column of the segments, a single segment (None) if None
+        current: dict | None - Sketches to add to, e.g. those of other partitions or of the
+            customers already binned
+        exact: bool - Size new sketches to hold every value without compacting, for exact quantiles
+            when all the values are in memory. Sketches of sketches.KLL_K items otherwise
+    Returns:
+        dict - sketches.QuantileSketch per segment, for spending_bin_edges
+    """
+    current = {} if current is None else current
+    values = customer_spending['payment_value'].to_numpy('float64')
+    if by is None:
+        segments = {None: np.arange(len(values))}
+    else:
+        segments = customer_spending.groupby(by, observed=True, sort=False).indices
+    for segment, positions in segments.items():
+        k = max(len(positions), 2) if exact else sketches.KLL_K
+        current.setdefault(segment, sketches.QuantileSketch(k)).update(values[positions])
+    return current
+
+def spending_bin_edges(segment_sketches: dict, n_bins: int = SPENDING_BINS) -> dict:
+    """
+    Quantile bin edges of each segment of the output of spending_sketches, as KBinsDiscretizer fits them
+    """
+    return {segment: sketches.quantile_bin_edges(sketch, n_bins, SPENDING_QUANTILE_METHOD)
+            for segment, sketch in segment_sketches.items()}
+
+def impute_order_delivery(data: dict, levels: tuple[str, ...] = IMPUTE_LEVELS[:1]) -> dict:
+    """
+    Impute missing delivery dates with the median of delivered orders from the same seller location
+
+    Args:
+        data: dict
+            Data:
+                - order: pd.DataFrame
+                - order_item: pd.DataFrame
+                - seller: pd.DataFrame
+        levels: tuple[str, ...] - Seller location levels to take medians over, from most to least
+            specific (see IMPUTE_LEVELS). Dates still missing after a level fall back to the next one.
+            The default only uses the zip code prefix.
+    Returns:
+        data: dict
+            Data:
+                - order: pd.DataFrame - Delivered and unavailable orders joined to their items,
+                  sorted by seller zip code prefix, with delivered_customer_date and
+                  delivered_carrier_date imputed
+    Raises:
+        ValueError: If a level is not in IMPUTE_LEVELS
+    """
+    unknown = [level for level in levels if level not in IMPUTE_LEVELS]
+    if unknown:
+        raise ValueError(f"Levels {unknown} not in {IMPUTE_LEVELS}")
 
     df_order = data['order']
     df_order_item = data['order_item']
@@ -210,93 +406,506 @@ def impute_order_delivery(data:dict) -> dict:
     df_order['delivered_customer_date'] = pd.to_datetime(df_order['delivered_customer_date'])
     df_order['delivered_carrier_date'] = pd.to_datetime(df_order['delivered_carrier_date'])
 
-    filled = (
-        df_order[mask]
-        .merge(df_order_item, how='left')
-        .merge(df_seller, how='left')
-        # Impute median zip codes grouped by zip codes
-        .groupby('zip_code_prefix')
-        .apply(
-            lambda g: g.assign(
-            # Fill customer delivery date with values from records with order_status as delivered
-                order_delivered_customer_date=g['delivered_customer_date'].fillna(
-                    g.loc[g['order_status'] == 'delivered', 'delivered_customer_date'].median()
-                ),
-            # Fill carrier delivery date with values from records with order_status as delivered
-                order_delivered_carrier_date=g['delivered_carrier_date'].fillna(
-                    g.loc[g['order_status'] == 'delivered', 'delivered_carrier_date'].median()
-                )
-            )
-        )
-        .reset_index(drop=True)
-    )
+    # Only the seller location is needed from the items and sellers
+    seller_columns = ['seller_id', *[level for level in IMPUTE_LEVELS if level in df_seller.columns]]
+    engine = engines.get_engine()
+    filled = engine.merge(df_order[mask], df_order_item[['order_id', 'seller_id']], on='order_id', how='left')
+    filled = engine.merge(filled, df_seller[seller_columns], on='seller_id', how='left')
+    # Keep the rows and row order of a groupby over the seller zip code
+    filled = (filled[filled['zip_code_prefix'].notna()]
+              .sort_values('zip_code_prefix', kind='stable')
+              .reset_index(drop=True))
+    filled = fill_delivery_dates(filled, levels)
+
     data['order'] = filled[data['order'].columns]
 
     return data
-"""----------------------------I/O----------------------------"""
-
-def preprocess_data() -> dict:
 
-    data = load_raw_data()
-
-    data = rename_columns(data)
+def fill_delivery_dates(filled: pd.DataFrame, levels: tuple[str, ...] = IMPUTE_LEVELS[:1]) -> pd.DataFrame:
+    """
+    Fill missing delivery dates with the median of delivered rows from the same seller location
 
-    data = convert_to_datetime(data)
+    Args:
+        filled: pd.DataFrame - Orders joined to their items and sellers (see impute_order_delivery).
+            Every row of a seller location must be present for its medians to be exact
+        levels: tuple[str, ...] - See impute_order_delivery
+    Returns:
+        pd.DataFrame - filled, with delivered_customer_date and delivered_carrier_date filled
+    """
+    if 'region' in levels:
+        filled['region'] = filled['state'].map(STATE_TO_REGION)
+
+    # Medians are taken over records with order_status as delivered
+    delivered = filled['order_status'] == 'delivered'
+    for col in ['delivered_customer_date', 'delivered_carrier_date']:
+        # Grouped datetime medians mishandle NaT, take them over nanoseconds as Series.median does
+        nanoseconds = pd.Series(filled[col].to_numpy('int64'), dtype='float64').where(filled[col].notna() & delivered)
+        for level in levels:
+            if not filled[col].isna().any():
+                break
+            medians = nanoseconds.groupby(filled[level]).transform('median')
+            filled[col] = filled[col].fillna(pd.to_datetime(medians))
+    return filled
+
+def build_zip_dimension(data: dict) -> dict:
+    """
+    Build the zip code dimension from the geolocation table
 
-    data = add_date_features(data)
+    Args:
+        data: dict
+            Data:
+                - geo: pd.DataFrame (with region, see map_states_to_regions)
+    Returns:
+        data: dict
+            Data:
+                - zip: pd.DataFrame - One row per zip code prefix
+                    Columns: zip_code_prefix, latitude, longitude, city, state, region
+    """
+    data['zip'] = dimensions.build_zip_dimension(data['geo'])
+    return data
 
-    data = add_delivery_time(data) 
+def build_order_fact(data: dict) -> dict:
+    """
+    Build the denormalised order-line fact table used by the dashboard
 
-    data = map_states_to_regions(data)
+    Args:
+        data: dict
+            Data:
+                - order_item: pd.DataFrame (with product columns, see add_product_volume)
+                - order: pd.DataFrame
+                - customer: pd.DataFrame
+                - seller: pd.DataFrame
+                - zip: pd.DataFrame
+                - order_payment: pd.DataFrame
+                - order_review: pd.DataFrame
+    Returns:
+        data: dict
+            Data:
+                - order_fact: pd.DataFrame - One row per order item
+                    Columns: order_id, order_item_id, product_id, seller_id, price, freight_value,
+                    category_name, customer_id, order_status, purchase_month, delivery_time,
+                    zip_code_prefix, city, state, region, payment_type, review_score, seller_state,
+                    distance_km, cross_state, cross_region
+    Notes:
+        - Order attributes are only present for orders kept by impute_order_delivery, the
+          other lines keep their price and category with NaN order/customer columns
+        - region comes from the zip dimension by customer zip, city and state from the customer
+        - payment_type is the first payment of the order, review_score the first review
+        - distance_km, cross_state and cross_region describe the seller to customer route, see
+          routes.add_route_features
+    """
+    # The processed order table is at order item grain, keep one row per order
+    orders = data['order'][FACT_ORDER_COLUMNS].drop_duplicates('order_id')
+    zip_regions = dimensions.build_zip_lookup(data['zip'], 'region')
+    payments = (data['order_payment']
+                .sort_values('payment_sequential')
+                .drop_duplicates('order_id')[['order_id', 'payment_type']])
+    reviews = data['order_review'].drop_duplicates('order_id')[['order_id', 'review_score']]
+    sellers = data['seller'][list(FACT_SELLER_COLUMNS)].rename(columns=FACT_SELLER_COLUMNS)
+
+    engine = engines.get_engine()
+    fact = engine.merge(data['order_item'][FACT_ITEM_COLUMNS], orders, on='order_id', how='left')
+    fact = engine.merge(fact, data['customer'][FACT_CUSTOMER_COLUMNS], on='customer_id', how='left')
+    fact = engine.merge(fact, payments, on='order_id', how='left')
+    fact = engine.merge(fact, reviews, on='order_id', how='left')
+    fact = engine.merge(fact, sellers, on='seller_id', how='left')
+    fact.insert(fact.columns.get_loc('state') + 1, 'region', dimensions.lookup_zips(fact['zip_code_prefix'], zip_regions))
+    fact = routes.add_route_features(fact, fact.pop('seller_zip_code_prefix'), data['zip'])
+
+    data['order_fact'] = fact
+    return data
 
-    data = merge_product_category(data)
+def build_rollups(data: dict) -> dict:
+    """
+    Build the monthly rollups behind the year filtered KPIs
 
-    data = add_product_volume(data)
+    Args:
+        data: dict
+            Data:
+                - order_fact: pd.DataFrame
+                - customer: pd.DataFrame
+    Returns:
+        data: dict
+            Data:
+                - monthly_rollup, monthly_city, monthly_category, customer_month: see rollups.build_rollups
+    """
+    data.update(rollups.build_rollups(data['order_fact'], data['customer']))
+    return data
 
-    data = add_customer_spending(data)
+"""----------------------------I/O----------------------------"""
 
-    data = impute_order_delivery(data)
+# Steps of preprocess_data, in order. Each takes and returns the dict of tables
+PIPELINE_STEPS = [
+    rename_columns,
+    convert_to_datetime,
+    add_date_features,
+    add_delivery_time,
+    map_states_to_regions,
+    build_zip_dimension,
+    merge_product_category,
+    encode_dimensions,
+    add_product_volume,
+    add_customer_spending,
+    impute_order_delivery,
+    build_order_fact,
+    build_rollups,
+]
+
+# Tables each step reads and writes (steps modify tables in place, so every modified table is
+# an output). preprocess_data runs the steps not depending on each other concurrently
+STEP_TABLES = {
+    'rename_columns': (list(RENAME_COLUMNS), list(RENAME_COLUMNS)),
+    'convert_to_datetime': (['order'], ['order']),
+    'add_date_features': (['order'], ['order']),
+    'add_delivery_time': (['order'], ['order']),
+    'map_states_to_regions': (['geo', 'customer'], ['geo', 'customer']),
+    'build_zip_dimension': (['geo'], ['zip']),
+    'merge_product_category': (['product', 'product_category'], ['product']),
+    'encode_dimensions': ([*RAW_FILES, 'zip'], [*RAW_FILES, 'zip', DICTIONARY_TABLE]),
+    'add_product_volume': (['order_item', 'product'], ['order_item']),
+    'add_customer_spending': (['customer', 'order', 'order_payment'], ['customer', 'unpaid_customer', 'order_customer']),
+    'impute_order_delivery': (['order', 'order_item', 'seller'], ['order']),
+    'build_order_fact': (['order_item', 'order', 'customer', 'seller', 'zip', 'order_payment', 'order_review'], ['order_fact']),
+    'build_rollups': (['order_fact', 'customer'], list(rollups.ROLLUP_TABLES)),
+}
+PIPELINE_DAG = [scheduler.Step(step, *map(tuple, STEP_TABLES[step.__name__])) for step in PIPELINE_STEPS]
+
+def preprocess_data(data: dict | None = None,
+                    hooks: list[profiling.Hook] | None = None,
+                    max_workers: int | None = None,
+                    use_processes: bool = False,
+                    cache_dir: Path | None = None,
+                    versions: dict[str, str] | None = None) -> dict:
+    """
+    Run every preprocessing step
 
-    return data
+    Args:
+        data: dict | None - Raw tables, loaded with load_raw_data() if None
+        hooks: list[profiling.Hook] | None - Called around each step, e.g. a profiling.StepProfiler
+        max_workers: int | None - Steps run at the same time (see scheduler.run_dag), the CPU
+            count if None. 1 runs PIPELINE_STEPS in order
+        use_processes: bool - Run the steps in worker processes instead of threads
+        cache_dir: Path | None - Reuse the outputs of steps whose inputs and code are unchanged
+            since a previous run with the same cache_dir
+        versions: dict[str, str] | None - Versions of the raw tables for cache_dir (see
+            raw_versions), content hashed if None
+    Returns:
+        data: dict - Processed tables
+    Notes:
+        - The steps form the DAG of STEP_TABLES, the tables are those of running them in order
+    """
+    if data is None:
+        data = load_raw_data()
+
+    return scheduler.run_dag(PIPELINE_DAG, data, max_workers, use_processes, hooks, cache_dir, versions)
+
+def save_processed_data(fmt: str = DEFAULT_FORMAT,
+                        processed_dir: Path = DATA_PROCESSED_DIR,
+                        raw_dir: Path = DATA_RAW_DIR,
+                        hooks: list[profiling.Hook] | None = None,
+                        low_memory: bool = False,
+                        max_workers: int | None = None,
+                        use_processes: bool = False,
+                        cache_dir: Path | None = None) -> None:
+    """
+    Run the preprocessing pipeline and write every table to data/processed
 
-def save_processed_data() -> None:
+    Args:
+        fmt: str - One of PROCESSED_FORMATS ('csv', 'parquet' or 'feather')
+        processed_dir: Path - Output directory
+        raw_dir: Path - Directory holding the raw Olist files
+        hooks: list[profiling.Hook] | None - Called around each preprocessing step
+        low_memory: bool - Read the raw tables with LOW_MEMORY_DTYPES
+        max_workers: int | None - Steps run and tables written at the same time, see preprocess_data
+        use_processes: bool - Run the steps in worker processes, see preprocess_data
+        cache_dir: Path | None - Step output cache, see preprocess_data
+    Raises:
+        ValueError: If the format is not supported
+    Notes:
+        - Also writes the manifest of ingested raw rows used by incremental.update_processed_data
+        - In low-memory mode the processed tables hold the same values, with categorical string
+          columns and downcast integer columns in memory (so in Parquet and Feather)
+    """
+    check_format(fmt)
     print("Processing data...")
-    data = preprocess_data()
-
-    for key, value in data.items():
-        print(f"Saving {key}...")
-        value.to_csv(DATA_PROCESSED_DIR / f'{key}.csv', index=False)
-        print(f"{key} saved to data/processed/")
+    dtypes = LOW_MEMORY_DTYPES if low_memory else None
+    offsets = manifest.file_offsets(raw_dir, list(RAW_FILES.values()))
+    raw_data = load_raw_data(raw_dir, dtypes=dtypes)
+    rows = {key: (RAW_FILES[key], 0, len(value)) for key, value in raw_data.items()}
+    versions = raw_versions(raw_dir, dtypes) if cache_dir else None
+    data = preprocess_data(raw_data, hooks, max_workers, use_processes, cache_dir, versions)
+
+    print("Saving tables...")
+    write_tables(data, processed_dir, fmt, max_workers)
+    manifest.write_manifest(manifest.record_batch(manifest.read_manifest(processed_dir), rows, 'full', fmt, offsets),
+                            processed_dir)
     print("All data saved to data/processed/")
     print("Done")
     return
 
-def load_raw_data()-> dict:
-    return {
-        'geo': pd.read_csv(DATA_RAW_DIR / 'olist_geolocation_dataset.csv'),
-        'order': pd.read_csv(DATA_RAW_DIR / 'olist_orders_dataset.csv'),
-        'order_item': pd.read_csv(DATA_RAW_DIR / 'olist_order_items_dataset.csv'),
-        'order_payment': pd.read_csv(DATA_RAW_DIR / 'olist_order_payments_dataset.csv'),
-        'order_review': pd.read_csv(DATA_RAW_DIR / 'olist_order_reviews_dataset.csv'),
-        'product': pd.read_csv(DATA_RAW_DIR / 'olist_products_dataset.csv'),
-        'seller': pd.read_csv(DATA_RAW_DIR / 'olist_sellers_dataset.csv'),
-        'customer': pd.read_csv(DATA_RAW_DIR / 'olist_customers_dataset.csv'),
-        'product_category': pd.read_csv(DATA_RAW_DIR / 'product_category_name_translation.csv')
-        }
-
-def load_processed_data() -> dict:
-    return {
-        'geo': pd.read_csv(DATA_PROCESSED_DIR / 'geo.csv'),
-        'order': pd.read_csv(DATA_PROCESSED_DIR / 'order.csv', parse_dates=['purchase_timestamp', 'approved_timestamp', 'delivered_carrier_date', 'delivered_customer_date', 'purchase_month']),
-        'order_item': pd.read_csv(DATA_PROCESSED_DIR / 'order_item.csv'),
-        'order_payment': pd.read_csv(DATA_PROCESSED_DIR / 'order_payment.csv'),
-        'order_review': pd.read_csv(DATA_PROCESSED_DIR / 'order_review.csv'),
-        'product': pd.read_csv(DATA_PROCESSED_DIR / 'product.csv'),
-        'seller': pd.read_csv(DATA_PROCESSED_DIR / 'seller.csv'),
-        'customer': pd.read_csv(DATA_PROCESSED_DIR / 'customer.csv'),
-        'product_category': pd.read_csv(DATA_PROCESSED_DIR / 'product_category.csv')
+def write_table(df: pd.DataFrame, path: Path, fmt: str = DEFAULT_FORMAT) -> None:
+    """
+    Write a single processed table
+
+    Args:
+        df: pd.DataFrame
+        path: Path - Destination file, including the format suffix
+        fmt: str - One of PROCESSED_FORMATS
+    Notes:
+        - Parquet and Feather store CATEGORICAL_COLUMNS dictionary encoded, so they
+          load back as pandas categoricals
+        - The table is written next to path then renamed over it, so readers holding the
+          previous file open keep reading it whole (see dataset.Snapshot)
+    """
+    tmp = partial_path(path)
+    if fmt == 'csv':
+        df.to_csv(tmp, index=False)
+    elif fmt == 'parquet':
+        encode_categoricals(df).to_parquet(tmp, index=False)
+    else:
+        # One record batch, so mapped columns need no concatenation
+        encode_categoricals(df).reset_index(drop=True).to_feather(tmp, compression=FEATHER_COMPRESSION,
+                                                                   chunksize=max(len(df), 1))
+    os.replace(tmp, path)
+
+def partial_path(path: Path) -> Path:
+    """
+    Where a table is written before replacing path
+    """
+    return path.with_name(path.name + '.partial')
+
+def write_tables(data: dict, processed_dir: Path, fmt: str = DEFAULT_FORMAT, max_workers: int | None = None) -> None:
+    """
+    Write processed tables concurrently, one write_table per table
+
+    Args:
+        data: dict - Tables, written to processed_dir/<key>.<fmt>
+        processed_dir: Path
+        fmt: str - One of PROCESSED_FORMATS
+        max_workers: int | None - Writer threads, defaults to one per table up to the CPU count
+    """
+    if max_workers is None:
+        max_workers = max(1, min(len(data), os.cpu_count() or 1))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(write_table, value, processed_dir / f'{key}.{fmt}', fmt): key
+                   for key, value in data.items()}
+        for future in as_completed(futures):
+            future.result()
+            print(f"{futures[future]} saved to data/processed/")
+
+def read_table(path: Path,
+               fmt: str = DEFAULT_FORMAT,
+               columns: list[str] | None = None,
+               dtypes: dict | None = None,
+               source: BinaryIO | None = None) -> pd.DataFrame:
+    """
+    Read a single processed table
+
+    Args:
+        path: Path - Source file, including the format suffix
+        fmt: str - One of PROCESSED_FORMATS
+        columns: list[str] | None - Only read these columns (all columns if None)
+        dtypes: dict | None - dtype per column
+        source: BinaryIO | None - The file opened earlier, read instead of path (which may
+            have been replaced since). Feather sources are memory mapped
+    Returns:
+        pd.DataFrame
+    """
+    if source is not None:
+        source.seek(0)
+    if fmt == 'csv':
+        header = pd.read_csv(source or path, nrows=0).columns
+        if source is not None:
+            source.seek(0)
+        dates = [col for col in DATE_COLUMNS.get(path.stem, []) if col in header and (columns is None or col in columns)]
+        # Chunked writers (see streaming.TableWriter) may write some chunks with fractional seconds
+        df = pd.read_csv(source or path, usecols=columns, parse_dates=dates, date_format='ISO8601', dtype=dtypes)
+    elif fmt == 'parquet':
+        df = pd.read_parquet(source or path, columns=columns)
+    elif source is not None:
+        df = map_feather(source, columns)
+    else:
+        df = pd.read_feather(path, columns=columns)
+    if dtypes and fmt != 'csv':
+        # Column by column, DataFrame.astype would copy the other (mapped) columns
+        for col, dtype in dtypes.items():
+            if col in df.columns:
+                df[col] = df[col].astype(dtype)
+    # Lets the merges/aggregations cache key on the file contents
+    return cache.stamp_version(df, cache.file_version(path, source))
+
+def map_feather(source: BinaryIO, columns: list[str] | None = None) -> pd.DataFrame:
+    """
+    Read a Feather table from a memory map of an open file
+
+    Columns of uncompressed files without nulls that pandas can hold as is (numbers, dates)
+    are views of the mapped pages, not copies. Other columns are converted as pd.read_feather does.
+    """
+    mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+    # feather.read_table would copy the whole file from a non-file source
+    table = pa.ipc.open_file(pa.BufferReader(pa.py_buffer(mapped))).read_all()
+    if columns is not None:
+        table = table.select(columns)
+    return table.to_pandas(split_blocks=True)
+
+def encode_categoricals(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert the low-cardinality string columns to categoricals
+    """
+    cols = [col for col in CATEGORICAL_COLUMNS if col in df.columns]
+    df = df.astype({col: 'category' for col in cols})
+    # Columns already categorical (low-memory mode) keep every raw category, store only the used ones
+    return df.assign(**{col: df[col].cat.remove_unused_categories() for col in cols})
+
+def check_format(fmt: str) -> None:
+    if fmt not in PROCESSED_FORMATS:
+        raise ValueError(f"Format {fmt} not in {PROCESSED_FORMATS}")
+
+def load_raw_data(raw_dir: Path = DATA_RAW_DIR,
+                  columns: dict[str, list[str]] | None = None,
+                  dtypes: dict[str, dict] | None = None,
+                  max_workers: int | None = None,
+                  report: dict | None = None) -> dict:
+    """
+    Load the raw Olist tables concurrently
+
+    Args:
+        raw_dir: Path - Directory holding the raw Olist files
+        columns: dict[str, list[str]] | None - Raw column projection per table (all columns for
+            tables not listed)
+        dtypes: dict[str, dict] | None - Raw column dtypes per table
+        max_workers: int | None - Reader threads, see loader.load_tables
+        report: dict | None - Filled with the per-table timing and memory report of loader.load_tables
+    Returns:
+        data: dict
+    """
+    columns = columns or {}
+    dtypes = dtypes or {}
+    readers = {
+        key: partial(pd.read_csv, raw_dir / file, usecols=columns.get(key), dtype=dtypes.get(key))
+        for key, file in RAW_FILES.items()
+    }
+    data, load_report = loader.load_tables(readers, max_workers=max_workers)
+    if report is not None:
+        report.update(load_report)
+    return data
+
+def raw_versions(raw_dir: Path = DATA_RAW_DIR, dtypes: dict[str, dict] | None = None) -> dict[str, str]:
+    """
+    Version of each raw table as read by load_raw_data: its file contents and dtypes
+    """
+    dtypes = dtypes or {}
+    return {key: f'{cache.file_version(raw_dir / file)}:{sorted(dtypes.get(key, {}).items())}'
+            for key, file in RAW_FILES.items()}
+
+def load_processed_data(fmt: str = DEFAULT_FORMAT,
+                        columns: dict[str, list[str]] | None = None,
+                        processed_dir: Path = DATA_PROCESSED_DIR,
+                        dtypes: dict[str, dict] | None = None,
+                        max_workers: int | None = None,
+                        report: dict | None = None) -> dict:
+    """
+    Load the processed tables concurrently
+
+    Args:
+        fmt: str - One of PROCESSED_FORMATS ('csv', 'parquet' or 'feather')
+        columns: dict[str, list[str]] | None - Column projection per table. When given,
+            only the listed tables are loaded, with only the listed columns (None loads all columns)
+        processed_dir: Path - Directory holding the processed files
+        dtypes: dict[str, dict] | None - Column dtypes per table
+        max_workers: int | None - Reader threads, see loader.load_tables
+        report: dict | None - Filled with the per-table timing and memory report of loader.load_tables
+    Returns:
+        data: dict - Dimension columns are categoricals with the codes of the dimension_dictionary table
+    Raises:
+        ValueError: If the format is not supported
+    """
+    check_format(fmt)
+    dtypes = dtypes or {}
+    tables = PROCESSED_TABLES if columns is None else list(columns)
+    coded = dimension_dtypes(processed_dir, fmt)
+    readers = {
+        key: partial(read_table, processed_dir / f'{key}.{fmt}', fmt,
+                     None if columns is None else columns[key], {**coded, **dtypes.get(key, {})} or None)
+        for key in tables
     }
+    data, load_report = loader.load_tables(readers, max_workers=max_workers)
+    if report is not None:
+        report.update(load_report)
+    return data
+
+def dimension_dtypes(processed_dir: Path = DATA_PROCESSED_DIR, fmt: str = DEFAULT_FORMAT) -> dict[str, pd.CategoricalDtype]:
+    """
+    Dictionary dtypes of the dimension columns of the processed tables
+
+    Returns:
+        dict[str, pd.CategoricalDtype] - See dimensions.dictionary_dtypes, empty if there is no
+            dimension_dictionary table
+    """
+    path = processed_dir / f'{DICTIONARY_TABLE}.{fmt}'
+    if not path.exists():
+        return {}
+    return dimensions.dictionary_dtypes(read_table(path, fmt))
 
 if __name__ == "__main__":
-    save_processed_data()
-    print("Done")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Process the raw Olist data into data/processed")
+    parser.add_argument('--format', choices=PROCESSED_FORMATS, default=DEFAULT_FORMAT)
+    parser.add_argument('--engine', choices=tuple(engines.ENGINES),
+                        help=f"Engine of the pipeline joins (default: ${engines.ENGINE_ENV} or {engines.DEFAULT_ENGINE})")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only ingest raw rows not yet recorded in data/processed/manifest.json")
+    parser.add_argument('--check', action='store_true',
+                        help="With --incremental, then compare the processed tables with a full rebuild in memory")
+    parser.add_argument('--streaming', action='store_true',
+                        help="Process raw files larger than memory chunk by chunk, spilling partitions to disk")
+    parser.add_argument('--partitions', type=int, help="Spill partitions in streaming mode (default 16)")
+    parser.add_argument('--chunk-rows', type=int, help="Raw rows read at a time in streaming mode (default 500000)")
+    parser.add_argument('--low-memory', action='store_true',
+                        help="Read the raw tables with categorical and downcast integer dtypes")
+    parser.add_argument('--workers', type=int,
+                        help="Independent steps and table writes run at the same time (default: CPU count)")
+    parser.add_argument('--processes', action='store_true', help="Run the pipeline steps in worker processes")
+    parser.add_argument('--step-cache', type=Path, metavar='DIR',
+                        help="Reuse the outputs of steps whose inputs and code are unchanged, cached in DIR")
+    parser.add_argument('--profile', type=Path, metavar='REPORT',
+                        help="Write the per-step time, memory and row count report to this JSON file")
+    parser.add_argument('--profile-step', action='append', choices=[step.__name__ for step in PIPELINE_STEPS],
+                        help="Also capture this step with a profiler, next to the report (repeatable)")
+    parser.add_argument('--profiler', choices=profiling.PROFILERS, default='cprofile')
+    parser.add_argument('--report', action='store_true',
+                        help="Then write the dashboard KPIs and chart specs to data/processed/report")
+    args = parser.parse_args()
+    if args.engine:
+        os.environ[engines.ENGINE_ENV] = args.engine
+    if args.incremental:
+        from app.assets import incremental
+        incremental.update_processed_data(fmt=args.format)
+        if args.check:
+            differences = incremental.check_against_full(fmt=args.format)
+            for key, difference in differences.items():
+                print(f"{key} differs from the full rebuild:\n{difference}")
+            if differences:
+                sys.exit(1)
+            print("The processed tables match a full rebuild")
+    elif args.streaming:
+        from app.assets import streaming
+        options = {'partitions': args.partitions, 'chunk_rows': args.chunk_rows}
+        streaming.save_processed_data_streaming(fmt=args.format,
+                                                **{key: value for key, value in options.items() if value})
+    else:
+        profiler = None
+        if args.profile or args.profile_step:
+            report = args.profile or DATA_PROCESSED_DIR / 'profile.json'
+            profiler = profiling.StepProfiler(args.profile_step, args.profiler, report.parent)
+        # Profiled steps run one at a time, so their timings and captures are their own
+        workers = 1 if profiler else args.workers
+        save_processed_data(fmt=args.format, hooks=[profiler] if profiler else None, low_memory=args.low_memory,
+                            max_workers=workers, use_processes=args.processes, cache_dir=args.step_cache)
+        if profiler:
+            profiler.write_report(report)
+            print(profiler.format_report())
+            print(f"Profile written to {report}")
+    if args.report:
+        from app.assets import reports
+        print(f"Report written to {reports.save_batch_report(fmt=args.format)}")
+    print("Done")
@@ -0,0 +1,210 @@
+import cProfile
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Environment variable enabling the profiler on the dashboard pages
+PROFILE_ENV = 'OLIST_PROFILE'
+PROFILERS = ('cprofile', 'pyinstrument')
+
+class Hook:
+    """
+    Called around each pipeline step or dashboard data call
+
+    inputs and outputs map a table or argument name to its DataFrame.
+    """
+
+    def before(self, name: str, inputs: dict[str, pd.DataFrame]) -> None:
+        pass
+
+    def after(self, name: str, outputs: dict[str, pd.DataFrame]) -> None:
+        pass
+
+class StepProfiler(Hook):
+    """
+    Records wall time, peak RSS, rows in and out per table and join fan-out of each step
+
+    Args:
+        profile_steps: list[str] - Steps to capture with a profiler as well
+        profiler: str - One of PROFILERS, pyinstrument must be installed to use it
+        output_dir: Path | None - Where the captures are written (<step>.prof for cProfile,
+            <step>.html for pyinstrument), the current directory if None
+    """
+
+    def __init__(self,
+                 profile_steps: list[str] | None = None,
+                 profiler: str = 'cprofile',
+                 output_dir: Path | None = None):
+        if profiler not in PROFILERS:
+            raise ValueError(f"Profiler {profiler} not in {PROFILERS}")
+        self.profile_steps = set(profile_steps or [])
+        self.profiler = profiler
+        self.output_dir = Path(output_dir or '.')
+        self.steps: list[dict] = []
+        self._pending: dict[str, dict] = {}
+
+    def before(self, name: str, inputs: dict[str, pd.DataFrame]) -> None:
+        pending = {'rows_in': count_rows(inputs), 'rss_before': peak_rss()}
+        if name in self.profile_steps:
+            pending['capture'] = self._start_capture()
+        pending['start'] = time.perf_counter()
+        self._pending[name] = pending
+
+    def after(self, name: str, outputs: dict[str, pd.DataFrame]) -> None:
+        seconds = time.perf_counter() - self._pending[name]['start']
+        pending = self._pending.pop(name)
+        record = {
+            'name': name,
+            'seconds': seconds,
+            'peak_rss_bytes': peak_rss(),
+            'rss_growth_bytes': None,
+            'rows_in': pending['rows_in'],
+            'rows_out': count_rows(outputs),
+            'fan_out': {},
+        }
+        if record['peak_rss_bytes'] is not None:
+            record['rss_growth_bytes'] = record['peak_rss_bytes'] - pending['rss_before']
+        # Tables whose row count changed, e.g. a merge multiplying rows
+        for key, rows in record['rows_out'].items():
+            rows_in = record['rows_in'].get(key)
+            if rows_in and rows != rows_in:
+                record['fan_out'][key] = rows / rows_in
+        if 'capture' in pending:
+            record['profile'] = str(self._stop_capture(name, pending['capture']))
+        self.steps.append(record)
+
+    def report(self) -> dict:
+        """
+        Returns:
+            dict - Keys:
+                - seconds: float - Total wall time of the recorded steps
+                - peak_rss_bytes: int | None - Peak RSS of the process (None where the resource module is missing)
+                - steps: list[dict] - Per step, in call order: name, seconds, peak_rss_bytes,
+                  rss_growth_bytes, rows_in and rows_out per table, fan_out (rows out / rows in per
+                  table whose row count changed), profile (path of the capture, if any)
+        """
+        return {
+            'seconds': sum(step['seconds'] for step in self.steps),
+            'peak_rss_bytes': peak_rss(),
+            'steps': self.steps,
+        }
+
+    def write_report(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.report(), indent=2))
+
+    def format_report(self) -> str:
+        """
+        Summary table of the recorded steps
+        """
+        width = max([len(step['name']) for step in self.steps] + [28]) + 2
+        lines = [f"{'step':<{width}}{'seconds':>10}{'peak MB':>10}{'+MB':>8}{'rows in':>12}{'rows out':>12}  fan-out"]
+        for step in self.steps:
+            peak, growth = (f"{step[key] / 1024 ** 2:.1f}" if step[key] is not None else '-'
+                            for key in ('peak_rss_bytes', 'rss_growth_bytes'))
+            fan_out = ', '.join(f"{key} x{ratio:.2f}" for key, ratio in step['fan_out'].items())
+            lines.append(f"{step['name']:<{width}}{step['seconds']:>10.3f}{peak:>10}{growth:>8}"
+                         f"{sum(step['rows_in'].values()):>12,}{sum(step['rows_out'].values()):>12,}  {fan_out}")
+        lines.append(f"{'total':<{width}}{sum(step['seconds'] for step in self.steps):>10.3f}")
+        return '\n'.join(lines)
+
+    def _start_capture(self):
+        if self.profiler == 'pyinstrument':
+            from pyinstrument import Profiler
+            capture = Profiler()
+            capture.start()
+        else:
+            capture = cProfile.Profile()
+            capture.enable()
+        return capture
+
+    def _stop_capture(self, name: str, capture) -> Path:
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        if self.profiler == 'pyinstrument':
+            capture.stop()
+            path = self.output_dir / f'{name}.html'
+            path.write_text(capture.output_html())
+        else:
+            capture.disable()
+            path = self.output_dir / f'{name}.prof'
+            capture.dump_stats(path)
+        return path
+
+def run_step(step: Callable[[dict], dict], data: dict, hooks: list[Hook] | None = None) -> dict:
+    """
+    Run a preprocessing step between the hooks
+
+    Args:
+        step: Callable[[dict], dict] - e.g. one of preprocessing.PIPELINE_STEPS
+        data: dict - Tables passed to the step
+        hooks: list[Hook] | None
+    Returns:
+        data: dict - Output of the step
+    """
+    if not hooks:
+        return step(data)
+    for hook in hooks:
+        hook.before(step.__name__, data)
+    data = step(data)
+    for hook in reversed(hooks):
+        hook.after(step.__name__, data)
+    return data
+
+def call(hooks: list[Hook] | None, func: Callable, *args, name: str | None = None, **kwargs):
+    """
+    Call a dashboard data function between the hooks
+
+    The DataFrame arguments are reported as inputs and a DataFrame result as output 'result'.
+    Table mappings (data) are not counted, so no table is loaded only to be measured.
+
+    Args:
+        hooks: list[Hook] | None
+        func: Callable - e.g. merges.get_sales_by_region_category
+        name: str | None - Name in the report, defaults to the function name
+    Returns:
+        The result of func(*args, **kwargs)
+    """
+    if not hooks:
+        return func(*args, **kwargs)
+    name = name or func.__name__
+    inputs = {f'arg{i}': arg for i, arg in enumerate(args) if isinstance(arg, pd.DataFrame)}
+    inputs.update({key: arg for key, arg in kwargs.items() if isinstance(arg, pd.DataFrame)})
+    for hook in hooks:
+        hook.before(name, inputs)
+    result = func(*args, **kwargs)
+    outputs = {'result': result} if isinstance(result, pd.DataFrame) else {}
+    for hook in reversed(hooks):
+        hook.after(name, outputs)
+    return result
+
+def count_rows(tables: dict) -> dict[str, int]:
+    """
+    Rows of each DataFrame in a dict of tables
+    """
+    return {key: len(df) for key, df in tables.items() if isinstance(df, pd.DataFrame)}
+
+def peak_rss() -> int | None:
+    """
+    Peak resident set size of the process in bytes, None where the resource module is missing
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def enabled() -> bool:
+    """
+    Whether the dashboard pages should profile their data calls (OLIST_PROFILE=1)
+    """
+    return os.environ.get(PROFILE_ENV, '') not in ('', '0')
@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+# Allow running this file as a script
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.assets import aggregations, charts, merges, profiling
+from app.assets.dataset import LazyDataset, served_format
+from app.assets.preprocessing import DATA_PROCESSED_DIR, PROCESSED_FORMATS
+
+# Written next to the processed tables
+REPORT_DIR = DATA_PROCESSED_DIR / 'report'
+KPI_FILE = 'kpis.json'
+CHART_DIR = 'charts'
+# Key of the all-time KPIs, per-year KPIs are keyed by the year
+ALL_YEARS = 'all'
+# Years of the Main Dashboard year filter
+REPORT_YEARS = [2017, 2018]
+# Above/below average chart choices of the Main Dashboard: chart name and get_average_sales_ARPU flags
+SALES_ARPU_CHARTS = {
+    "Above Average Sales and Below Average ARPU": ('above_sales_below_ARPU', {'sales': True, 'ARPU': False}),
+    "Below Average Sales and Above Average ARPU": ('below_sales_above_ARPU', {'sales': False, 'ARPU': True}),
+}
+# Tables and columns each page reads, loaded on first access
+PAGE_COLUMNS = {
+    'executive_summary': {
+        'customer_month': ['purchase_month', 'customer_key'],
+        'monthly_rollup': ['purchase_month', 'revenue', 'order_count'],
+        'leaderboard': ['dimension', 'year', 'region', 'rank', 'label', 'value'],
+    },
+    'main_dashboard': {
+        'customer_month': ['purchase_month', 'customer_key'],
+        'monthly_rollup': ['purchase_month', 'revenue', 'order_count'],
+        'leaderboard': ['dimension', 'year', 'region', 'rank', 'label', 'value'],
+        'order_payment': ['payment_type', 'payment_value'],
+        'order_fact': ['order_id', 'price', 'category_name', 'region', 'city', 'purchase_month',
+                       'order_status', 'delivery_time', 'review_score'],
+    },
+}
+# Tables and columns read by the report, those of both pages
+REPORT_COLUMNS = PAGE_COLUMNS['main_dashboard']
+
+def get_kpis(data: dict[str, pd.DataFrame],
+             year: int | None = None,
+             hooks: list[profiling.Hook] | None = None) -> dict[str, str]:
+    """
+    KPI tiles of the pages, formatted for display
+    Args:
+        data: dict[str, pd.DataFrame]
+            Data:
+                - customer_month, monthly_rollup, leaderboard: pd.DataFrame
+        year: int | None - Purchase year, all years if None
+        hooks: list[profiling.Hook] | None - Called around each data call
+    Returns:
+        dict[str, str] - Keys: total_revenue, total_orders, total_customers,
+            highest_selling_city, highest_selling_category
+    """
+    city = profiling.call(hooks, merges.get_top_sellers, data, 'city', year=year).index[0]
+    category = profiling.call(hooks, merges.get_top_sellers, data, 'category_name', year=year).index[0]
+    return {
+        'total_revenue': profiling.call(hooks, aggregations.get_total_revenue, data, year=year),
+        'total_orders': profiling.call(hooks, aggregations.get_total_orders, data, year=year),
+        'total_customers': profiling.call(hooks, aggregations.get_total_customers, data, year=year),
+        'highest_selling_city': city.title(),
+        'highest_selling_category': category.title().replace("_", " & "),
+    }
+
+def sales_ARPU_chart_name(selection: str, year: int) -> str:
+    """
+    Report chart name of an above/below average chart (a key of SALES_ARPU_CHARTS) for a year
+    """
+    return f"{SALES_ARPU_CHARTS[selection][0]}_{year}"
+
+def build_report(data: dict[str, pd.DataFrame],
+                 years: list[int] = REPORT_YEARS,
+                 hooks: list[profiling.Hook] | None = None) -> dict:
+    """
+    Compute every KPI and chart of the Executive Summary and Main Dashboard in one pass
+    Args:
+        data: dict[str, pd.DataFrame] - The REPORT_COLUMNS tables
+        years: list[int] - Years of the year filter
+        hooks: list[profiling.Hook] | None - Called around each data call
+    Returns:
+        dict - Keys:
+            - kpis: dict[str, dict[str, str]] - get_kpis per year (as a string) and for ALL_YEARS
+            - charts: dict[str, dict] - Vega-Lite spec, with its aggregated data, per chart name
+    Notes:
+        - sales_by_region and each above/below average selection are computed once and
+          sliced per year, the other intermediates are shared through the merges cache
+    """
+    kpis = {ALL_YEARS: get_kpis(data, hooks=hooks)}
+    kpis.update({str(year): get_kpis(data, year, hooks) for year in years})
+
+    sales_by_region = profiling.call(hooks, merges.get_sales_by_region_category, data)
+    sales_by_region = profiling.call(hooks, aggregations.calculate_ARPU, sales_by_region)
+    figures = {
+        'sales_by_region': profiling.call(hooks, charts.get_sales_by_region_category_bubble_chart, sales_by_region),
+        'payment_type': profiling.call(hooks, charts.payment_type_pie_chart, data['order_payment']),
+        'delivery_time': profiling.call(hooks, charts.delivery_time_boxplot_chart, data['order_fact']),
+    }
+    for selection, (_, flags) in SALES_ARPU_CHARTS.items():
+        merged_data = profiling.call(hooks, merges.get_average_sales_ARPU, sales_by_region, data, **flags)
+        for year in years:
+            figures[sales_ARPU_chart_name(selection, year)] = profiling.call(
+                hooks, charts.sales_ARPU_time_chart, merged_data, year=year)
+    return {'kpis': kpis, 'charts': {name: chart.to_dict() for name, chart in figures.items()}}
+
+def save_report(report: dict, versions: tuple, report_dir: Path = REPORT_DIR) -> None:
+    """
+    Write the output of build_report as static files
+
+    Args:
+        report: dict - Output of build_report
+        versions: tuple - data_versions() of the tables the report was built from
+        report_dir: Path - Output directory
+    Notes:
+        - Each chart goes to charts/<name>.json, the KPIs and versions to kpis.json. Files are
+          replaced atomically and kpis.json is written last, so pages only switch to a new report
+          once its charts are in place
+    """
+    (report_dir / CHART_DIR).mkdir(parents=True, exist_ok=True)
+    for name, spec in report['charts'].items():
+        _write_json(spec, report_dir / CHART_DIR / f'{name}.json')
+    index = {'versions': dict(versions), 'kpis': report['kpis'], 'charts': sorted(report['charts'])}
+    _write_json(index, report_dir / KPI_FILE)
+
+def _write_json(value: dict, path: Path) -> None:
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(value, f)
+    os.replace(tmp, path)
+
+def load_report(versions: tuple, report_dir: Path = REPORT_DIR) -> dict | None:
+    """
+    Read the KPI file of a report, if it is up to date
+
+    Args:
+        versions: tuple - data_versions() of the tables a page reads
+        report_dir: Path - Directory written by save_report
+    Returns:
+        dict | None - Keys: versions, kpis, charts (names). None when there is no report or
+            one of the tables changed since it was built
+    """
+    path = report_dir / KPI_FILE
+    if not path.exists():
+        return None
+    with open(path) as f:
+        report = json.load(f)
+    if any(report['versions'].get(key) != version for key, version in versions):
+        return None
+    return report
+
+def load_chart(name: str, report_dir: Path = REPORT_DIR) -> dict:
+    """
+    Vega-Lite spec of a report chart, for st.vega_lite_chart
+    """
+    with open(report_dir / CHART_DIR / f'{name}.json') as f:
+        return json.load(f)
+
+def save_batch_report(fmt: str | None = None,
+                      processed_dir: Path = DATA_PROCESSED_DIR,
+                      report_dir: Path | None = None,
+                      hooks: list[profiling.Hook] | None = None) -> Path:
+    """
+    Build the report from the processed tables and write it
+
+    Args:
+        fmt: str | None - One of PROCESSED_FORMATS, the format the dashboard reads if None
+            (see dataset.served_format)
+        processed_dir: Path - Directory holding the processed tables
+        report_dir: Path | None - Output directory (report/ under processed_dir if None)
+        hooks: list[profiling.Hook] | None - Called around each data call
+    Returns:
+        Path - The report directory
+    """
+    report_dir = report_dir or processed_dir / REPORT_DIR.name
+    data = LazyDataset(fmt or served_format(processed_dir), processed_dir).view(REPORT_COLUMNS)
+    save_report(build_report(data, hooks=hooks), data.data_versions(), report_dir)
+    return report_dir
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write the dashboard KPIs and chart specs of data/processed as static files")
+    parser.add_argument('--format', choices=PROCESSED_FORMATS,
+                        help="Format of the tables (default: $OLIST_FORMAT, then the format of the last run)")
+    parser.add_argument('--output', type=Path, help=f"Report directory (default: {REPORT_DIR})")
+    args = parser.parse_args()
+    print(f"Report written to {save_batch_report(fmt=args.format, report_dir=args.output)}")
@@ -0,0 +1,366 @@
+import numpy as np
+import pandas as pd
+
+from app.assets import routes
+
+# Monthly rollup tables built from order_fact, persisted with the processed tables
+ROLLUP_TABLES = ['monthly_rollup', 'monthly_city', 'monthly_category', 'customer_month', 'leaderboard',
+                 'leaderboard_totals', 'route_stats']
+# Entries kept per leaderboard slice
+LEADERBOARD_K = 10
+# Leaderboard dimensions and the fact_partials entry they rank by
+LEADERBOARD_DIMENSIONS = {'city': 'city_lines', 'category_name': 'category_sales'}
+
+def build_rollups(df_fact: pd.DataFrame, df_customer: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    """
+    Aggregate the order fact table by purchase month
+
+    Args:
+        df_fact: pd.DataFrame - order_fact table
+        df_customer: pd.DataFrame - customer table (customers with payments)
+    Returns:
+        dict[str, pd.DataFrame]
+            Data:
+                - monthly_rollup: purchase_month, revenue, order_count, customer_count, lines (order lines)
+                - monthly_city: purchase_month, city, order_count (order lines)
+                - monthly_category: purchase_month, category_name, sales, lines
+                - customer_month: purchase_month, customer_key, one row per customer and month
+                  with a kept order (see customer_keys)
+                - leaderboard: dimension, year, region, rank, label, value (see build_leaderboard)
+                - leaderboard_totals: dimension, year, region, label, lines, value, the totals
+                  ranked by the leaderboard, for every label
+                - route_stats: delivery time and distance per seller state and customer state
+                  (see routes.finish_route_stats)
+    Notes:
+        - Order lines of orders dropped by impute_order_delivery have no purchase month, their
+          revenue and sales are kept under a NaT month so all-time totals stay exact
+        - Customers without a delivered or unavailable order are counted under the NaT month
+        - The tables keep the counts and sums their partials are rebuilt from (see
+          stored_partials), so update_rollups can merge changed rows into them
+    """
+    kept = df_fact[df_fact['order_status'].notna()]
+    pairs = customer_months(kept[['customer_id', 'purchase_month']], df_customer['customer_id'])
+    return finish_rollups(fact_partials(df_fact), customer_partials(pairs))
+
+def fact_partials(df_fact: pd.DataFrame) -> dict[str, pd.Series]:
+    """
+    Mergeable monthly aggregates of order_fact rows, see merge_partials
+
+    Args:
+        df_fact: pd.DataFrame - order_fact rows. Partials merged together must hold disjoint orders
+    Returns:
+        dict[str, pd.Series | pd.DataFrame] - month (lines, revenue, order_count), monthly_city
+            (order lines) and monthly_category (lines, sales), indexed by purchase_month (and city
+            or category_name), city_lines (order lines) and category_sales (lines, value) indexed
+            by year, region and city or category_name, route (see routes.route_partials)
+    Notes:
+        - Every entry counts its lines, merged groups left without lines are dropped by finish_rollups
+    """
+    kept = df_fact[df_fact['order_status'].notna()]
+    years, kept_years = df_fact['purchase_month'].dt.year.rename('year'), kept['purchase_month'].dt.year.rename('year')
+    month = df_fact.groupby('purchase_month', dropna=False)['price'].agg(lines='size', revenue='sum')
+    order_count = kept.groupby('purchase_month')['order_id'].nunique()
+    month['order_count'] = order_count.reindex(month.index, fill_value=0)
+    return {
+        'month': month,
+        'monthly_city': kept.groupby(['purchase_month', 'city'], observed=True).size().rename('order_count'),
+        'monthly_category': (df_fact
+                             .groupby(['purchase_month', 'category_name'], dropna=False, observed=True)['price']
+                             .agg(lines='size', sales='sum')),
+        'city_lines': (kept
+                       .groupby([kept_years, kept['region'], kept['city']], dropna=False, observed=True)
+                       .size()
+                       .rename('value')),
+        'category_sales': (df_fact
+                           .groupby([years, df_fact['region'], df_fact['category_name']], dropna=False, observed=True)['price']
+                           .agg(lines='size', value='sum')),
+        'route': routes.route_partials(df_fact),
+    }
+
+def customer_months(pairs: pd.DataFrame, customer_ids: pd.Series) -> pd.DataFrame:
+    """
+    Distinct customers of each purchase month, restricted to the customer table
+
+    Args:
+        pairs: pd.DataFrame - customer_id, purchase_month of kept order lines, may repeat
+        customer_ids: pd.Series - customer_id of the customer table
+    Returns:
+        pd.DataFrame - customer_id, purchase_month. Customers without any pair get a NaT month
+    """
+    pairs = pairs[['customer_id', 'purchase_month']].drop_duplicates()
+    pairs = pairs[pairs['customer_id'].isin(customer_ids)]
+    unattributed = customer_ids[~customer_ids.isin(pairs['customer_id'])].to_frame('customer_id')
+    return pd.concat([pairs, unattributed.assign(purchase_month=pd.NaT)], ignore_index=True)
+
+def customer_partials(pairs: pd.DataFrame) -> dict[str, pd.Series | pd.DataFrame]:
+    """
+    Mergeable monthly customer aggregates, see merge_partials
+
+    Args:
+        pairs: pd.DataFrame - Output of customer_months. Partials merged together must hold disjoint customers
+    Returns:
+        dict[str, pd.Series | pd.DataFrame] - customer_count by purchase_month and customer_month
+    """
+    return {
+        'customer_count': pairs.groupby('purchase_month', dropna=False)['customer_id'].nunique().rename('customer_count'),
+        'customer_month': pd.DataFrame({'purchase_month': pairs['purchase_month'].to_numpy(),
+                                        'customer_key': customer_keys(pairs['customer_id'])}),
+    }
+
+def customer_keys(customer_ids: pd.Series) -> np.ndarray:
+    """
+    64-bit hash of each customer_id, stable across runs and partitions
+
+    Distinct customers of any set of months are counted exactly as distinct keys: at Olist
+    scale a collision between two of 100 million customers has a probability under 1e-3.
+
+    Returns:
+        np.ndarray - int64 keys (the uint64 hash reinterpreted, so every format stores them)
+    """
+    return pd.util.hash_pandas_object(customer_ids, index=False).to_numpy().view('int64')
+
+def merge_partials(partials: list[dict]) -> dict:
+    """
+    Merge outputs of fact_partials or of customer_partials
+
+    Counts and sums add up, customer_month pairs are concatenated and route partials are
+    merged by routes.merge_route_partials.
+    """
+    merged = {}
+    for key in partials[0]:
+        values = [partial[key] for partial in partials]
+        if key == 'customer_month':
+            merged[key] = pd.concat(values, ignore_index=True)
+        elif key == 'route':
+            merged[key] = routes.merge_route_partials(values)
+        else:
+            levels = list(range(values[0].index.nlevels))
+            merged[key] = pd.concat(values).groupby(level=levels, dropna=False, observed=True).sum()
+    return merged
+
+def negate_partials(partials: dict) -> dict:
+    """
+    Partials cancelling outputs of fact_partials, merged in to remove order_fact rows
+
+    Counts and sums change sign, route delivery means are kept (routes.merge_route_partials
+    then removes the rows exactly).
+    """
+    negated = {key: -value for key, value in partials.items()}
+    negated['route']['delivery_mean'] = partials['route']['delivery_mean']
+    return negated
+
+def stored_partials(tables: dict[str, pd.DataFrame]) -> tuple[dict, dict]:
+    """
+    Rebuild merged fact_partials and customer_partials from stored rollup tables
+
+    Args:
+        tables: dict[str, pd.DataFrame] - The ROLLUP_TABLES, as written by finish_rollups
+    Returns:
+        tuple[dict, dict] - fact_partials and customer_partials of every order_fact row and customer
+    Notes:
+        - Groups finish_rollups drops (missing categories and labels) are not stored, merged
+          partials only ever remove rows from them again, so the finished tables are the same
+    """
+    monthly = tables['monthly_rollup'].set_index('purchase_month')
+    totals = tables['leaderboard_totals']
+    dimension_totals = {
+        dimension: (totals[totals['dimension'] == dimension]
+                    .set_index(['year', 'region', 'label'])
+                    .rename_axis(['year', 'region', dimension])[['lines', 'value']])
+        for dimension in LEADERBOARD_DIMENSIONS
+    }
+    route = tables['route_stats'].set_index(['seller_state', 'state'])
+    fact = {
+        'month': monthly[['lines', 'revenue', 'order_count']],
+        'monthly_city': tables['monthly_city'].set_index(['purchase_month', 'city'])['order_count'],
+        'monthly_category': tables['monthly_category'].set_index(['purchase_month', 'category_name'])[['lines', 'sales']],
+        'city_lines': dimension_totals['city']['value'],
+        'category_sales': dimension_totals['category_name'],
+        'route': pd.DataFrame({
+            'lines': route['lines'],
+            'delivery_count': route['delivery_count'],
+            'delivery_mean': route['mean_delivery_time'].fillna(0),
+            'delivery_m2': (route['std_delivery_time'] ** 2 * route['delivery_count']).fillna(0),
+            'distance_count': route['distance_count'],
+            'distance_sum': (route['mean_distance_km'] * route['distance_count']).fillna(0),
+        }),
+    }
+    customer = {'customer_count': monthly['customer_count'], 'customer_month': tables['customer_month']}
+    return fact, customer
+
+def update_rollups(tables: dict[str, pd.DataFrame],
+                   removed_fact: pd.DataFrame,
+                   added_fact: pd.DataFrame,
+                   pairs: pd.DataFrame,
+                   customer_ids: pd.Series) -> dict[str, pd.DataFrame]:
+    """
+    Update stored rollup tables for changed order_fact rows and customers, without aggregating order_fact
+
+    The partials of the added rows and the negated partials of the removed rows are merged into
+    those of the stored tables, and the customer_month rows of the changed customers are replaced.
+
+    Args:
+        tables: dict[str, pd.DataFrame] - The ROLLUP_TABLES before the change
+        removed_fact: pd.DataFrame - order_fact rows replaced or deleted
+        added_fact: pd.DataFrame - order_fact rows replacing them or new
+        pairs: pd.DataFrame - Output of customer_months for the changed customers, from all their kept lines
+        customer_ids: pd.Series - The changed customers, in the customer table or not. Must include
+            the customers of removed_fact and added_fact
+    Returns:
+        dict[str, pd.DataFrame] - The updated tables, as build_rollups gives on the changed order_fact
+    """
+    fact, customer = stored_partials(tables)
+    fact = merge_partials([fact, fact_partials(added_fact), negate_partials(fact_partials(removed_fact))])
+
+    replaced = customer['customer_month']['customer_key'].isin(customer_keys(customer_ids))
+    added = customer_partials(pairs)
+    removed_count = customer['customer_month'][replaced].groupby('purchase_month', dropna=False).size()
+    customer = {
+        'customer_count': (pd.concat([customer['customer_count'], added['customer_count'], -removed_count])
+                           .groupby(level=0, dropna=False)
+                           .sum()),
+        'customer_month': pd.concat([customer['customer_month'][~replaced], added['customer_month']], ignore_index=True),
+    }
+    return finish_rollups(fact, customer)
+
+def finish_rollups(fact: dict[str, pd.Series | pd.DataFrame],
+                   customer: dict[str, pd.Series | pd.DataFrame]) -> dict[str, pd.DataFrame]:
+    """
+    Build the rollup tables from (merged) fact_partials and customer_partials
+
+    Returns:
+        dict[str, pd.DataFrame] - See build_rollups
+    """
+    month = fact['month'][fact['month']['lines'] != 0]
+    customer_count = customer['customer_count'][customer['customer_count'] != 0]
+    monthly_rollup = pd.concat([month['revenue'], month['order_count'], customer_count.rename('customer_count'),
+                                month['lines']], axis=1).fillna(0).rename_axis('purchase_month').reset_index()
+    monthly_rollup = monthly_rollup.astype({'order_count': 'int64', 'customer_count': 'int64', 'lines': 'int64'})
+
+    monthly_city = fact['monthly_city'][fact['monthly_city'] != 0].reset_index()
+    monthly_category = fact['monthly_category'][fact['monthly_category']['lines'] != 0].reset_index()
+    monthly_category = monthly_category[monthly_category['category_name'].notna()]
+
+    city_lines = fact['city_lines'][fact['city_lines'] != 0]
+    totals = {'city': pd.DataFrame({'lines': city_lines, 'value': city_lines}),
+              'category_name': fact['category_sales'][fact['category_sales']['lines'] != 0]}
+
+    return {
+        'monthly_rollup': monthly_rollup.sort_values('purchase_month', ignore_index=True),
+        'monthly_city': monthly_city,
+        'monthly_category': monthly_category[['purchase_month', 'category_name', 'sales', 'lines']].reset_index(drop=True),
+        'customer_month': (customer['customer_month']
+                           .sort_values(['purchase_month', 'customer_key'], ignore_index=True)),
+        'leaderboard': build_leaderboard({dimension: frame['value'] for dimension, frame in totals.items()}),
+        'leaderboard_totals': leaderboard_totals(totals),
+        'route_stats': routes.finish_route_stats(fact['route']),
+    }
+
+def leaderboard_totals(totals: dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """
+    Every total ranked by build_leaderboard, the leaderboard is rebuilt from them on updates
+
+    Args:
+        totals: dict[str, pd.DataFrame] - Per dimension, lines and value indexed by year, region and label
+    Returns:
+        pd.DataFrame - Columns: dimension, year, region, label, lines, value. Missing labels are left out
+    """
+    frames = []
+    for dimension, frame in totals.items():
+        frame = frame[frame.index.get_level_values(dimension).notna()]
+        frames.append(frame.reset_index().rename(columns={dimension: 'label'}).assign(dimension=dimension))
+    table = pd.concat(frames, ignore_index=True)
+    table['label'] = table['label'].astype(object)
+    table = table.astype({'year': 'float64', 'region': object, 'lines': 'int64', 'value': 'float64'})
+    table = table[['dimension', 'year', 'region', 'label', 'lines', 'value']]
+    return table.sort_values(['dimension', 'year', 'region', 'label'], ignore_index=True)
+
+def build_leaderboard(totals: dict[str, pd.Series], k: int = LEADERBOARD_K) -> pd.DataFrame:
+    """
+    Top k labels of each dimension, over all years and regions, per year, per region and per year and region
+
+    Args:
+        totals: dict[str, pd.Series] - Per dimension, values indexed by year, region and label
+            (city_lines and category_sales of fact_partials)
+        k: int - Labels kept per slice
+    Returns:
+        pd.DataFrame - Columns: dimension, year, region, rank, label, value
+            Data:
+                - year, region: NaN for the slices over all years or all regions
+                - rank: 1 for the highest value, ties are ranked by label
+    Notes:
+        - Missing years (orders without a purchase month) and regions only count in the slices
+          over all years and all regions, missing labels are not ranked
+        - Each slice keeps its k largest values by partial selection (top_k), the groups are
+          never fully sorted
+    """
+    slices = []
+    for dimension, values in totals.items():
+        values = values[values.index.get_level_values(dimension).notna()]
+        for by in ([], ['year'], ['region'], ['year', 'region']):
+            slice_totals = values.groupby(level=[*by, dimension], observed=True).sum()
+            keys = slice_totals.index.to_frame(index=False)
+            # Rows of each slice, rows with a missing year or region only count in the wider slices
+            groups = keys.groupby(by, observed=True).indices.values() if by else [np.arange(len(keys))]
+            # Labels are sorted within a slice, so ties are ranked by label
+            top = [np.empty(0, dtype='int64')] + [positions[top_k(slice_totals.to_numpy()[positions], k)]
+                                                  for positions in groups]
+            ranks = [np.arange(1, len(positions) + 1) for positions in top]
+            top = np.concatenate(top)
+            slices.append(keys.iloc[top].rename(columns={dimension: 'label'})
+                          .assign(dimension=dimension, rank=np.concatenate(ranks), value=slice_totals.to_numpy()[top]))
+    leaderboard = pd.concat(slices, ignore_index=True)
+    for col in ['year', 'region']:
+        if col not in leaderboard:
+            leaderboard[col] = np.nan
+    leaderboard['label'] = leaderboard['label'].astype(object)
+    leaderboard = leaderboard.astype({'year': 'float64', 'region': object, 'rank': 'int64', 'value': 'float64'})
+    return leaderboard[['dimension', 'year', 'region', 'rank', 'label', 'value']]
+
+def top_k(values: np.ndarray, k: int) -> np.ndarray:
+    """
+    Positions of the k largest values, largest first, ties by position
+
+    Only the values tied with or above the k-th largest are sorted (np.partition finds it).
+    """
+    if len(values) > k:
+        threshold = np.partition(values, len(values) - k)[len(values) - k]
+        candidates = np.flatnonzero(values >= threshold)
+    else:
+        candidates = np.arange(len(values))
+    return candidates[np.lexsort((candidates, -values[candidates]))][:k]
+
+def month_mask(months: pd.Series,
+               year: int | list[int] | None = None,
+               start: str | pd.Timestamp | None = None,
+               end: str | pd.Timestamp | None = None) -> pd.Series:
+    """
+    Select rollup rows by purchase month
+
+    Args:
+        months: pd.Series - purchase_month column of a rollup table
+        year: int | list[int] | None - Purchase year(s)
+        start: str | pd.Timestamp | None - First month, inclusive
+        end: str | pd.Timestamp | None - Last month, inclusive
+    Returns:
+        pd.Series - Boolean mask. Every row, including the NaT month, when no filter is given
+    """
+    mask = pd.Series(True, index=months.index)
+    if year is None and start is None and end is None:
+        return mask
+    mask &= months.notna()
+    if year is not None:
+        mask &= months.dt.year.isin([year] if isinstance(year, int) else year)
+    if start is not None:
+        mask &= months >= pd.Timestamp(start).to_period('M').to_timestamp()
+    if end is not None:
+        mask &= months <= pd.Timestamp(end).to_period('M').to_timestamp()
+    return mask
+
+def is_filtered(year: int | list[int] | None = None,
+                start: str | pd.Timestamp | None = None,
+                end: str | pd.Timestamp | None = None) -> bool:
+    """
+    Whether month_mask would filter anything
+    """
+    return year is not None or start is not None or end is not None
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+
+from app.assets import dimensions
+
+# Mean Earth radius (IUGG)
+EARTH_RADIUS_KM = 6371.0088
+
+def haversine_km(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    """
+    Great-circle distance between two arrays of points
+
+    Args:
+        lat1, lon1, lat2, lon2: np.ndarray - Coordinates in degrees, NaN for unknown points
+    Returns:
+        np.ndarray - Distance in kilometres, NaN where a point is unknown
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(values, dtype='float64')) for values in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def add_route_features(df_fact: pd.DataFrame, seller_zips: pd.Series, zip_dim: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add the seller to customer route of each order line, in place
+
+    Zip centroids and regions are read from dense lookup arrays indexed by zip code prefix
+    (see dimensions.build_zip_lookup), so there is no merge and no per-row Python.
+
+    Args:
+        df_fact: pd.DataFrame - order_fact rows with zip_code_prefix, state and region of the
+            customer and seller_state
+        seller_zips: pd.Series - Zip code prefix of the seller of each row
+        zip_dim: pd.DataFrame - Output of dimensions.build_zip_dimension
+    Returns:
+        pd.DataFrame - The same table with:
+            - distance_km: haversine distance between the seller and customer zip centroids, NaN
+              when either zip is unknown
+            - cross_state, cross_region: seller and customer in different states or regions,
+              False when either is unknown
+    """
+    latitude = dimensions.build_zip_lookup(zip_dim, 'latitude')
+    longitude = dimensions.build_zip_lookup(zip_dim, 'longitude')
+    customer_zips = df_fact['zip_code_prefix']
+    df_fact['distance_km'] = haversine_km(dimensions.lookup_zips(seller_zips, latitude),
+                                          dimensions.lookup_zips(seller_zips, longitude),
+                                          dimensions.lookup_zips(customer_zips, latitude),
+                                          dimensions.lookup_zips(customer_zips, longitude))
+
+    seller_regions = dimensions.zip_to_region(seller_zips, zip_dim)
+    df_fact['cross_state'] = _differ(df_fact['seller_state'], df_fact['state'])
+    df_fact['cross_region'] = _differ(seller_regions, df_fact['region'])
+    return df_fact
+
+def _differ(left, right) -> np.ndarray:
+    left, right = pd.Categorical(left), pd.Categorical(right)
+    if not left.categories.equals(right.categories):
+        right = right.set_categories(left.categories.union(right.categories))
+        left = left.set_categories(right.categories)
+    # Codes over shared categories, -1 for missing labels
+    return (left.codes >= 0) & (right.codes >= 0) & (left.codes != right.codes)
+
+def route_partials(df_fact: pd.DataFrame) -> pd.DataFrame:
+    """
+    Mergeable delivery aggregates per route (seller state to customer state), see merge_route_partials
+
+    Returns:
+        pd.DataFrame - Indexed by seller_state, state. Columns: lines, delivery_count,
+            delivery_mean, delivery_m2 (sum of squared deviations from delivery_mean),
+            distance_count, distance_sum
+    """
+    delivery = df_fact['delivery_time'].astype('float64')
+    distance = df_fact['distance_km'].astype('float64')
+    # Deviations from the mean of each route, squared and summed in a second pass
+    mean = delivery.groupby([df_fact['seller_state'], df_fact['state']], observed=True).transform('mean')
+    frame = pd.DataFrame({
+        'seller_state': df_fact['seller_state'],
+        'state': df_fact['state'],
+        'lines': 1,
+        'delivery_count': delivery.notna().astype('int64'),
+        'delivery_mean': delivery,
+        'delivery_m2': (delivery - mean) ** 2,
+        'distance_count': distance.notna().astype('int64'),
+        'distance_sum': distance.fillna(0),
+    })
+    partial = frame.groupby(['seller_state', 'state'], observed=True).agg({
+        'lines': 'sum', 'delivery_count': 'sum', 'delivery_mean': 'mean', 'delivery_m2': 'sum',
+        'distance_count': 'sum', 'distance_sum': 'sum',
+    })
+    partial['delivery_mean'] = partial['delivery_mean'].fillna(0)
+    return partial
+
+def merge_route_partials(partials: list[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Merge outputs of route_partials, see rollups.merge_partials
+
+    Counts and sums add up. Delivery means and squared deviations are combined pairwise with
+    Chan's formula, so the variance never comes from a difference of large sums.
+    """
+    merged = partials[0]
+    for partial in partials[1:]:
+        index = merged.index.union(partial.index)
+        left, right = merged.reindex(index, fill_value=0), partial.reindex(index, fill_value=0)
+        merged = left + right
+        count = merged['delivery_count'].where(merged['delivery_count'] != 0)
+        delta = right['delivery_mean'] - left['delivery_mean']
+        merged['delivery_mean'] = (left['delivery_mean'] + delta * right['delivery_count'] / count).fillna(0)
+        merged['delivery_m2'] = (left['delivery_m2'] + right['delivery_m2']
+                                 + (delta ** 2 * left['delivery_count'] * right['delivery_count'] / count).fillna(0))
+    return merged
+
+def finish_route_stats(partial: pd.DataFrame) -> pd.DataFrame:
+    """
+    Build the route_stats table from (merged) route_partials
+
+    Returns:
+        pd.DataFrame - One row per route with order lines, sorted by origin and destination
+            Columns: seller_state, state, lines, delivery_count, mean_delivery_time,
+            std_delivery_time (population), distance_count, mean_distance_km, cross_state
+    """
+    partial = partial[partial['lines'] > 0]
+    count = partial['delivery_count'].where(partial['delivery_count'] > 0)
+    stats = pd.DataFrame({
+        'lines': partial['lines'].astype('int64'),
+        'delivery_count': partial['delivery_count'].astype('int64'),
+        'mean_delivery_time': partial['delivery_mean'].where(count.notna()),
+        # Partials with removed rows (see rollups.negate_partials) can round just below zero
+        'std_delivery_time': np.sqrt(partial['delivery_m2'].clip(lower=0) / count),
+        'distance_count': partial['distance_count'].astype('int64'),
+        'mean_distance_km': partial['distance_sum'] / partial['distance_count'].where(partial['distance_count'] > 0),
+    }).reset_index()
+    stats['cross_state'] = _differ(stats['seller_state'], stats['state'])
+    return stats.sort_values(['seller_state', 'state'], ignore_index=True)
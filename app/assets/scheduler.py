@@ -0,0 +1,231 @@
+import hashlib
+import inspect
+import os
+import pickle
+import types
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+import pandas as pd
+
+from app.assets import cache, engines, profiling
+
+class Step(NamedTuple):
+    """
+    A pipeline step and the tables it reads and writes
+
+    func takes the dict of its input tables and returns a dict holding its output tables.
+    A step may modify its inputs in place, as long as every table it modifies is an output.
+    """
+    func: Callable[[dict], dict]
+    inputs: tuple[str, ...]
+    outputs: tuple[str, ...]
+
+    @property
+    def name(self) -> str:
+        return self.func.__name__
+
+def dependencies(steps: list[Step]) -> dict[str, set[str]]:
+    """
+    Steps each step must wait for, so the DAG computes what running the steps in order does
+
+    Args:
+        steps: list[Step] - In sequential order
+    Returns:
+        dict[str, set[str]] - Per step name, the earlier steps that write one of its inputs or
+            outputs, or read one of its outputs (steps modify tables in place)
+    """
+    writer: dict[str, str] = {}
+    readers: dict[str, set[str]] = {}
+    deps = {}
+    for step in steps:
+        deps[step.name] = {writer[key] for key in (*step.inputs, *step.outputs) if key in writer}
+        deps[step.name].update(name for key in step.outputs for name in readers.get(key, ()))
+        deps[step.name].discard(step.name)
+        for key in step.inputs:
+            readers.setdefault(key, set()).add(step.name)
+        for key in step.outputs:
+            writer[key] = step.name
+            readers[key] = set()
+    return deps
+
+def code_version(func: Callable) -> str:
+    """
+    Hash of the source of a step, with the functions and constants of its module it uses and
+    the app modules it calls into
+    """
+    digest = hashlib.sha1()
+    seen = set()
+    pending = [func]
+    while pending:
+        current = pending.pop()
+        if current.__name__ in seen:
+            continue
+        seen.add(current.__name__)
+        digest.update(inspect.getsource(current).encode())
+        for name in sorted(set(current.__code__.co_names)):
+            value = current.__globals__.get(name)
+            if isinstance(value, types.ModuleType) and value.__name__.startswith('app.'):
+                digest.update(Path(value.__file__).read_bytes())
+            elif isinstance(value, types.FunctionType) and value.__module__ == func.__module__:
+                pending.append(value)
+            elif isinstance(value, (dict, list, tuple, str, int, float)):
+                digest.update(repr(value).encode())
+    return digest.hexdigest()
+
+class StepCache:
+    """
+    Outputs of the steps on disk, keyed on the step code, the engine and the input table versions
+
+    A raw table's version is its content hash, an output's version derives from the key of
+    the step that produced it, so only the raw tables are hashed. Each step keeps its latest entry.
+
+    Args:
+        cache_dir: Path - Directory of the entries, <step>/<key>.pkl
+    """
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+        self.versions: dict[str, str] = {}
+
+    def add_tables(self, data: dict[str, pd.DataFrame], versions: dict[str, str] | None = None) -> None:
+        """
+        Version the tables not produced by a step (raw tables), content hashed unless in versions
+        """
+        versions = versions or {}
+        for key, df in data.items():
+            self.versions[key] = versions.get(key) or cache.frame_hash(df)
+
+    def key(self, step: Step) -> str:
+        digest = hashlib.sha1(f'{step.name}:{code_version(step.func)}:{engines.get_engine().name}'.encode())
+        for table in step.inputs:
+            digest.update(f'{table}:{self.versions.get(table)}'.encode())
+        return digest.hexdigest()
+
+    def path(self, step: Step, key: str) -> Path:
+        return self.cache_dir / step.name / f'{key}.pkl'
+
+    def load(self, step: Step, key: str) -> dict:
+        with open(self.path(step, key), 'rb') as f:
+            return pickle.load(f)
+
+    def record(self, step: Step, key: str) -> None:
+        """
+        Version the outputs of a step run or loaded with this key, and drop its older entries
+        """
+        for table in step.outputs:
+            self.versions[table] = hashlib.sha1(f'{key}:{table}'.encode()).hexdigest()
+        for path in self.path(step, key).parent.glob('*.pkl'):
+            if path.stem != key:
+                path.unlink()
+
+def run_dag(steps: list[Step],
+            data: dict,
+            max_workers: int | None = None,
+            use_processes: bool = False,
+            hooks: list[profiling.Hook] | None = None,
+            cache_dir: Path | None = None,
+            versions: dict[str, str] | None = None) -> dict:
+    """
+    Run steps as a DAG, each step as soon as the steps it depends on are done
+
+    Args:
+        steps: list[Step] - In sequential order, see dependencies
+        data: dict - Input tables
+        max_workers: int | None - Steps run at the same time, the CPU count if None. With 1
+            the steps run in order in the calling thread
+        use_processes: bool - Run the steps in a process pool instead of a thread pool. Input
+            tables are pickled to the workers and outputs back
+        hooks: list[profiling.Hook] | None - Called around each step, from the calling thread:
+            with several workers, when the step is submitted and when it is done
+        cache_dir: Path | None - Reuse step outputs cached there when the inputs and code of the
+            step are unchanged (see StepCache)
+        versions: dict[str, str] | None - Versions of input tables for the cache, e.g. from their
+            files. Other tables are content hashed
+    Returns:
+        data: dict - Input and output tables, new tables in the order of the steps producing them
+    Notes:
+        - Cached outputs are only read when a step that runs needs them or nothing replaces them,
+          hooks get no outputs for a cached step
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    step_cache = StepCache(cache_dir) if cache_dir else None
+    if step_cache:
+        step_cache.add_tables(data, versions)
+    deps = dependencies(steps)
+    tables = dict(data)
+    # Tables held by a cache entry not read yet, with the step and key of the entry
+    cached: dict[str, tuple[Step, str]] = {}
+
+    def read_cached(names) -> None:
+        for step, key in {cached[name] for name in names if name in cached}:
+            outputs = step_cache.load(step, key)
+            for table in [table for table, entry in cached.items() if entry == (step, key)]:
+                tables[table] = outputs[table]
+                del cached[table]
+
+    def finish(step: Step, outputs: dict, key: str | None) -> None:
+        for table in step.outputs:
+            cached.pop(table, None)
+            if table in outputs:
+                tables[table] = outputs[table]
+        if step_cache:
+            step_cache.record(step, key)
+        for hook in reversed(hooks or []):
+            hook.after(step.name, outputs)
+
+    pending = list(steps)
+    running = {}
+    pool = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    executor = pool(max_workers=max_workers) if max_workers > 1 else None
+    try:
+        while pending or running:
+            blocked = {step.name for step in pending} | {step.name for step, _ in running.values()}
+            ready = [step for step in pending if not deps[step.name] & blocked]
+            for step in ready if executor else ready[:1]:
+                pending.remove(step)
+                key = step_cache.key(step) if step_cache else None
+                hit = step_cache is not None and step_cache.path(step, key).exists()
+                if not hit:
+                    read_cached(step.inputs)
+                inputs = {table: tables[table] for table in step.inputs if table in tables}
+                for hook in hooks or []:
+                    hook.before(step.name, inputs)
+                path = step_cache.path(step, key) if step_cache else None
+                if hit:
+                    finish(step, {}, key)
+                    cached.update({table: (step, key) for table in step.outputs})
+                    for table in step.outputs:
+                        tables.pop(table, None)
+                elif executor is None:
+                    finish(step, _run(step.func, inputs, step.outputs, path), key)
+                else:
+                    running[executor.submit(_run, step.func, inputs, step.outputs, path)] = (step, key)
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step, key = running.pop(future)
+                    finish(step, future.result(), key)
+        read_cached(list(cached))
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    # Keep the table order of running the steps in order
+    ordered = dict.fromkeys(data)
+    ordered.update(dict.fromkeys(table for step in steps for table in step.outputs))
+    return {table: tables[table] for table in ordered if table in tables}
+
+def _run(func: Callable[[dict], dict], inputs: dict, outputs: tuple[str, ...], path: Path | None) -> dict:
+    # Cached by the worker, before later steps modify the outputs in place
+    result = func(inputs)
+    result = {table: result[table] for table in outputs if table in result}
+    if path is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    return result
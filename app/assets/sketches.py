@@ -0,0 +1,137 @@
+import numpy as np
+
+# KLL top level capacity and capacity ratio between consecutive levels
+KLL_K = 2048
+KLL_DECAY = 2 / 3
+
+class QuantileSketch:
+    """
+    KLL quantile sketch: a mergeable summary of a stream of values in bounded memory
+
+    Values are kept in levels of compactors, an item of level h standing for 2 ** h values. When
+    a level holds more items than its capacity, its items are sorted and every other one (from
+    a random offset) is promoted to the next level. Capacities shrink by KLL_DECAY per level
+    below the top one, so the sketch holds at most about 3 * k items whatever the number of values.
+
+    Until more than k values were added nothing is compacted and quantiles are exact. Beyond,
+    the rank error of a quantile is about 1.7 / k of the count (under 0.1% with KLL_K).
+    Sketches built on partitions of the values merge into a sketch of all of them.
+
+    Args:
+        k: int - Capacity of the top level
+        seed: int - Seed of the compaction offsets, results are reproducible
+    Raises:
+        ValueError: If k is below 2
+    """
+
+    def __init__(self, k: int = KLL_K, seed: int = 0):
+        if k < 2:
+            raise ValueError(f"Sketch capacity {k} below 2")
+        self.k = k
+        self.levels: list[np.ndarray] = [np.empty(0)]
+        self.min = np.inf
+        self.max = -np.inf
+        self._rng = np.random.default_rng(seed)
+
+    @property
+    def count(self) -> int:
+        """
+        Number of values summarised
+        """
+        return sum(len(items) << level for level, items in enumerate(self.levels))
+
+    def capacity(self, level: int) -> int:
+        return max(int(np.ceil(self.k * KLL_DECAY ** (len(self.levels) - level - 1))), 2)
+
+    def update(self, values: np.ndarray) -> 'QuantileSketch':
+        """
+        Add values (NaN are skipped)
+        """
+        values = np.asarray(values, dtype='float64')
+        values = values[~np.isnan(values)]
+        if len(values):
+            self.min, self.max = min(self.min, values.min()), max(self.max, values.max())
+            self.levels[0] = np.concatenate([self.levels[0], values])
+            self._compress()
+        return self
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        """
+        Add the values summarised by another sketch
+        """
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self._compress()
+        return self
+
+    def quantiles(self, levels: np.ndarray, method: str = 'averaged_inverted_cdf') -> np.ndarray:
+        """
+        Quantiles of the values, as np.percentile(values, levels, method=method)
+
+        Args:
+            levels: np.ndarray - Percentiles, between 0 and 100
+            method: str - 'linear' or 'averaged_inverted_cdf', used as is while the sketch is exact.
+                Once compacted, each quantile is the averaged inverse of the weighted distribution
+        Returns:
+            np.ndarray - One quantile per level, the 0 and 100 percentiles are the exact min and max
+        Raises:
+            ValueError: If the sketch is empty or the method is not supported
+        """
+        if method not in ('linear', 'averaged_inverted_cdf'):
+            raise ValueError(f"Quantile method {method} not in ('linear', 'averaged_inverted_cdf')")
+        if self.count == 0:
+            raise ValueError("No values in the sketch")
+        levels = np.asarray(levels, dtype='float64')
+        if len(self.levels) == 1:
+            return np.percentile(self.levels[0], levels, method=method)
+
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level_items), 1 << level) for level, level_items in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        items, cumulative = items[order], np.cumsum(weights[order])
+        # First item whose cumulative weight reaches the rank, averaged with the next one on a tie
+        ranks = cumulative[-1] * levels / 100
+        first = np.minimum(np.searchsorted(cumulative, ranks, side='left'), len(items) - 1)
+        following = np.minimum(first + 1, len(items) - 1)
+        tie = (cumulative[first] == ranks) & (first < len(items) - 1)
+        result = np.where(tie, (items[first] + items[following]) / 2, items[first])
+        result[levels <= 0] = self.min
+        result[levels >= 100] = self.max
+        return result
+
+    def _compress(self) -> None:
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) <= self.capacity(level):
+                level += 1
+                continue
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            items = np.sort(self.levels[level])
+            # An odd item out stays on this level
+            odd = len(items) % 2
+            promoted = items[odd:][self._rng.integers(2)::2]
+            self.levels[level] = items[:odd]
+            self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            # Capacities of the lower levels shrink with a new top level
+            level = 0
+
+def quantile_bin_edges(sketch: QuantileSketch, n_bins: int, method: str = 'averaged_inverted_cdf') -> np.ndarray:
+    """
+    Quantile bin edges of the values of a sketch, as KBinsDiscretizer(strategy='quantile') fits them
+
+    Returns:
+        np.ndarray - n_bins + 1 edges, bins narrower than 1e-8 removed. [-inf, inf] for constant values
+    Raises:
+        ValueError: If the sketch is empty
+    """
+    if sketch.count == 0:
+        raise ValueError("No values to bin")
+    if sketch.min == sketch.max:
+        # Constant feature, KBinsDiscretizer keeps a single bin
+        return np.array([-np.inf, np.inf])
+    edges = sketch.quantiles(np.linspace(0, 100, n_bins + 1), method)
+    return edges[np.ediff1d(edges, to_begin=np.inf) > 1e-8]
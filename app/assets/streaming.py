@@ -0,0 +1,437 @@
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from app.assets import dimensions, manifest, rollups
+from app.assets.preprocessing import (CATEGORICAL_COLUMNS, DATA_PROCESSED_DIR, DATA_RAW_DIR, DEFAULT_FORMAT,
+                                      DICTIONARY_TABLE, FACT_CUSTOMER_COLUMNS, FACT_ITEM_COLUMNS, FACT_ORDER_COLUMNS,
+                                      FEATHER_COMPRESSION, RAW_FILES,
+                                      STATE_TO_REGION,
+                                      add_date_features, add_delivery_time, add_product_volume, build_order_fact,
+                                      check_format, convert_to_datetime, discretize_spending, fill_delivery_dates,
+                                      merge_product_category, partial_path, rename_columns, spending_bin_edges,
+                                      spending_sketches, write_table)
+
+# Raw tables at order grain, spilled by order_id (customer is spilled by customer_id)
+ORDER_TABLES = ['order', 'order_item', 'order_payment', 'order_review']
+# Raw tables small enough to be processed in memory
+SMALL_TABLES = ['product', 'seller', 'product_category']
+# Processed tables written chunk by chunk
+STREAMED_TABLES = ['geo', 'order', 'order_item', 'order_payment', 'order_review', 'customer', 'unpaid_customer',
+                   'order_customer', 'order_fact']
+# Partitions of each spilled table, every partition is processed in memory
+STREAM_PARTITIONS = 16
+# Raw rows read at a time
+STREAM_CHUNK_ROWS = 500_000
+# Raw row numbers, restore the row order of save_processed_data across partitions
+ROW, ORDER_ROW, ITEM_ROW = '_row', '_order_row', '_item_row'
+
+class Spill:
+    """
+    Tables split into partitions of Parquet files, appended to chunk by chunk
+
+    Args:
+        root: Path - Directory of the files, one subdirectory per table and partition
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.columns: dict[str, list[str]] = {}
+        self._files = 0
+
+    def write(self, name: str, df: pd.DataFrame, partitions: np.ndarray) -> None:
+        """
+        Append the rows of df to their partition (one partition number per row)
+        """
+        self.columns.setdefault(name, list(df.columns))
+        for partition, part in df.groupby(partitions, sort=False):
+            self.put(name, partition, part)
+
+    def put(self, name: str, partition: int, df: pd.DataFrame) -> None:
+        """
+        Append df to a single partition
+        """
+        self.columns.setdefault(name, list(df.columns))
+        directory = self.root / name / str(partition)
+        directory.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(directory / f'{self._files:08d}.parquet', index=False)
+        self._files += 1
+
+    def read(self, name: str, partition: int) -> pd.DataFrame:
+        """
+        Rows of a partition in the order they were written (empty with the table columns if none)
+        """
+        files = sorted((self.root / name / str(partition)).glob('*.parquet'))
+        if not files:
+            return pd.DataFrame(columns=self.columns.get(name, []))
+        return pd.concat([pd.read_parquet(file) for file in files], ignore_index=True)
+
+class TableWriter:
+    """
+    Write a processed table chunk by chunk, to the same file and format as preprocessing.write_table
+
+    CSV chunks are appended to a partial file. Parquet and Feather chunks are written as parts, then
+    merged by close() into the partial file with one schema and CATEGORICAL_COLUMNS dictionary encoded with the
+    sorted categories of the whole table. The labels of the dimension columns written are
+    collected in labels, for the dimension dictionary. close() renames the partial file over path,
+    as write_table does.
+
+    Args:
+        path: Path - Destination file, including the format suffix
+        fmt: str - One of PROCESSED_FORMATS
+        parts_dir: Path - Where the parts are written (Parquet and Feather)
+        batch_rows: int - Rows per batch when merging the parts
+    """
+
+    def __init__(self, path: Path, fmt: str, parts_dir: Path, batch_rows: int = STREAM_CHUNK_ROWS):
+        self.path = path
+        self.fmt = fmt
+        self.parts_dir = parts_dir
+        self.batch_rows = batch_rows
+        self.rows = 0
+        self._columns: list[str] | None = None
+        self._parts: list[Path] = []
+        self.labels = dimensions.dimension_labels([])
+
+    def write(self, df: pd.DataFrame) -> None:
+        if self._columns is None:
+            self._columns = list(df.columns)
+        df = df[self._columns]
+        for col, labels in dimensions.dimension_labels([df]).items():
+            self.labels[col] |= labels
+        if self.fmt == 'csv':
+            df.to_csv(partial_path(self.path), index=False, mode='w' if self.rows == 0 else 'a', header=self.rows == 0)
+        else:
+            # Categoricals are encoded once all categories are known
+            df = df.astype({col: object for col in CATEGORICAL_COLUMNS
+                            if col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype)})
+            self.parts_dir.mkdir(parents=True, exist_ok=True)
+            part = self.parts_dir / f'{len(self._parts):06d}.parquet'
+            df.to_parquet(part, index=False)
+            self._parts.append(part)
+        self.rows += len(df)
+
+    def close(self) -> None:
+        if self.fmt == 'csv':
+            if self._columns is not None:
+                os.replace(partial_path(self.path), self.path)
+            return
+        if not self._parts:
+            return
+        schemas = [pq.read_schema(part).remove_metadata() for part in self._parts]
+        fields = [pa.field(name, _common_type([schema.field(name).type for schema in schemas]))
+                  for name in self._columns]
+        schema = pa.schema(fields)
+
+        # Sorted categories over all parts, as pandas astype('category') gives
+        dictionaries = {}
+        for name in CATEGORICAL_COLUMNS:
+            if name in self._columns and pa.types.is_string(schema.field(name).type):
+                values = set()
+                for part in self._parts:
+                    column = pq.read_table(part, columns=[name]).column(name).cast(pa.string())
+                    values.update(pc.unique(column).drop_null().to_pylist())
+                dictionaries[name] = pa.array(sorted(values), pa.string())
+        final = pa.schema([pa.field(field.name, pa.dictionary(pa.int32(), pa.string()))
+                           if field.name in dictionaries else field for field in schema])
+
+        tmp = partial_path(self.path)
+        if self.fmt == 'parquet':
+            writer = pq.ParquetWriter(tmp, final)
+        else:
+            compression = None if FEATHER_COMPRESSION == 'uncompressed' else FEATHER_COMPRESSION
+            writer = pa.ipc.new_file(tmp, final, options=pa.ipc.IpcWriteOptions(compression=compression))
+        with writer:
+            for part in self._parts:
+                for batch in pq.ParquetFile(part).iter_batches(batch_size=self.batch_rows):
+                    table = pa.Table.from_batches([batch]).select(self._columns).cast(schema)
+                    arrays = []
+                    for name in self._columns:
+                        column = table.column(name).combine_chunks()
+                        if name in dictionaries:
+                            indices = pc.index_in(column, value_set=dictionaries[name])
+                            column = pa.DictionaryArray.from_arrays(indices, dictionaries[name])
+                        arrays.append(column)
+                    writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=final))
+        os.replace(tmp, self.path)
+
+def save_processed_data_streaming(fmt: str = DEFAULT_FORMAT,
+                                  processed_dir: Path = DATA_PROCESSED_DIR,
+                                  raw_dir: Path = DATA_RAW_DIR,
+                                  partitions: int = STREAM_PARTITIONS,
+                                  chunk_rows: int = STREAM_CHUNK_ROWS,
+                                  spill_dir: Path | None = None) -> None:
+    """
+    Run the preprocessing pipeline over raw files larger than memory and write every table to data/processed
+
+    The raw files are read chunk by chunk and spilled to partitioned Parquet files in a temporary
+    directory: order tables by order_id, customers by customer_id and the rows of the delivery
+    imputation by seller zip range. Each partition then goes through the same steps as
+    save_processed_data in memory. The zip dimension, spending bins and monthly rollups are
+    merged from per-chunk or per-partition partial aggregates.
+
+    Args:
+        fmt: str - One of PROCESSED_FORMATS ('csv', 'parquet' or 'feather')
+        processed_dir: Path - Output directory
+        raw_dir: Path - Directory holding the raw Olist files
+        partitions: int - Partitions of each spilled table. Peak memory follows the largest
+            partition, raise it with the size of the raw files
+        chunk_rows: int - Raw rows read at a time
+        spill_dir: Path | None - Parent of the temporary spill directory (system default if None),
+            needs about the size of the raw files free
+    Raises:
+        ValueError: If the format is not supported or partitions < 1
+    Notes:
+        - Writes the same tables and rows as save_processed_data. geo, order, product,
+          seller, product_category, zip and the rollups also keep its row order; order_item,
+          order_payment, order_review, customer, unpaid_customer, order_customer and order_fact
+          are written partition by partition
+        - Sums merged from partials may differ from save_processed_data in the last digits
+        - Spending bin edges come from sketches merged over the partitions, exact up to
+          sketches.KLL_K customers. Beyond, each edge is within 0.1% of the customer count in rank
+          of the exact one, so the customer table can put customers that close to an edge in
+          the neighbouring customer_spending bin
+        - Also writes the manifest of ingested raw rows used by incremental.update_processed_data
+    """
+    check_format(fmt)
+    if partitions < 1:
+        raise ValueError(f"partitions must be at least 1, got {partitions}")
+    processed_dir.mkdir(parents=True, exist_ok=True)
+    print("Processing data (streaming)...")
+
+    with tempfile.TemporaryDirectory(prefix='olist-spill-', dir=spill_dir) as tmp:
+        tmp = Path(tmp)
+        spill = Spill(tmp / 'spill')
+        writers = {key: TableWriter(processed_dir / f'{key}.{fmt}', fmt, tmp / 'parts' / key, chunk_rows)
+                   for key in STREAMED_TABLES}
+
+        offsets = manifest.file_offsets(raw_dir, list(RAW_FILES.values()))
+        data, rows = read_small_tables(raw_dir)
+        print("Streaming geo...")
+        data['zip'], rows['geo'] = stream_geo(raw_dir, writers['geo'], chunk_rows)
+        print("Partitioning orders and customers...")
+        rows.update(partition_raw_tables(raw_dir, spill, partitions, chunk_rows))
+
+        for partition in range(partitions):
+            process_order_partition(partition, spill, data, writers, partitions)
+        for partition in range(partitions):
+            impute_zip_partition(partition, spill, writers['order'])
+        customer_partial = process_customer_partitions(spill, writers['customer'], writers['unpaid_customer'], partitions)
+        fact_partial = None
+        for partition in range(partitions):
+            partial = build_fact_partition(partition, spill, data['zip'], data['seller'], writers['order_fact'])
+            fact_partial = partial if fact_partial is None else rollups.merge_partials([fact_partial, partial])
+        data.update(rollups.finish_rollups(fact_partial, customer_partial))
+        labels = dimensions.dimension_labels(data.values())
+        for writer in writers.values():
+            for col, values in writer.labels.items():
+                labels[col] |= values
+        data[DICTIONARY_TABLE] = dimensions.build_dimension_dictionary(labels)
+
+        for key, value in data.items():
+            print(f"Saving {key}...")
+            write_table(value, processed_dir / f'{key}.{fmt}', fmt)
+        for key, writer in writers.items():
+            print(f"Saving {key}...")
+            writer.close()
+    manifest.write_manifest(manifest.record_batch(manifest.read_manifest(processed_dir), rows, 'full', fmt, offsets),
+                            processed_dir)
+    print("All data saved to data/processed/")
+
+def read_small_tables(raw_dir: Path) -> tuple[dict, dict]:
+    """
+    Read and process product, seller and product_category in memory
+
+    Returns:
+        tuple[dict, dict] - Processed tables and, per table, (raw file name, first row, end row)
+    """
+    data = {key: pd.read_csv(raw_dir / RAW_FILES[key]) for key in SMALL_TABLES}
+    rows = {key: (RAW_FILES[key], 0, len(df)) for key, df in data.items()}
+    return merge_product_category(rename_columns(data)), rows
+
+def stream_geo(raw_dir: Path, writer: TableWriter, chunk_rows: int) -> tuple[pd.DataFrame, tuple[str, int, int]]:
+    """
+    Write the geo table chunk by chunk and build the zip dimension from its partial aggregates
+
+    Returns:
+        tuple[pd.DataFrame, tuple[str, int, int]] - zip dimension, (raw file name, first row, end row)
+    """
+    partial = None
+    for chunk in pd.read_csv(raw_dir / RAW_FILES['geo'], chunksize=chunk_rows):
+        chunk = rename_columns({'geo': chunk})['geo']
+        # As map_states_to_regions
+        chunk['region'] = dimensions.map_labels(chunk['state'], STATE_TO_REGION)
+        writer.write(chunk)
+        chunk_partial = dimensions.zip_dimension_partials(chunk)
+        partial = chunk_partial if partial is None else dimensions.merge_zip_dimension_partials([partial, chunk_partial])
+    return dimensions.finish_zip_dimension(partial), (RAW_FILES['geo'], 0, writer.rows)
+
+def partition_raw_tables(raw_dir: Path, spill: Spill, partitions: int, chunk_rows: int) -> dict:
+    """
+    Spill the raw order tables by order_id and the raw customers by customer_id, numbering the raw rows
+
+    Returns:
+        dict - Per table: (raw file name, first row, end row)
+    """
+    rows = {}
+    for key in [*ORDER_TABLES, 'customer']:
+        column = 'customer_id' if key == 'customer' else 'order_id'
+        start = 0
+        for chunk in pd.read_csv(raw_dir / RAW_FILES[key], chunksize=chunk_rows):
+            chunk = rename_columns({key: chunk})[key]
+            chunk.insert(0, ROW, np.arange(start, start + len(chunk)))
+            start += len(chunk)
+            spill.write(key, chunk, hash_partitions(chunk[column], partitions))
+        rows[key] = (RAW_FILES[key], 0, start)
+    return rows
+
+def process_order_partition(partition: int, spill: Spill, data: dict, writers: dict, partitions: int) -> None:
+    """
+    Run the order steps of the pipeline on one order_id partition
+
+    Writes order_customer, order_item, order_payment and order_review, and spills the inputs of the later stages:
+    per-customer payment sums and requested customers (by customer_id), the rows to impute (by
+    seller zip range) and the order_fact inputs (by order_id).
+    """
+    order = spill.read('order', partition)
+    payments = spill.read('order_payment', partition)
+    steps = {'order': order, 'order_item': spill.read('order_item', partition), 'product': data['product']}
+    for step in [convert_to_datetime, add_date_features, add_delivery_time, add_product_volume]:
+        steps = step(steps)
+    order, items = steps['order'], steps['order_item']
+
+    writers['order_customer'].write(order[['order_id', 'customer_id']])
+    writers['order_item'].write(items.drop(columns=ROW))
+    writers['order_payment'].write(payments.drop(columns=ROW))
+    writers['order_review'].write(spill.read('order_review', partition).drop(columns=ROW))
+
+    # Payment totals of this partition, summed per customer by process_customer_partitions
+    spending = (order[['order_id', 'customer_id']]
+                .merge(payments[['order_id', 'payment_value']], on='order_id')
+                .groupby('customer_id', sort=False)['payment_value']
+                .sum()
+                .reset_index())
+    spill.write('spending', spending, hash_partitions(spending['customer_id'], partitions))
+
+    # Rows of impute_order_delivery, imputed per seller zip by impute_zip_partition
+    order_columns = [col for col in order.columns if col != ROW]
+    mask = order['order_status'].isin(['unavailable', 'delivered'])
+    filled = (order[mask].rename(columns={ROW: ORDER_ROW})
+              .merge(items[['order_id', 'seller_id', ROW]].rename(columns={ROW: ITEM_ROW}), how='left')
+              .merge(data['seller'][['seller_id', 'zip_code_prefix']], how='left'))
+    filled = filled[filled['zip_code_prefix'].notna()]
+    spill.write('delivery', filled[order_columns + ['zip_code_prefix', ORDER_ROW, ITEM_ROW]],
+                zip_partitions(filled['zip_code_prefix'], partitions))
+
+    # Inputs of build_fact_partition
+    kept = order.loc[order['order_id'].isin(filled['order_id']), FACT_ORDER_COLUMNS]
+    spill.put('fact_item', partition, items[FACT_ITEM_COLUMNS])
+    spill.put('fact_order', partition, kept)
+    requests = kept[['customer_id']].drop_duplicates().assign(partition=partition)
+    spill.write('customer_request', requests, hash_partitions(requests['customer_id'], partitions))
+    months = kept[['customer_id', 'purchase_month']].drop_duplicates()
+    spill.write('customer_month', months, hash_partitions(months['customer_id'], partitions))
+
+def impute_zip_partition(partition: int, spill: Spill, writer: TableWriter) -> None:
+    """
+    Impute the delivery dates of one seller zip range and write its processed order rows
+    """
+    filled = spill.read('delivery', partition)
+    if filled.empty:
+        return
+    # Row order of impute_order_delivery: by seller zip, then raw order and item rows
+    filled = filled.sort_values(['zip_code_prefix', ORDER_ROW, ITEM_ROW], kind='stable', ignore_index=True)
+    filled = fill_delivery_dates(filled)
+    writer.write(filled.drop(columns=['zip_code_prefix', ORDER_ROW, ITEM_ROW]))
+
+def process_customer_partitions(spill: Spill, writer: TableWriter, unpaid_writer: TableWriter, partitions: int) -> dict:
+    """
+    Add customer spending, write the customer and unpaid_customer tables, send customers to the order_fact partitions
+    requesting them and aggregate the monthly customer rollups
+
+    Returns:
+        dict - Merged rollups.customer_partials
+    """
+    spending = {}
+    for partition in range(partitions):
+        customer_ids = spill.read('customer', partition)['customer_id']
+        totals = (spill.read('spending', partition)
+                  .groupby('customer_id', sort=False)['payment_value']
+                  .sum()
+                  .reset_index())
+        totals = totals[totals['customer_id'].isin(customer_ids)]
+        spill.put('spending_total', partition, totals)
+        spending = spending_sketches(totals, current=spending)
+
+    bin_edges = spending_bin_edges(spending)
+
+    merged = None
+    for partition in range(partitions):
+        customers = spill.read('customer', partition).drop(columns=ROW)
+        # As map_states_to_regions and add_customer_spending
+        customers['region'] = dimensions.map_labels(customers['state'], STATE_TO_REGION)
+        spending = discretize_spending(spill.read('spending_total', partition), bin_edges)
+        unpaid_writer.write(customers[~customers['customer_id'].isin(spending['customer_id'])])
+        customers = customers.merge(spending, on='customer_id', how='inner')
+        writer.write(customers)
+
+        requests = spill.read('customer_request', partition).merge(customers[FACT_CUSTOMER_COLUMNS], on='customer_id')
+        spill.write('fact_customer', requests.drop(columns='partition'), requests['partition'].to_numpy())
+
+        pairs = rollups.customer_months(spill.read('customer_month', partition), customers['customer_id'])
+        partial = rollups.customer_partials(pairs)
+        merged = partial if merged is None else rollups.merge_partials([merged, partial])
+    return merged
+
+def build_fact_partition(partition: int, spill: Spill, zip_dim: pd.DataFrame, seller: pd.DataFrame,
+                         writer: TableWriter) -> dict:
+    """
+    Build and write the order_fact rows of one order_id partition
+
+    Returns:
+        dict - rollups.fact_partials of the rows
+    """
+    fact = build_order_fact({
+        'order_item': spill.read('fact_item', partition),
+        'order': spill.read('fact_order', partition),
+        'customer': spill.read('fact_customer', partition),
+        'order_payment': spill.read('order_payment', partition),
+        'order_review': spill.read('order_review', partition),
+        'seller': seller,
+        'zip': zip_dim,
+    })['order_fact']
+    writer.write(fact)
+    return rollups.fact_partials(fact)
+
+def hash_partitions(keys: pd.Series, partitions: int) -> np.ndarray:
+    """
+    Partition of each key, the same in every chunk
+    """
+    hashes = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+    return (hashes % np.uint64(partitions)).astype('int64')
+
+def zip_partitions(zips: pd.Series, partitions: int) -> np.ndarray:
+    """
+    Partition of each zip code prefix, by range so partitions hold ascending zips
+    """
+    zips = zips.to_numpy('int64')
+    return np.clip(zips * partitions // dimensions.ZIP_PREFIX_MAX, 0, partitions - 1)
+
+def _common_type(types: list[pa.DataType]) -> pa.DataType:
+    """
+    Arrow type holding a column whose type varies between chunks (e.g. all-null or int chunks)
+    """
+    types = [t for t in types if not pa.types.is_null(t)]
+    if not types:
+        return pa.null()
+    if all(t == types[0] for t in types):
+        return types[0]
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+        return pa.float64()
+    return pa.string()
@@ -0,0 +1,139 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from streamlit import cache_resource
+
+from app.assets import aggregations, merges, reports
+from app.assets.dataset import LazyDataset, Snapshot, get_dataset
+
+# Set to 0 to compute every page result on demand
+WARMUP_ENV = 'OLIST_WARMUP'
+# Warm-up tasks running at the same time
+WARMUP_WORKERS = 2
+
+def enabled() -> bool:
+    """
+    Whether the dashboard pages should warm the results cache in the background (on unless OLIST_WARMUP=0)
+    """
+    return os.environ.get(WARMUP_ENV, '1') not in ('', '0')
+
+def warm_tasks(snapshot: Snapshot) -> list[tuple[str, Callable[[], object]]]:
+    """
+    The data calls of every widget value of the pages, as (name, call) pairs
+
+    Pages with an up to date report (see reports.load_report) read their KPIs and charts
+    from it and are skipped. Each call goes through the merges/aggregations cache with a
+    view of the same tables and columns as the page, so a page rerun finds its results there.
+
+    Args:
+        snapshot: Snapshot - The data version to warm
+    Returns:
+        list[tuple[str, Callable]] - The tables of the pages first, then the KPIs and charts
+    """
+    tasks = []
+    for page, columns in reports.PAGE_COLUMNS.items():
+        view = snapshot.view(columns)
+        if reports.load_report(view.data_versions()) is not None:
+            continue
+        tasks += [(f'{page}:{key}', lambda view=view, key=key: view[key]) for key in columns]
+        if page == 'executive_summary':
+            tasks.append((f'{page}:kpis', lambda view=view: reports.get_kpis(view)))
+            continue
+        tasks += [(f'{page}:kpis_{year}', lambda view=view, year=year: reports.get_kpis(view, year))
+                  for year in reports.REPORT_YEARS]
+        tasks.append((f'{page}:sales_ARPU', lambda view=view: _warm_sales_ARPU(view)))
+    return tasks
+
+def _warm_sales_ARPU(data) -> None:
+    sales_by_region = merges.get_sales_by_region_category(data)
+    sales_by_region = aggregations.calculate_ARPU(sales_by_region)
+    for _, flags in reports.SALES_ARPU_CHARTS.values():
+        merges.get_average_sales_ARPU(sales_by_region, data, **flags)
+
+class Warmer:
+    """
+    Computes the results of every page in a background thread pool, once per data version
+
+    ensure_started() starts a round for the current snapshot of the dataset, unless one already
+    ran or runs for it. Pages do not wait for it: a rerun asking for a result the round has not
+    computed yet computes it on demand, as without warm-up. Safe to share between sessions.
+
+    Args:
+        dataset: LazyDataset - The dataset the pages read
+        max_workers: int - Tasks running at the same time
+    """
+
+    def __init__(self, dataset: LazyDataset, max_workers: int = WARMUP_WORKERS):
+        self.dataset = dataset
+        self.max_workers = max_workers
+        self.version: str | None = None
+        # None until the tasks of the round are listed
+        self.total: int | None = None
+        self.done = 0
+        self.failed: list[str] = []
+        self._lock = threading.Lock()
+
+    def ensure_started(self) -> bool:
+        """
+        Start warming the current data version if it is not already
+
+        Returns:
+            bool - Whether a new round was started
+        """
+        snapshot = self.dataset.snapshot()
+        with self._lock:
+            if snapshot.version == self.version:
+                return False
+            self.version = snapshot.version
+            self.done = 0
+            self.failed = []
+            self.total = None
+        thread = threading.Thread(target=self._run, args=(snapshot,), name='olist-warmup', daemon=True)
+        thread.start()
+        return True
+
+    def progress(self) -> dict:
+        """
+        State of the current round
+
+        Returns:
+            dict - Keys: version, done, total (None while listing the tasks), failed (task names),
+                ready (every task ran)
+        """
+        with self._lock:
+            return {'version': self.version, 'done': self.done, 'total': self.total,
+                    'failed': list(self.failed), 'ready': self.total is not None and self.done >= self.total}
+
+    def _run(self, snapshot: Snapshot) -> None:
+        tasks = warm_tasks(snapshot)
+        with self._lock:
+            if snapshot.version != self.version:
+                return
+            self.total = len(tasks)
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='olist-warmup') as executor:
+            for name, task in tasks:
+                executor.submit(self._run_task, snapshot.version, name, task)
+
+    def _run_task(self, version: str, name: str, task: Callable[[], object]) -> None:
+        # A newer round took over, its pages no longer read this version
+        if version != self.version:
+            return
+        try:
+            task()
+            failed = False
+        except Exception:
+            failed = True
+        with self._lock:
+            if version == self.version:
+                self.done += 1
+                if failed:
+                    self.failed.append(name)
+
+@cache_resource
+def get_warmer(fmt: str | None = None) -> Warmer:
+    """
+    The Warmer of the dataset shared by every page and session of the Streamlit server, see get_dataset
+    """
+    return Warmer(get_dataset(fmt))
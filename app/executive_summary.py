@@ -5,16 +5,26 @@ import sys
 PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 
-from app.assets.preprocessing import load_processed_data_streamlit
-from app.assets import aggregations, merges
+from app.assets.dataset import get_dataset, served_format
+from app.assets import profiling, reports, warmup
+
+# Tables and columns used by this page, loaded on first access
+PAGE_COLUMNS = reports.PAGE_COLUMNS['executive_summary']
 
 # Load data for summary metrics
-data = load_processed_data_streamlit()
-total_revenue = aggregations.get_total_revenue(data)
-total_orders = aggregations.get_total_orders(data)
-total_customers = aggregations.get_total_customers(data)
-highest_selling_city = merges.get_highest_selling_cities(data).head(1).index[0].title()
-highest_selling_category = merges.get_highest_selling_categories(data).head(1).index[0].title().replace("_", " & ")
+# Format of the last run (data/processed/manifest.json) unless OLIST_FORMAT is set
+FORMAT = served_format()
+data = get_dataset(FORMAT).view(PAGE_COLUMNS)
+# Computes the results of every widget value in the background, unless OLIST_WARMUP=0
+warmer = warmup.get_warmer(FORMAT) if warmup.enabled() else None
+if warmer:
+    warmer.ensure_started()
+# Times the data calls of this rerun when OLIST_PROFILE=1
+profiler = profiling.StepProfiler() if profiling.enabled() else None
+hooks = [profiler] if profiler else None
+# Precomputed KPIs (python app/assets/reports.py), when up to date with the tables
+report = reports.load_report(data.data_versions())
+kpis = report['kpis'][reports.ALL_YEARS] if report else reports.get_kpis(data, hooks=hooks)
 
 st.title("📊 Executive Summary")
 st.markdown("### Olist Brazilian E-Commerce Analysis (2016-2018)")
@@ -40,9 +50,9 @@ with col1:
     """)
 
 with col2:
-    st.metric("Total Revenue", total_revenue)
-    st.metric("Total Orders", total_orders)
-    st.metric("Unique Customers", total_customers)
+    st.metric("Total Revenue", kpis['total_revenue'])
+    st.metric("Total Orders", kpis['total_orders'])
+    st.metric("Unique Customers", kpis['total_customers'])
 
 st.markdown("---")
 
@@ -63,7 +73,7 @@ with col1:
     - High-value categories show distinct seasonal patterns
     - Cross-regional preferences reveal targeted marketing opportunities
     - Product category mix varies significantly by region
-    """.format(highest_selling_city, highest_selling_category))
+    """.format(kpis['highest_selling_city'], kpis['highest_selling_category']))
 
 with col2:
     st.markdown("""
@@ -144,4 +154,11 @@ st.markdown("""
     <p><i>This analysis is part of the CMSE 830 course project (Fall 2025)</i></p>
     <p><b>Navigate to the Main Dashboard to explore interactive visualizations</b></p>
 </div>
-""", unsafe_allow_html=True)
\ No newline at end of file
+""", unsafe_allow_html=True)
+
+if warmer and not (progress := warmer.progress())['ready']:
+    st.sidebar.caption(f"Warming up results: {progress['done']}/{progress['total'] or '?'}")
+
+if profiler:
+    with st.sidebar.expander("Profile"):
+        st.code(profiler.format_report())
\ No newline at end of file
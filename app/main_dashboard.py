@@ -7,81 +7,124 @@ st.set_page_config(layout="wide")
 PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 
-from app.assets.preprocessing import load_processed_data_streamlit
-from app.assets import charts, aggregations, merges
+from app.assets.dataset import get_dataset, served_format
+from app.assets import charts, aggregations, merges, panels, profiling, reports, warmup
+
+# Tables and columns used by this page, loaded on first access
+PAGE_COLUMNS = reports.PAGE_COLUMNS['main_dashboard']
 
 # Load processed data
-data = load_processed_data_streamlit()
-
-df_geo = data['geo']
-df_order = data['order']
-df_order_item = data['order_item']
-df_product = data['product']
-df_customer = data['customer']
-df_product_category = data['product_category']
-df_order_payment = data['order_payment']
-df_order_review = data['order_review']
-
-# Calculate sales by region and ARPU
-sales_by_region = merges.get_sales_by_region_category(data)
-sales_by_region = aggregations.calculate_ARPU(sales_by_region)
-
-#Get KPIs
-#todo Add year filter to KPI's
-total_revenue = aggregations.get_total_revenue(data)
-total_orders = aggregations.get_total_orders(data)
-total_customers = aggregations.get_total_customers(data)
-highest_selling_city = merges.get_highest_selling_cities(data).head(1).index[0].title()
-highest_selling_category = merges.get_highest_selling_categories(data).head(1).index[0].title().replace("_", " & ")
-
-VALID_YEARS = [2017, 2018]
+# Format of the last run (data/processed/manifest.json) unless OLIST_FORMAT is set
+FORMAT = served_format()
+data = get_dataset(FORMAT).view(PAGE_COLUMNS)
+# Computes the results of every widget value in the background, unless OLIST_WARMUP=0
+warmer = warmup.get_warmer(FORMAT) if warmup.enabled() else None
+if warmer:
+    warmer.ensure_started()
+
+# Times the data calls of this rerun when OLIST_PROFILE=1
+profiler = profiling.StepProfiler() if profiling.enabled() else None
+hooks = [profiler] if profiler else None
+
+# Precomputed KPIs and charts (python app/assets/reports.py), when up to date with the tables
+versions = data.data_versions()
+report = reports.load_report(versions)
+
+VALID_YEARS = reports.REPORT_YEARS
 
 st.title("Olist EDA Dashboard")
 
 with st.sidebar:
     selected_year = st.selectbox("Select Year", VALID_YEARS)
 
-# KPI Metrics
-with st.container():
-    st.markdown("## KPI Metrics")
+def get_sales_by_region():
+    # Sales and ARPU by region and category, shared through the merges cache
+    sales_by_region = profiling.call(hooks, merges.get_sales_by_region_category, data)
+    return profiling.call(hooks, aggregations.calculate_ARPU, sales_by_region)
+
+def chart_spec(name: str, key: tuple, make_chart) -> dict:
+    # Report chart when up to date, else the chart computed once per key in this session
+    if report:
+        return reports.load_chart(name)
+    return panels.cached(name, (versions, *key), lambda: make_chart().to_dict())
+
+# Each panel reruns alone on a change of its own widgets and recomputes only when its inputs change
+@panels.panel('kpis', inputs=('year',))
+def kpi_panel(year):
+    #Get KPIs for the selected year, from the monthly rollups and the leaderboard
+    kpis = report['kpis'][str(year)] if report else panels.cached(
+        'kpis', (versions, year), lambda: reports.get_kpis(data, year=year, hooks=hooks))
+    st.markdown(f"## KPI Metrics ({year})")
     col1, col2, col3, col4, col5 = st.columns(5)
     with col1:
         with st.container(border=True):
-            st.markdown(f"## **Total Revenue:** \n ### `{total_revenue}`")
+            st.markdown(f"## **Total Revenue:** \n ### `{kpis['total_revenue']}`")
     with col2:
         with st.container(border=True):
-            st.markdown(f"## **Total Orders:** \n ### `{total_orders}`")
+            st.markdown(f"## **Total Orders:** \n ### `{kpis['total_orders']}`")
     with col3:
         with st.container(border=True):
-            st.markdown(f"## **Total Customers:** \n ### `{total_customers}`")
+            st.markdown(f"## **Total Customers:** \n ### `{kpis['total_customers']}`")
     with col4:
         with st.container(border=True):
-            st.markdown(f"## **Highest Selling City:** \n ### `{highest_selling_city}`")
+            st.markdown(f"## **Highest Selling City:** \n ### `{kpis['highest_selling_city']}`")
     with col5:
         with st.container(border=True):
-            st.markdown(f"## **Highest Selling Category:** \n ### `{highest_selling_category}`")
+            st.markdown(f"## **Highest Selling Category:** \n ### `{kpis['highest_selling_category']}`")
+
+@panels.panel('sales_by_region')
+def sales_by_region_panel():
+    st.vega_lite_chart(spec=chart_spec('sales_by_region', (), lambda: profiling.call(
+        hooks, charts.get_sales_by_region_category_bubble_chart, get_sales_by_region())))
+
+@panels.panel('sales_ARPU', inputs=('year',))
+def sales_ARPU_panel(year):
+    selected_chart = st.selectbox("Choose a chart to display", list(reports.SALES_ARPU_CHARTS))
+    flags = reports.SALES_ARPU_CHARTS[selected_chart][1]
+
+    def make_chart():
+        merged_data = profiling.call(hooks, merges.get_average_sales_ARPU, get_sales_by_region(), data, **flags)
+        return profiling.call(hooks, charts.sales_ARPU_time_chart, merged_data, year=year)
+    st.vega_lite_chart(spec=chart_spec(reports.sales_ARPU_chart_name(selected_chart, year), (), make_chart))
+
+@panels.panel('payment_type')
+def payment_type_panel():
+    st.markdown("## Payment Type")
+    st.vega_lite_chart(spec=chart_spec('payment_type', (), lambda: profiling.call(
+        hooks, charts.payment_type_pie_chart, data['order_payment'])))
+
+@panels.panel('delivery_time')
+def delivery_time_panel():
+    st.markdown("## Delivery Time")
+    st.vega_lite_chart(spec=chart_spec('delivery_time', (), lambda: profiling.call(
+        hooks, charts.delivery_time_boxplot_chart, data['order_fact'])))
+
+# KPI Metrics
+with st.container():
+    kpi_panel(year=selected_year)
 
 # Sales and ARPU by Region and Product Category
 with st.container(border=True):
         st.markdown("## Sales by Region")
         col1, col2 = st.columns(2)
         with col1:
-            st.altair_chart(charts.get_sales_by_region_category_bubble_chart(sales_by_region))
+            sales_by_region_panel()
         with col2:
-            selected_chart = st.selectbox("Choose a chart to display", ["Above Average Sales and Below Average ARPU", "Below Average Sales and Above Average ARPU"])
-            if selected_chart == "Above Average Sales and Below Average ARPU":
-                merged_data = merges.get_average_sales_ARPU(sales_by_region, data, sales=True, ARPU=False)
-                st.altair_chart(charts.sales_ARPU_time_chart(merged_data, year=selected_year))
-            else:
-                merged_data = merges.get_average_sales_ARPU(sales_by_region, data, sales=False, ARPU=True)
-                st.altair_chart(charts.sales_ARPU_time_chart(merged_data, year=selected_year))
+            sales_ARPU_panel(year=selected_year)
 
 
 with st.container(border=True):
     col1, col2 = st.columns(2)
     with col1:
-        st.markdown("## Payment Type")
-        st.altair_chart(charts.payment_type_pie_chart(df_order_payment))
+        payment_type_panel()
     with col2:
-        st.markdown("## Delivery Time")
-        st.altair_chart(charts.delivery_time_boxplot_chart(df_order, df_order_review))
+        delivery_time_panel()
+
+if warmer and not (progress := warmer.progress())['ready']:
+    st.sidebar.caption(f"Warming up results: {progress['done']}/{progress['total'] or '?'}")
+
+if profiler:
+    with st.sidebar.expander("Profile"):
+        st.code(profiler.format_report())
+    with st.sidebar:
+        panels.timings_panel()
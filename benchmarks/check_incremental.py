@@ -0,0 +1,107 @@
+import argparse
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+
+PROJECT_ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from app.assets import incremental
+from app.assets.preprocessing import DEFAULT_FORMAT, PROCESSED_FORMATS, RAW_FILES, save_processed_data
+from benchmarks.synthetic import OLIST_ROWS, generate_raw_data
+
+BENCHMARK_DIR = Path(__file__).parent
+DATA_DIR = BENCHMARK_DIR / 'data'
+# Raw tables split between the first run and the appended batch
+SPLIT_TABLES = ['order', 'order_item', 'order_payment', 'order_review', 'customer']
+
+def split_raw_data(raw_dir: Path, first_dir: Path, full_dir: Path, batch: float, late_payments: bool = False) -> int:
+    """
+    Split raw data into a first run and an appended batch of orders
+
+    Args:
+        raw_dir: Path - Directory holding the raw Olist files
+        first_dir: Path - Receives the raw files without the batch
+        full_dir: Path - Receives the raw files with the batch rows appended after the first run rows,
+            as update_processed_data expects
+        batch: float - Share of the orders, the last ones, in the batch
+        late_payments: bool - Also hold back, until the batch, the payments of the same share of
+            the first run orders (the last ones). Their customers are first processed without payments
+    Returns:
+        int - Orders in the batch
+    Raises:
+        ValueError: If batch is not between 0 and 1
+    """
+    if not 0 < batch < 1:
+        raise ValueError(f"batch must be between 0 and 1, got {batch}")
+    for directory in (first_dir, full_dir):
+        directory.mkdir(parents=True, exist_ok=True)
+        for key, file in RAW_FILES.items():
+            if key not in SPLIT_TABLES:
+                shutil.copy(raw_dir / file, directory / file)
+
+    orders = pd.read_csv(raw_dir / RAW_FILES['order'], usecols=['order_id', 'customer_id'])
+    first = orders.iloc[:len(orders) - round(len(orders) * batch)]
+    paid = first.iloc[:len(first) - round(len(first) * batch)] if late_payments else first
+    for key in SPLIT_TABLES:
+        df = pd.read_csv(raw_dir / RAW_FILES[key])
+        in_first = (df['customer_id'].isin(first['customer_id']) if key == 'customer'
+                    else df['order_id'].isin((paid if key == 'order_payment' else first)['order_id']))
+        df[in_first].to_csv(first_dir / RAW_FILES[key], index=False)
+        pd.concat([df[in_first], df[~in_first]]).to_csv(full_dir / RAW_FILES[key], index=False)
+    return len(orders) - len(first)
+
+def check_incremental(raw_dir: Path, batch: float, fmt: str = DEFAULT_FORMAT, late_payments: bool = False) -> dict[str, str]:
+    """
+    Process the raw data without its last orders, ingest them incrementally and compare with a full rebuild
+
+    Args:
+        raw_dir: Path - Directory holding the raw Olist files
+        batch: float - Share of the orders, the last ones, ingested incrementally
+        fmt: str - Storage format of the processed tables
+        late_payments: bool - Also ingest the payments of some earlier orders, see split_raw_data
+    Returns:
+        dict[str, str] - See incremental.check_against_full, empty if the tables match
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        first_dir, full_dir, processed_dir = Path(tmp) / 'first', Path(tmp) / 'full', Path(tmp) / 'processed'
+        orders = split_raw_data(raw_dir, first_dir, full_dir, batch, late_payments)
+        processed_dir.mkdir()
+        save_processed_data(fmt, processed_dir, first_dir)
+        print(f"Ingesting the last {orders} orders...")
+        incremental.update_processed_data(full_dir, fmt, processed_dir)
+        return incremental.check_against_full(full_dir, fmt, processed_dir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that an incremental run gives the processed tables of a full "
+                                                 "rebuild, on synthetic Olist data")
+    parser.add_argument('--scale', type=float, default=1.0, help="Multiplier of the Olist row counts")
+    parser.add_argument('--base-orders', type=int, default=OLIST_ROWS['order'],
+                        help="Orders at scale 1, lower it for a quick run")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR, help="Where the synthetic raw data is kept")
+    parser.add_argument('--raw-dir', type=Path, help="Check on these raw files instead of synthetic data")
+    parser.add_argument('--batch', type=float, nargs='+', default=[.002, .2],
+                        help="Shares of the orders ingested incrementally, one check each")
+    parser.add_argument('--format', choices=PROCESSED_FORMATS, default=DEFAULT_FORMAT)
+    args = parser.parse_args()
+
+    raw_dir = args.raw_dir
+    if raw_dir is None:
+        scale = int(args.scale) if args.scale.is_integer() else args.scale
+        raw_dir = args.data_dir / f'{scale}x'
+        generate_raw_data(raw_dir, scale, args.seed, args.base_orders)
+
+    failed = False
+    for batch in args.batch:
+        for late_payments in (False, True):
+            differences = check_incremental(raw_dir, batch, args.format, late_payments)
+            for key, difference in differences.items():
+                print(f"{key} differs from the full rebuild:\n{difference}")
+            payments = ", with late payments" if late_payments else ""
+            print(f"Batch of {batch:.1%} of the orders{payments}: {'FAILED' if differences else 'OK'}")
+            failed |= bool(differences)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,97 @@
+import argparse
+import sys
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+
+PROJECT_ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from app.assets import incremental, streaming
+from app.assets.preprocessing import (DEFAULT_FORMAT, DICTIONARY_TABLE, PROCESSED_FORMATS, PROCESSED_TABLES,
+                                      SPENDING_BINS, load_processed_data, save_processed_data)
+from benchmarks.synthetic import OLIST_ROWS, generate_raw_data
+
+BENCHMARK_DIR = Path(__file__).parent
+DATA_DIR = BENCHMARK_DIR / 'data'
+# Rank error of each spending bin edge, as a share of the customers (see sketches.QuantileSketch)
+EDGE_RANK_ERROR = .001
+
+def check_streaming(raw_dir: Path, fmt: str = DEFAULT_FORMAT, partitions: int = 4, chunk_rows: int = 50_000) -> dict[str, str]:
+    """
+    Process the raw data with the streaming and the regular pipeline and compare the tables read back
+
+    Args:
+        raw_dir: Path - Directory holding the raw Olist files
+        fmt: str - Storage format of the processed tables
+        partitions: int - Spill partitions of the streaming run
+        chunk_rows: int - Raw rows read at a time by the streaming run, small values write many chunks
+    Returns:
+        dict[str, str] - See incremental.compare_tables (with dtypes), empty if the tables match
+    Notes:
+        - The dimension dictionary is left out, its codes depend on the labels seen by each pipeline
+        - customer_spending may differ by one bin for up to EDGE_RANK_ERROR of the customers per
+          bin edge, the tolerance of the streamed edges
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        streamed_dir, full_dir = Path(tmp) / 'streaming', Path(tmp) / 'full'
+        streaming.save_processed_data_streaming(fmt, streamed_dir, raw_dir, partitions, chunk_rows)
+        full_dir.mkdir()
+        save_processed_data(fmt, full_dir, raw_dir)
+        streamed = load_processed_data(fmt, processed_dir=streamed_dir)
+        full = load_processed_data(fmt, processed_dir=full_dir)
+        differences = incremental.compare_tables(streamed, full, [key for key in PROCESSED_TABLES
+                                                                  if key not in (DICTIONARY_TABLE, 'customer')],
+                                                 check_dtype=True)
+        customers = streamed['customer']
+        differences.update(incremental.compare_tables({'customer': customers.drop(columns='customer_spending')},
+                                                      full, ['customer'], check_dtype=True))
+        moved = compare_spending_bins(customers, full['customer'])
+        if moved:
+            differences['customer_spending'] = moved
+        return differences
+
+def compare_spending_bins(streamed: pd.DataFrame, full: pd.DataFrame) -> str | None:
+    """
+    Check the streamed customer_spending bins against those of a regular run
+
+    Returns:
+        str | None - What exceeds the tolerance of the streamed edges, None if within it
+    """
+    bins = streamed.set_index('customer_id')['customer_spending'].astype('float64')
+    shift = (bins - full.set_index('customer_id')['customer_spending'].astype('float64')).abs()
+    allowed = int(EDGE_RANK_ERROR * len(full) * (SPENDING_BINS - 1))
+    if (shift > 1).any() or (shift != 0).sum() > allowed:
+        return f"{(shift != 0).sum()} customers in another bin (at most {allowed} by one bin allowed), largest shift {shift.max()}"
+    print(f"{(shift != 0).sum()} of {len(full)} customers in a neighbouring spending bin (at most {allowed} allowed)")
+    return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that the streaming pipeline writes the tables, dtypes and values "
+                                                 "of a regular run, on synthetic Olist data")
+    parser.add_argument('--scale', type=float, default=1.0, help="Multiplier of the Olist row counts")
+    parser.add_argument('--base-orders', type=int, default=OLIST_ROWS['order'],
+                        help="Orders at scale 1, lower it for a quick run")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR, help="Where the synthetic raw data is kept")
+    parser.add_argument('--raw-dir', type=Path, help="Check on these raw files instead of synthetic data")
+    parser.add_argument('--partitions', type=int, default=4)
+    parser.add_argument('--chunk-rows', type=int, default=50_000)
+    parser.add_argument('--format', choices=PROCESSED_FORMATS, nargs='+', default=list(PROCESSED_FORMATS))
+    args = parser.parse_args()
+
+    raw_dir = args.raw_dir
+    if raw_dir is None:
+        scale = int(args.scale) if args.scale.is_integer() else args.scale
+        raw_dir = args.data_dir / f'{scale}x'
+        generate_raw_data(raw_dir, scale, args.seed, args.base_orders)
+
+    failed = False
+    for fmt in args.format:
+        differences = check_streaming(raw_dir, fmt, args.partitions, args.chunk_rows)
+        for key, difference in differences.items():
+            print(f"{key} differs from the regular run:\n{difference}")
+        print(f"Streaming to {fmt}: {'FAILED' if differences else 'OK'}")
+        failed |= bool(differences)
+    sys.exit(1 if failed else 0)
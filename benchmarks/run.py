@@ -0,0 +1,316 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+PROJECT_ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from app.assets import aggregations, charts, engines, merges
+from app.assets.preprocessing import LOW_MEMORY_DTYPES, PIPELINE_STEPS, load_raw_data
+from benchmarks.synthetic import OLIST_ROWS, generate_raw_data
+
+BENCHMARK_DIR = Path(__file__).parent
+DATA_DIR = BENCHMARK_DIR / 'data'
+RESULTS_DIR = BENCHMARK_DIR / 'results'
+DEFAULT_SCALES = [1, 10, 100]
+# Year passed to the year filtered dashboard functions
+BENCHMARK_YEAR = 2017
+
+def measure(func: Callable, repeat: int = 1, memory: bool = True) -> tuple[object, dict]:
+    """
+    Time a zero-argument callable and trace its peak memory
+
+    Args:
+        func: Callable - Must not modify its inputs, it is called repeat (+1 with memory) times
+        repeat: int - Timed calls, the fastest is reported
+        memory: bool - Trace the allocations of one more call with tracemalloc
+    Returns:
+        tuple[object, dict]
+            - The result of the last call
+            - Stats: seconds (fastest call), peak_bytes (peak allocation above the memory in use
+              before the call), retained_bytes (memory still allocated by the result)
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - start)
+    stats = {'seconds': min(seconds)}
+    if memory:
+        result, stats['peak_bytes'], stats['retained_bytes'] = _trace(func)
+    return result, stats
+
+def benchmark_pipeline(raw: dict, repeat: int = 1, memory: bool = True) -> tuple[dict, dict]:
+    """
+    Time and trace each step of preprocess_data
+
+    Args:
+        raw: dict - Raw tables, left unmodified (every run starts from a copy)
+        repeat: int - Timed runs of the whole pipeline, the fastest run of each step is reported
+        memory: bool - Trace the allocations of each step during one more run
+    Returns:
+        tuple[dict, dict]
+            - Processed tables
+            - Stats per step name, see measure(), and of the whole pipeline under preprocess_data
+              (peak_bytes is the peak of the run above the raw tables)
+    """
+    stats = {step.__name__: {'seconds': float('inf')} for step in PIPELINE_STEPS}
+    for _ in range(repeat):
+        data = _copy_tables(raw)
+        for step in PIPELINE_STEPS:
+            start = time.perf_counter()
+            data = step(data)
+            stats[step.__name__]['seconds'] = min(stats[step.__name__]['seconds'], time.perf_counter() - start)
+    total = {'seconds': sum(step_stats['seconds'] for step_stats in stats.values())}
+    if memory:
+        data = _copy_tables(raw)
+        # One trace for the whole run, so memory freed by a later step counts against it
+        tracemalloc.start()
+        try:
+            total['peak_bytes'] = 0
+            for step in PIPELINE_STEPS:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                data = step(data)
+                current, peak = tracemalloc.get_traced_memory()
+                stats[step.__name__]['peak_bytes'] = peak - before
+                stats[step.__name__]['retained_bytes'] = current - before
+                total['peak_bytes'] = max(total['peak_bytes'], peak)
+            total['retained_bytes'] = current
+        finally:
+            tracemalloc.stop()
+    stats['preprocess_data'] = total
+    return data, stats
+
+def dashboard_calls(data: dict) -> dict[str, Callable]:
+    """
+    The data functions the dashboard pages call, bound to their arguments
+
+    merges and aggregations functions are called uncached, charts are serialised to the
+    Vega-Lite spec Streamlit sends to the browser. get_average_sales_ARPU slices the cached
+    sales cube, whose build is timed on its own as get_sales_cube.
+
+    Args:
+        data: dict - Processed tables
+    Returns:
+        dict[str, Callable] - Zero-argument callables per function name
+    """
+    sales_by_region = merges.get_sales_by_region_category.uncached(data)
+    sales_ARPU = aggregations.calculate_ARPU.uncached(sales_by_region)
+    merged = merges.get_average_sales_ARPU.uncached(sales_ARPU, data, sales=True, ARPU=False)
+    return {
+        'get_sales_by_region_category': lambda: merges.get_sales_by_region_category.uncached(data),
+        'calculate_ARPU': lambda: aggregations.calculate_ARPU.uncached(sales_by_region),
+        'get_sales_cube': lambda: merges.get_sales_cube.uncached(data),
+        'get_average_sales_ARPU': lambda: merges.get_average_sales_ARPU.uncached(sales_ARPU, data, sales=True, ARPU=False),
+        'get_highest_selling_cities': lambda: merges.get_highest_selling_cities.uncached(data),
+        'get_highest_selling_categories': lambda: merges.get_highest_selling_categories.uncached(data),
+        'get_top_sellers[year]': lambda: merges.get_top_sellers.uncached(data, 'city', year=BENCHMARK_YEAR),
+        'get_total_revenue': lambda: aggregations.get_total_revenue.uncached(data),
+        'get_total_orders': lambda: aggregations.get_total_orders.uncached(data),
+        'get_total_customers': lambda: aggregations.get_total_customers.uncached(data),
+        'get_total_customers[year]': lambda: aggregations.get_total_customers.uncached(data, year=BENCHMARK_YEAR),
+        'bubble_chart': lambda: charts.get_sales_by_region_category_bubble_chart(sales_ARPU).to_dict(),
+        'sales_ARPU_time_chart': lambda: charts.sales_ARPU_time_chart(merged, year=BENCHMARK_YEAR).to_dict(),
+        'payment_type_pie_chart': lambda: charts.payment_type_pie_chart(data['order_payment']).to_dict(),
+        'delivery_time_boxplot_chart': lambda: charts.delivery_time_boxplot_chart(data['order_fact']).to_dict(),
+    }
+
+def benchmark_dashboard(data: dict, repeat: int = 1, memory: bool = True) -> dict:
+    """
+    Time and trace each dashboard data function, see dashboard_calls()
+
+    Returns:
+        dict - Stats per function name, see measure()
+    """
+    return {name: measure(func, repeat, memory)[1] for name, func in dashboard_calls(data).items()}
+
+def benchmark_scale(scale: float,
+                    data_dir: Path = DATA_DIR,
+                    base_orders: int = OLIST_ROWS['order'],
+                    seed: int = 0,
+                    repeat: int = 1,
+                    memory: bool = True,
+                    low_memory: bool = False) -> dict:
+    """
+    Generate (or reuse) the synthetic raw data of one scale and benchmark it
+
+    low_memory loads the raw tables with LOW_MEMORY_DTYPES, as save_processed_data(low_memory=True).
+
+    Returns:
+        dict - Keys: raw_rows, load_raw_data, pipeline, dashboard, processed_rows
+    """
+    raw_dir = data_dir / f'{scale}x'
+    print(f"[{scale}x] Generating synthetic raw data in {raw_dir}...")
+    raw_rows = generate_raw_data(raw_dir, scale, seed, base_orders)
+
+    print(f"[{scale}x] Loading raw data...")
+    dtypes = LOW_MEMORY_DTYPES if low_memory else None
+    raw, load_stats = measure(lambda: load_raw_data(raw_dir, dtypes=dtypes), memory=memory)
+    print(f"[{scale}x] Running the pipeline...")
+    data, pipeline = benchmark_pipeline(raw, repeat, memory)
+    del raw
+    print(f"[{scale}x] Running the dashboard functions...")
+    dashboard = benchmark_dashboard(data, repeat, memory)
+    return {
+        'raw_rows': raw_rows,
+        'load_raw_data': load_stats,
+        'pipeline': pipeline,
+        'dashboard': dashboard,
+        'processed_rows': {key: len(df) for key, df in data.items()},
+    }
+
+def run(scales: list[float] = DEFAULT_SCALES,
+        data_dir: Path = DATA_DIR,
+        base_orders: int = OLIST_ROWS['order'],
+        seed: int = 0,
+        repeat: int = 1,
+        memory: bool = True,
+        low_memory: bool = False) -> dict:
+    """
+    Benchmark every scale
+
+    Returns:
+        dict - Keys: meta (commit, versions, parameters), scales (benchmark_scale() per scale)
+    """
+    results = {
+        'meta': {
+            **_git_info(),
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'engine': engines.get_engine().name,
+            'platform': platform.platform(),
+            'base_orders': base_orders,
+            'seed': seed,
+            'repeat': repeat,
+            'memory': memory,
+            'low_memory': low_memory,
+        },
+        'scales': {},
+    }
+    for scale in scales:
+        results['scales'][str(scale)] = benchmark_scale(scale, data_dir, base_orders, seed, repeat, memory, low_memory)
+    return results
+
+def format_results(results: dict) -> str:
+    """
+    Summary table of run() results, one column pair (seconds, peak MB) per scale
+    """
+    scales = list(results['scales'])
+    header = f"{'':<34}" + ''.join(f"{scale + 'x s':>12}{'MB':>9}" for scale in scales)
+    lines = [header]
+    for section in ['load_raw_data', 'pipeline', 'dashboard']:
+        lines.append(section)
+        for name, per_scale in _rows(results, section).items():
+            cells = ''
+            for scale in scales:
+                stats = per_scale.get(scale, {})
+                peak = stats.get('peak_bytes')
+                cells += f"{stats.get('seconds', float('nan')):>12.3f}"
+                cells += f"{peak / 1024 ** 2:>9.1f}" if peak is not None else f"{'':>9}"
+            lines.append(f"  {name:<32}{cells}")
+    return '\n'.join(lines)
+
+def compare_results(old: dict, new: dict) -> str:
+    """
+    Seconds and peak memory of new relative to old, for the scales and functions in both
+    """
+    lines = [f"{'':<40}{'old s':>10}{'new s':>10}{'ratio':>8}{'old MB':>10}{'new MB':>10}"]
+    for scale in [scale for scale in new['scales'] if scale in old['scales']]:
+        for section in ['load_raw_data', 'pipeline', 'dashboard']:
+            old_rows, new_rows = _rows(old, section), _rows(new, section)
+            for name in [name for name in new_rows if name in old_rows]:
+                before, after = old_rows[name].get(scale), new_rows[name].get(scale)
+                if before is None or after is None:
+                    continue
+                mb = [stats.get('peak_bytes', float('nan')) / 1024 ** 2 for stats in (before, after)]
+                lines.append(f"{scale + 'x ' + name:<40}{before['seconds']:>10.3f}{after['seconds']:>10.3f}"
+                             f"{after['seconds'] / before['seconds']:>8.2f}{mb[0]:>10.1f}{mb[1]:>10.1f}")
+    return '\n'.join(lines)
+
+def _rows(results: dict, section: str) -> dict[str, dict]:
+    # {name: {scale: stats}} for one section of the results
+    rows = {}
+    for scale, scale_results in results['scales'].items():
+        stats = scale_results[section]
+        for name, value in ({section: stats} if 'seconds' in stats else stats).items():
+            rows.setdefault(name, {})[scale] = value
+    return rows
+
+def _trace(func: Callable) -> tuple[object, int, int]:
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak - before, current - before
+
+def _copy_tables(data: dict) -> dict:
+    return {key: df.copy() for key, df in data.items()}
+
+def _git_info() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=PROJECT_ROOT,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {'commit': commit, 'dirty': dirty}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing pipeline and dashboard data functions "
+                                                 "on synthetic Olist data")
+    parser.add_argument('--scales', type=float, nargs='+', default=DEFAULT_SCALES,
+                        help="Multipliers of the Olist row counts")
+    parser.add_argument('--base-orders', type=int, default=OLIST_ROWS['order'],
+                        help="Orders at scale 1, lower it for a quick run")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help="Timed runs, the fastest is reported")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the tracemalloc runs")
+    parser.add_argument('--data-dir', type=Path, default=DATA_DIR, help="Where the synthetic raw data is kept")
+    parser.add_argument('--low-memory', action='store_true',
+                        help="Load the raw tables with the low-memory dtypes of the preprocessing")
+    parser.add_argument('--engine', choices=tuple(engines.ENGINES), help="Engine of the merges and aggregations")
+    parser.add_argument('--output', type=Path, help="Results JSON, defaults to benchmarks/results/<time>-<commit>.json")
+    parser.add_argument('--compare', type=Path, nargs='+', metavar='RESULTS',
+                        help="Compare with a previous results JSON. With two files, compare them without running")
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) == 2:
+        old, new = (json.loads(path.read_text()) for path in args.compare)
+        print(compare_results(old, new))
+        sys.exit()
+
+    if args.engine:
+        os.environ[engines.ENGINE_ENV] = args.engine
+    scales = [int(scale) if scale.is_integer() else scale for scale in args.scales]
+    results = run(scales, args.data_dir, args.base_orders, args.seed, args.repeat, not args.no_memory,
+                  args.low_memory)
+
+    output = args.output
+    if output is None:
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = RESULTS_DIR / f"{stamp}-{(results['meta']['commit'] or 'nogit')[:7]}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+
+    print(format_results(results))
+    if args.compare:
+        print(compare_results(json.loads(args.compare[0].read_text()), results))
+    print(f"Results written to {output}")
@@ -0,0 +1,256 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from app.assets.preprocessing import DATA_RAW_DIR, RAW_FILES
+
+# Row counts of the public Olist dataset, generated at scale 1
+OLIST_ROWS = {
+    'order': 99_441,
+    'geo': 1_000_163,
+    'product': 32_951,
+    'seller': 3_095,
+}
+# Zip code prefixes and cities in the Olist geolocation table. Upper bounds when scaling,
+# a larger dataset adds customers and geolocation points, not zip codes
+OLIST_ZIPS = 19_015
+OLIST_CITIES = 8_011
+FIRST_PURCHASE = pd.Timestamp('2016-09-04')
+LAST_PURCHASE = pd.Timestamp('2018-10-17')
+
+# Approximate share of customers per state
+STATE_WEIGHTS = {
+    'SP': .420, 'RJ': .129, 'MG': .117, 'RS': .055, 'PR': .051, 'SC': .037, 'BA': .034,
+    'DF': .021, 'ES': .020, 'GO': .020, 'PE': .017, 'CE': .013, 'PA': .010, 'MT': .009,
+    'MA': .007, 'MS': .007, 'PB': .005, 'PI': .005, 'RN': .005, 'AL': .004, 'SE': .0035,
+    'TO': .0028, 'RO': .0025, 'AM': .0015, 'AC': .0008, 'AP': .0007, 'RR': .0005,
+}
+ORDER_STATUSES = {
+    'delivered': .9702, 'shipped': .0111, 'canceled': .0063, 'unavailable': .0061,
+    'invoiced': .0032, 'processing': .0030, 'created': .0001,
+}
+PAYMENT_TYPES = {'credit_card': .739, 'boleto': .190, 'voucher': .056, 'debit_card': .015}
+# Probability of an order having 0, 1, 2, ... items
+ITEMS_PER_ORDER = [.0078, .8936, .0756, .0133, .0051, .0021, .0025]
+PAYMENTS_PER_ORDER = [0, .957, .030, .013]
+REVIEW_RATE = .99
+PARAMS_FILE = 'synthetic.json'
+
+def generate_raw_data(raw_dir: Path,
+                      scale: float = 1,
+                      seed: int = 0,
+                      base_orders: int = OLIST_ROWS['order'],
+                      chunk_orders: int = 200_000) -> dict[str, int]:
+    """
+    Write synthetic raw tables with the Olist file names and schema
+
+    Args:
+        raw_dir: Path - Output directory
+        scale: float - Multiplier of the orders, items, payments, reviews, customers and geolocation rows
+        seed: int - Random seed, the output is identical for identical arguments
+        base_orders: int - Orders at scale 1 (the Olist size by default). Products, sellers and
+            geolocation rows keep their Olist ratio to it, zip codes and cities are capped at the Olist counts
+        chunk_orders: int - Orders generated and written at a time, bounds memory at large scales
+    Returns:
+        dict[str, int] - Rows written per table
+    Notes:
+        - Skips generation when raw_dir already holds the output of the same arguments
+    """
+    raw_dir = Path(raw_dir)
+    params = {'scale': scale, 'seed': seed, 'base_orders': base_orders}
+    params_path = raw_dir / PARAMS_FILE
+    if params_path.exists():
+        saved = json.loads(params_path.read_text())
+        if saved['params'] == params:
+            return saved['rows']
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    params_path.unlink(missing_ok=True)
+
+    rng = np.random.default_rng(seed)
+    ratio = base_orders / OLIST_ROWS['order']
+    n_orders = max(1, int(base_orders * scale))
+    n_geo = max(1, int(OLIST_ROWS['geo'] * ratio * scale))
+    n_products = max(1, int(OLIST_ROWS['product'] * ratio))
+    n_sellers = max(1, int(OLIST_ROWS['seller'] * ratio))
+    n_zips = max(len(STATE_WEIGHTS), min(OLIST_ZIPS, int(OLIST_ZIPS * ratio * scale)))
+    n_cities = max(len(STATE_WEIGHTS), min(OLIST_CITIES, int(OLIST_CITIES * ratio * scale)))
+
+    zips = _zip_table(rng, n_zips, n_cities)
+    rows = {
+        'geo': _write_geo(rng, raw_dir / RAW_FILES['geo'], zips, n_geo, chunk_orders * 10),
+        'product_category': _write_product_category(raw_dir / RAW_FILES['product_category']),
+    }
+    categories = pd.read_csv(raw_dir / RAW_FILES['product_category'])['product_category_name']
+    rows['product'] = _write_products(rng, raw_dir / RAW_FILES['product'], categories, n_products)
+    rows['seller'] = _write_sellers(rng, raw_dir / RAW_FILES['seller'], zips, n_sellers)
+
+    for key in ['order', 'order_item', 'order_payment', 'order_review', 'customer']:
+        rows[key] = 0
+    product_ids, seller_ids = _ids(1, 0, n_products), _ids(2, 0, n_sellers)
+    for start in range(0, n_orders, chunk_orders):
+        tables = _order_tables(rng, start, min(start + chunk_orders, n_orders), zips, product_ids, seller_ids)
+        for key, df in tables.items():
+            df.to_csv(raw_dir / RAW_FILES[key], mode='w' if start == 0 else 'a', header=start == 0, index=False)
+            rows[key] += len(df)
+
+    params_path.write_text(json.dumps({'params': params, 'rows': rows}, indent=2))
+    return rows
+
+def _ids(tag: int, start: int, stop: int) -> np.ndarray:
+    # 32 hex characters, like the Olist ids, distinct between tables
+    return np.array([f'{tag:x}{i:031x}' for i in range(start, stop)], dtype=object)
+
+def _zip_table(rng: np.random.Generator, n_zips: int, n_cities: int) -> pd.DataFrame:
+    states = np.array(list(STATE_WEIGHTS))
+    weights = np.array(list(STATE_WEIGHTS.values()))
+    weights /= weights.sum()
+
+    # Every state has at least one city and one zip code
+    city_state = np.concatenate([np.arange(len(states)), rng.choice(len(states), n_cities - len(states), p=weights)])
+    zip_state = np.concatenate([np.arange(len(states)), rng.choice(len(states), n_zips - len(states), p=weights)])
+
+    # Pick a city of the same state for each zip code
+    city_order = np.argsort(city_state, kind='stable')
+    counts = np.bincount(city_state, minlength=len(states))
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    zip_city = city_order[offsets[zip_state] + rng.integers(0, counts[zip_state])]
+
+    return pd.DataFrame({
+        'zip_code_prefix': np.sort(rng.choice(np.arange(1_000, 100_000), n_zips, replace=False)),
+        'city': np.char.add('city_', zip_city.astype(str)),
+        'state': states[zip_state],
+        'latitude': rng.uniform(-30, -3, n_zips),
+        'longitude': rng.uniform(-60, -35, n_zips),
+    })
+
+def _write_geo(rng: np.random.Generator, path: Path, zips: pd.DataFrame, n_rows: int, chunk_rows: int) -> int:
+    for start in range(0, n_rows, chunk_rows):
+        n = min(chunk_rows, n_rows - start)
+        z = zips.iloc[rng.integers(0, len(zips), n)]
+        pd.DataFrame({
+            'geolocation_zip_code_prefix': z['zip_code_prefix'].to_numpy(),
+            'geolocation_lat': z['latitude'].to_numpy() + rng.normal(0, .05, n),
+            'geolocation_lng': z['longitude'].to_numpy() + rng.normal(0, .05, n),
+            'geolocation_city': z['city'].to_numpy(),
+            'geolocation_state': z['state'].to_numpy(),
+        }).to_csv(path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+    return n_rows
+
+def _write_product_category(path: Path) -> int:
+    # The category translation is small and ships with the repo
+    df = pd.read_csv(DATA_RAW_DIR / RAW_FILES['product_category'])
+    df.to_csv(path, index=False)
+    return len(df)
+
+def _write_products(rng: np.random.Generator, path: Path, categories: pd.Series, n: int) -> int:
+    category = pd.Series(rng.choice(categories.to_numpy(), n)).where(rng.random(n) > .0185)
+    pd.DataFrame({
+        'product_id': _ids(1, 0, n),
+        'product_category_name': category,
+        'product_name_lenght': rng.integers(5, 77, n),
+        'product_description_lenght': rng.integers(4, 4_000, n),
+        'product_photos_qty': rng.integers(1, 7, n),
+        'product_weight_g': rng.lognormal(6.6, 1.2, n).round(),
+        'product_length_cm': rng.integers(7, 106, n),
+        'product_height_cm': rng.integers(2, 106, n),
+        'product_width_cm': rng.integers(6, 119, n),
+    }).to_csv(path, index=False)
+    return n
+
+def _write_sellers(rng: np.random.Generator, path: Path, zips: pd.DataFrame, n: int) -> int:
+    z = zips.iloc[rng.integers(0, len(zips), n)]
+    pd.DataFrame({
+        'seller_id': _ids(2, 0, n),
+        'seller_zip_code_prefix': z['zip_code_prefix'].to_numpy(),
+        'seller_city': z['city'].to_numpy(),
+        'seller_state': z['state'].to_numpy(),
+    }).to_csv(path, index=False)
+    return n
+
+def _order_tables(rng: np.random.Generator, start: int, stop: int, zips: pd.DataFrame,
+                  product_ids: np.ndarray, seller_ids: np.ndarray) -> dict[str, pd.DataFrame]:
+    n = stop - start
+    order_ids = _ids(3, start, stop)
+    customer_ids = _ids(4, start, stop)
+
+    # One customer per order, a few customers order again under a new customer_id
+    z = zips.iloc[rng.integers(0, len(zips), n)]
+    unique = np.where(rng.random(n) < .034, rng.integers(0, stop, n), np.arange(start, stop))
+    customer = pd.DataFrame({
+        'customer_id': customer_ids,
+        'customer_unique_id': np.array([f'{5:x}{i:031x}' for i in unique], dtype=object),
+        'customer_zip_code_prefix': z['zip_code_prefix'].to_numpy(),
+        'customer_city': z['city'].to_numpy(),
+        'customer_state': z['state'].to_numpy(),
+    })
+
+    # Volume grows over time, as in the Olist data
+    span = (LAST_PURCHASE - FIRST_PURCHASE).total_seconds()
+    purchase = FIRST_PURCHASE + pd.to_timedelta(np.sqrt(rng.random(n)) * span, unit='s').floor('s')
+    status = rng.choice(list(ORDER_STATUSES), n, p=_probabilities(ORDER_STATUSES.values()))
+    delivered = status == 'delivered'
+    approved = purchase + pd.to_timedelta(rng.exponential(10 * 3600, n), unit='s').floor('s')
+    carrier = approved + pd.to_timedelta(rng.gamma(2, 1.5 * 86400, n), unit='s').floor('s')
+    customer_date = carrier + pd.to_timedelta(rng.gamma(2, 4 * 86400, n), unit='s').floor('s')
+    order = pd.DataFrame({
+        'order_id': order_ids,
+        'customer_id': customer_ids,
+        'order_status': status,
+        'order_purchase_timestamp': purchase,
+        'order_approved_at': pd.Series(approved).where(status != 'created'),
+        'order_delivered_carrier_date': pd.Series(carrier).where(delivered | (status == 'shipped')),
+        # A few delivered orders miss their delivery date, impute_order_delivery fills them
+        'order_delivered_customer_date': pd.Series(customer_date).where(delivered & (rng.random(n) > .0001)),
+        'order_estimated_delivery_date': (purchase + pd.to_timedelta(rng.integers(10, 40, n), unit='D')).normalize(),
+    })
+
+    n_items = rng.choice(len(ITEMS_PER_ORDER), n, p=_probabilities(ITEMS_PER_ORDER))
+    item_order = np.repeat(np.arange(n), n_items)
+    order_item = pd.DataFrame({
+        'order_id': order_ids[item_order],
+        'order_item_id': _sequence(item_order),
+        'product_id': product_ids[rng.integers(0, len(product_ids), len(item_order))],
+        'seller_id': seller_ids[rng.integers(0, len(seller_ids), len(item_order))],
+        'shipping_limit_date': purchase[item_order] + pd.Timedelta('6D'),
+        'price': rng.lognormal(4.4, .85, len(item_order)).round(2),
+        'freight_value': rng.gamma(3, 6.7, len(item_order)).round(2),
+    })
+
+    n_payments = rng.choice(len(PAYMENTS_PER_ORDER), n, p=_probabilities(PAYMENTS_PER_ORDER))
+    payment_order = np.repeat(np.arange(n), n_payments)
+    order_payment = pd.DataFrame({
+        'order_id': order_ids[payment_order],
+        'payment_sequential': _sequence(payment_order),
+        'payment_type': rng.choice(list(PAYMENT_TYPES), len(payment_order), p=_probabilities(PAYMENT_TYPES.values())),
+        'payment_installments': rng.integers(1, 11, len(payment_order)),
+        'payment_value': rng.lognormal(4.7, .85, len(payment_order)).round(2),
+    })
+
+    review_order = np.flatnonzero(rng.random(n) < REVIEW_RATE)
+    order_review = pd.DataFrame({
+        'review_id': _ids(6, start, stop)[review_order],
+        'order_id': order_ids[review_order],
+        'review_score': rng.choice([1, 2, 3, 4, 5], len(review_order), p=[.115, .032, .083, .193, .577]),
+        'review_comment_title': None,
+        'review_comment_message': None,
+        'review_creation_date': (purchase[review_order] + pd.Timedelta('12D')).normalize(),
+        'review_answer_timestamp': purchase[review_order] + pd.Timedelta('14D'),
+    })
+
+    return {
+        'order': order,
+        'order_item': order_item,
+        'order_payment': order_payment,
+        'order_review': order_review,
+        'customer': customer,
+    }
+
+def _sequence(groups: np.ndarray) -> np.ndarray:
+    # 1, 2, ... within each run of equal values of a sorted array
+    return pd.Series(groups).groupby(groups).cumcount().to_numpy() + 1
+
+def _probabilities(weights) -> np.ndarray:
+    weights = np.fromiter(weights, dtype=float)
+    return weights / weights.sum()